@@ -0,0 +1,57 @@
+"""Micro-benchmark of patching jvm.eval(...) templates.
+
+Compares the single-pass `jvm.eval_all` used by JVMInstruction.eval_and_patch
+with the previous approach of calling `jvm.eval` until nothing is left.
+
+    python benchmarks/bench_eval_and_patch.py
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from jarvis.smartgpt import jvm  # noqa: E402
+
+
+def eval_loop(text):
+    while True:
+        patched = jvm.eval(text)
+        if patched is None:
+            return text
+        text = patched
+
+
+def build_content(placeholders, filler_len):
+    filler = "lorem ipsum dolor sit amet " * (filler_len // 27 + 1)
+    parts = []
+    for i in range(placeholders):
+        parts.append(filler[:filler_len])
+        parts.append(f"jvm.eval(jvm.get('summary_{i % 10}.seq3.str'))")
+    return "".join(parts)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        context = jvm.JVMContext(os.path.join(tmp_dir, "kv_store.json"))
+        with jvm.use_context(context):
+            for i in range(10):
+                jvm.set(f"summary_{i}.seq3.str", f"summary of page {i} " * 20)
+
+            print(f"{'placeholders':>12} {'text length':>12} {'loop (ms)':>10} {'single pass (ms)':>17} {'speedup':>8}")
+            for placeholders, filler_len in [(10, 200), (100, 200), (500, 500), (1000, 1000)]:
+                text = build_content(placeholders, filler_len)
+                assert eval_loop(text) == jvm.eval_all(text)
+
+                number = max(1, 200 // placeholders)
+                loop_time = timeit.timeit(lambda: eval_loop(text), number=number) / number
+                single_time = timeit.timeit(lambda: jvm.eval_all(text), number=number) / number
+                print(
+                    f"{placeholders:>12} {len(text):>12} {loop_time * 1000:>10.2f} "
+                    f"{single_time * 1000:>17.2f} {loop_time / single_time:>7.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Throughput of extracting the plain text of HTML pages.
+
+Compares FetchWebContentAction's previous BeautifulSoup extraction with the
+streaming extractor, on every engine available. Pass a directory of saved
+.html pages as corpus, otherwise synthetic article pages are generated.
+
+    python benchmarks/bench_extract_text.py [corpus_dir]
+"""
+import os
+import sys
+import glob
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from jarvis.smartgpt import extractor  # noqa: E402
+
+
+def extract_text_bs4(html):
+    # FetchWebContentAction.extract_text before the streaming extractor
+    soup = BeautifulSoup(html, "html.parser")
+    for script in soup(["script", "style"]):
+        script.extract()
+
+    for a in soup.find_all("a"):
+        url = a.get("href", "")
+        if url and (url.startswith("http://") or url.startswith("https://")):
+            a.string = f"[{a.get_text()}]({url})"
+
+    text = soup.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return "\n".join(chunk for chunk in chunks if chunk)
+
+
+def synthetic_page(paragraphs):
+    nav = "".join(f'<li><a href="/section/{i}">Section {i}</a></li>' for i in range(30))
+    body = "".join(
+        f"<p>Paragraph {i} of the article, with <b>some</b> markup and "
+        f'<a href="https://example.com/ref/{i}">a reference</a>.  '
+        f"{'Lorem ipsum dolor sit amet. ' * 8}</p>\n"
+        for i in range(paragraphs)
+    )
+    return (
+        "<!DOCTYPE html><html><head><title>Article</title>"
+        "<style>p { margin: 0 }</style><script>window.analytics = {};</script></head>"
+        f"<body><nav><ul>{nav}</ul></nav><main><article>{body}</article></main>"
+        "<footer><p>Copyright</p></footer></body></html>"
+    )
+
+
+def load_corpus(corpus_dir):
+    if corpus_dir:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(corpus_dir, "*.htm*"))):
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                pages.append((os.path.basename(path), f.read()))
+        return pages
+    return [(f"synthetic-{n}", synthetic_page(n)) for n in (10, 100, 1000)]
+
+
+def main():
+    corpus = load_corpus(sys.argv[1] if len(sys.argv) > 1 else None)
+    engines = ["stdlib"] + (["lxml"] if extractor.etree is not None else [])
+    candidates = [("bs4", extract_text_bs4)]
+    for engine in engines:
+        candidates.append(
+            (
+                f"{engine}",
+                lambda html, engine=engine: extractor.extract_text(
+                    html, skip_boilerplate=False, engine=engine
+                ),
+            )
+        )
+        candidates.append(
+            (
+                f"{engine}+skip",
+                lambda html, engine=engine: extractor.extract_text(
+                    html, skip_boilerplate=True, engine=engine
+                ),
+            )
+        )
+
+    header = f"{'page':>24} {'KiB':>8}" + "".join(f" {name + ' MB/s':>16}" for name, _ in candidates)
+    print(header)
+    totals = {name: 0.0 for name, _ in candidates}
+    total_bytes = 0
+    for name, html in corpus:
+        size = len(html.encode("utf-8"))
+        total_bytes += size
+        number = max(1, 2_000_000 // max(size, 1))
+        row = f"{name[:24]:>24} {size / 1024:>8.1f}"
+        for candidate, extract in candidates:
+            seconds = timeit.timeit(lambda: extract(html), number=number) / number
+            totals[candidate] += seconds
+            row += f" {size / seconds / 1e6:>16.2f}"
+        print(row)
+
+    print(
+        f"{'total':>24} {total_bytes / 1024:>8.1f}"
+        + "".join(f" {total_bytes / totals[name] / 1e6:>16.2f}" for name, _ in candidates)
+    )
+
+
+if __name__ == "__main__":
+    main()
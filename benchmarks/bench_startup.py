@@ -0,0 +1,73 @@
+"""Startup cost of importing the smartgpt modules.
+
+Every CLI invocation, test run and RunPython child pays for its imports, so
+each module is imported in a fresh interpreter and the median wall time of
+several runs is reported. The first use of the LLM clients and of the
+tokenizer, which are created lazily, is measured separately.
+
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import sys
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = [
+    "jarvis.smartgpt.jvm",
+    "jarvis.smartgpt.gpt",
+    "jarvis.smartgpt.actions",
+    "jarvis.smartgpt.instruction",
+]
+
+FIRST_USES = {
+    "chat client": "gpt.OPEN_AI_MODELS_HUB[gpt.GPT_3_5_TURBO]",
+    "tokenizer": "gpt.count_tokens('hello world')",
+}
+
+
+def timed(setup, statement):
+    # the interpreter start itself is left out, only the statement is timed
+    code = (
+        "import time\n"
+        f"{setup}\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def report(name, setup, statement, runs):
+    try:
+        seconds = [timed(setup, statement) for _ in range(runs)]
+    except subprocess.CalledProcessError as err:
+        print(f"{name:>32} failed: {err.stderr.strip().splitlines()[-1]}")
+        return
+    print(
+        f"{name:>32} {statistics.median(seconds) * 1000:>10.1f} {min(seconds) * 1000:>10.1f}"
+    )
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"{'import / first use':>32} {'median ms':>10} {'min ms':>10}")
+    for module in MODULES:
+        report(module, "", f"import {module}", runs)
+    for name, statement in FIRST_USES.items():
+        report(name, "from jarvis.smartgpt import gpt", statement, runs)
+
+
+if __name__ == "__main__":
+    main()
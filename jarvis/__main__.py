@@ -10,6 +10,7 @@ from jarvis.smartgpt import gpt
 from jarvis.smartgpt import planner
 from jarvis.smartgpt import instruction
 from jarvis.smartgpt import compiler
+from jarvis.smartgpt import profiler
 
 
 PLANNER_MODEL = gpt.GPT_4
@@ -27,6 +28,9 @@ def run():
     parser.add_argument('--goalfile', type=str, default='', help='Specify the goal description file for Jarvis')
     parser.add_argument('--compile', type=int, default=0, help='Translate plan into instructions with given task number')
     parser.add_argument('--workspace', type=str, default='workspace', help='Specify the workspace directory')
+    parser.add_argument('--profile', type=str, default='',
+                        help='Profile the execution of --yaml, writing the profile to this JSON file '
+                             'and a Chrome trace next to it')
 
     args = parser.parse_args()
 
@@ -48,8 +52,16 @@ def run():
             task_instrs = yaml.safe_load(f)
         logging.info(f"Running JVM Instructions:\n{task_instrs}")
 
-        interpreter = instruction.JVMInterpreter()
-        interpreter.run(task_instrs["instructions"], task=task_instrs["task"])
+        run_profiler = profiler.Profiler() if args.profile else None
+        interpreter = instruction.JVMInterpreter(profiler=run_profiler)
+        try:
+            interpreter.run(task_instrs["instructions"], task=task_instrs["task"])
+        finally:
+            if run_profiler is not None:
+                trace_file = os.path.splitext(args.profile)[0] + ".trace.json"
+                run_profiler.dump_json(args.profile)
+                run_profiler.dump_chrome_trace(trace_file)
+                logging.info(f"Wrote the profile to {args.profile} and {trace_file}")
     else:
         if args.replan:
             goal = ""
@@ -1,9 +1,9 @@
 import ast
 import glob
 import os
+import shutil
 import uuid
 import logging
-import tiktoken
 import re
 import json
 
@@ -17,6 +17,7 @@ import yaml
 from jarvis.smartgpt import initializer
 from jarvis.smartgpt import planner
 from jarvis.smartgpt import instruction
+from jarvis.smartgpt import checkpoint
 from jarvis.smartgpt import jvm
 from jarvis.smartgpt import gpt
 from jarvis.smartgpt.compiler import Compiler
@@ -31,7 +32,6 @@ Max_Overview_Length = 500
 # BASE_MODEL = gpt.GPT_3_5_TURBO_16K
 BASE_MODEL = gpt.GPT_4
 EMPTY_FIELD_INDICATOR = "EMPTY_FIELD_INDICATOR"
-Encoding = tiktoken.encoding_for_model(BASE_MODEL)
 
 
 def generate_task_outcome_overview(task, result):
@@ -108,6 +108,7 @@ class JarvisExecutor:
 
     def __init__(self, executor_id: Optional[str] = None):
         self.completed_tasks = {}
+        self.context = None
         if executor_id is not None:
             self.executor_id = executor_id
         else:
@@ -115,37 +116,42 @@ class JarvisExecutor:
             timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
             self.executor_id = f"{unique_id}-{timestamp}"
 
+    def workdir(self) -> str:
+        """The directory of the plan, task and kv store files of this executor.
+
+        Every path is resolved against it instead of changing the cwd, which is
+        shared by all the executors of a process.
+        """
+        workdir = os.path.abspath(self.executor_id)
+        os.makedirs(workdir, exist_ok=True)
+        return workdir
+
     @conditional_chan_traceable(run_type="chain")
     def execute_with_plan(
         self,
         goal: str,
         skip_gen: bool = False,
     ):
-        current_workdir = os.getcwd()
-        logging.info(f"Current workdir: {current_workdir}")
-        new_subdir = os.path.join(current_workdir, self.executor_id)
-        os.makedirs(new_subdir, exist_ok=True)
-        os.chdir(new_subdir)
+        workdir = self.workdir()
+        logging.info(f"Executor workdir: {workdir}")
 
         result = ChainInfo(goal=goal, task_infos=[], result=EMPTY_FIELD_INDICATOR)
 
         try:
             # load execution plan
             if skip_gen:
-                task_list = self.load_instructions()
+                task_list = self.load_instructions(workdir)
             else:
-                planner.gen_plan(BASE_MODEL, goal)
+                planner.gen_plan(BASE_MODEL, goal, workdir)
                 # Generate new tasks from plan.yaml: (1.yaml, 2.yaml, ...)
-                tasks = Compiler(BASE_MODEL).compile_plan()
+                tasks = Compiler(BASE_MODEL, workdir).compile_plan()
                 task_list = []
                 for task_idx, task in enumerate(tasks):
                     task_list.append((task_idx + 1, task))
         except Exception as e:
             logging.error(f"Error generating plan for goal({goal}): {e}")
-            # os.chdir(current_workdir)
             logging.info(traceback.format_exc())
             result.error = str(e)
-            os.chdir(current_workdir)
             return result
 
         logging.info(f"Sucess generating plan for goal({goal})")
@@ -155,12 +161,11 @@ class JarvisExecutor:
         for task in task_list:
             task_idx, instrs = task
             try:
-                task_info = self.execute_instructions([task])
+                task_info = self.execute_instructions([task], workdir)
                 last_task_result = task_info.result
             except Exception as e:
                 logging.error(f"Error executing task {task}: {e}")
                 logging.info(traceback.format_exc())
-                os.chdir(current_workdir)
                 task_info = TaskInfo(
                     task_num=task_idx,
                     task=instrs["task"],
@@ -171,11 +176,10 @@ class JarvisExecutor:
                     error=str(e),
                 )
                 result.task_infos.append(task_info)
-                os.chdir(current_workdir)
                 result.error = f"Error on executing task{instrs['task']}:{str(e)}"
                 return result
 
-            if len(Encoding.encode(task_info.result)) > Max_Overview_Length:
+            if not gpt.within_tokens(task_info.result, Max_Overview_Length):
                 task_info.result = generate_task_outcome_overview(
                     instrs["task"], task_info.result
                 )
@@ -185,7 +189,6 @@ class JarvisExecutor:
             self.completed_tasks[task_idx] = task_info
 
         result.result = last_task_result
-        os.chdir(current_workdir)
         return result
 
     def execute(
@@ -196,19 +199,17 @@ class JarvisExecutor:
         dependent_taskIDs: List = [],
         skip_gen: bool = False,
         reference: Optional[str] = None,
+        resume: bool = False,
     ) -> TaskInfo | None:
         # skip_gen and subdir are used for testing purpose
-        current_workdir = os.getcwd()
-        new_subdir = os.path.join(current_workdir, self.executor_id)
-        os.makedirs(new_subdir, exist_ok=True)
-        os.chdir(new_subdir)
+        # with resume, a task whose last run failed continues from its checkpoint
+        workdir = self.workdir()
 
         previous_tasks = []
         for dt_id in dependent_taskIDs:
             previous_task = self.completed_tasks.get(dt_id, None)
             if previous_task is None:
                 logging.error(f"Error: dependent task {dt_id} is not completed")
-                os.chdir(current_workdir)
                 raise Exception(
                     f"Error: depend task {dt_id} is not found under {self.executor_id}"
                 )
@@ -216,40 +217,41 @@ class JarvisExecutor:
                 previous_tasks.append(previous_task)
 
         try:
+            instrs = None
             if skip_gen:
-                instrs = self.load_instructions()
-            else:
+                instrs = self.load_instructions(workdir)
+            elif resume:
+                instrs = self.load_checkpointed_instructions(
+                    self.task_number(previous_tasks, task_num), workdir
+                )
+            if instrs is None:
                 instrs = self.gen_instructions(
-                    task, goal, previous_tasks, task_num, reference
+                    task, goal, previous_tasks, task_num, reference, workdir
                 )
-            result = self.execute_instructions(instrs)
+            result = self.execute_instructions(instrs, workdir, resume)
         except Exception as e:
             logging.error(f"Error executing task {task}: {e}")
-            os.chdir(current_workdir)
             logging.error(traceback.format_exc())
             raise e
 
-        os.chdir(current_workdir)
         if result is not None:
             self.completed_tasks[result.task_num] = result
         return result
 
     def eval_plan(self, goal: str, subdir: str):
-        current_workdir = os.getcwd()
-        new_subdir = os.path.join(current_workdir, subdir)
-        os.chdir(new_subdir)
+        workdir = os.path.abspath(subdir)
 
-        res = planner.eval_plan(goal)
+        res = planner.evaluate_plan(BASE_MODEL, goal, workdir)
         if res is not None and res.lower() == "yes":
             return True
         else:
-            shutil.rmtree(new_subdir)
+            shutil.rmtree(workdir)
             return False
 
-    def load_instructions(self) -> List:
+    def load_instructions(self, workdir: str) -> List:
         instructions = []
-        for file_name in glob.glob("[0-9]*.yaml"):
-            with open(file_name, "r") as f:
+        for file_name in glob.glob("[0-9]*.yaml", root_dir=workdir):
+            with open(os.path.join(workdir, file_name), "r") as f:
                 saved = f.read()
             task_num = int(file_name.split(".")[0])
             instructions.append((task_num, yaml.safe_load(saved)))
@@ -259,6 +261,35 @@ class JarvisExecutor:
 
         return sorted_instructions
 
+    def load_checkpointed_instructions(self, task_num: int, workdir: str):
+        """The saved instructions of task_num, if a failed run of them left a checkpoint."""
+        file_name = os.path.join(workdir, f"{task_num}.yaml")
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name, "r") as f:
+            instrs = yaml.safe_load(f)
+
+        state = checkpoint.Checkpoint(
+            os.path.join(workdir, checkpoint.CHECKPOINT_FILE)
+        ).load()
+        if state is None or state.get("task") != checkpoint.task_key(
+            instrs["instructions"], instrs["task"]
+        ):
+            return None
+        logging.info(f"Resuming the saved instructions of task {task_num}")
+        return [(task_num, instrs)]
+
+    def task_number(
+        self, dependent_tasks: List[TaskInfo], task_num: Optional[int] = None
+    ) -> int:
+        if task_num is not None:
+            return task_num
+        computed_task_num = 1
+        for dt in dependent_tasks:
+            if dt.task_num >= computed_task_num:
+                computed_task_num = dt.task_num + 1
+        return computed_task_num
+
     def gen_instructions(
         self,
         task: str,
@@ -266,10 +297,10 @@ class JarvisExecutor:
         dependent_tasks: List[TaskInfo],
         task_num: Optional[int] = None,
         reference: Optional[str] = None,
+        workdir: str = "",
     ) -> List:
-        compiler = Compiler(BASE_MODEL)
+        compiler = Compiler(BASE_MODEL, workdir)
         previous_outcomes = []
-        computed_task_num = 1
 
         for dt in dependent_tasks:
             previous_outcomes.append(
@@ -279,20 +310,26 @@ class JarvisExecutor:
                     "outcome": dt.metadata.get("instruction_outcome", ""),
                 }
             )
-            if dt.task_num >= computed_task_num:
-                computed_task_num = dt.task_num + 1
 
-        if task_num is None:
-            task_num = computed_task_num
+        task_num = self.task_number(dependent_tasks, task_num)
 
         generated_instrs = compiler.compile_task(
             task_num, task, goal, previous_outcomes, reference=reference
         )
         return [(task_num, generated_instrs)]
 
-    def execute_instructions(self, tasks: List) -> TaskInfo | None:
-        jvm.load_kv_store()
-        interpreter = instruction.JVMInterpreter()
+    def get_context(self, workdir: Optional[str] = None) -> jvm.JVMContext:
+        """The JVM context of this executor, stored in its working directory."""
+        workdir = workdir or os.getcwd()
+        if self.context is None or self.context.workdir != os.path.abspath(workdir):
+            self.context = jvm.JVMContext(os.path.join(workdir, "kv_store.json"))
+        return self.context
+
+    def execute_instructions(
+        self, tasks: List, workdir: Optional[str] = None, resume: bool = False
+    ) -> TaskInfo | None:
+        context = self.get_context(workdir)
+        interpreter = instruction.JVMInterpreter(context)
         last_result = None
 
         for task in tasks:
@@ -300,7 +337,7 @@ class JarvisExecutor:
             interpreter.reset()
             task_num, instrs = task
             logging.info(f"Executing task {task_num}: {instrs}")
-            interpreter.run(instrs["instructions"], instrs["task"])
+            interpreter.run(instrs["instructions"], instrs["task"], resume=resume)
             last_result = TaskInfo(
                 task_num=task_num,
                 task=instrs["task"],
@@ -311,9 +348,10 @@ class JarvisExecutor:
             )
 
         if last_result is not None:
-            result = self.get_task_result(
-                last_result.task_num, last_result.metadata["instruction_outcome"]
-            )
+            with jvm.use_context(context):
+                result = self.get_task_result(
+                    last_result.task_num, last_result.metadata["instruction_outcome"]
+                )
             if result is not None and result != "None":
                 last_result.result = result
 
@@ -417,6 +455,7 @@ class JarvisAgent:
         task_num: Optional[int] = None,
         skip_gen: bool = False,
         enable_skill_library: bool = False,
+        resume: bool = False,
     ):
         _, executor = self._load_executor(executor_id)
         skill_code = None
@@ -431,7 +470,7 @@ class JarvisAgent:
                 break
 
         return executor.execute(
-            goal, task, task_num, dependent_taskIDs, skip_gen, skill_code
+            goal, task, task_num, dependent_taskIDs, skip_gen, skill_code, resume
         )
 
     def execute_with_plan(
@@ -64,6 +64,7 @@ class SkillManager:
         else:
             self.skills = {}
 
+        # its requests go through gpt.SCHEDULER, within the limits of the model
         embedding_func = gpt.OPEN_AI_MODELS_HUB["text-embedding-ada-002"]
         self.vectordb = Chroma(
             collection_name="skill_vectordb",
@@ -147,7 +148,10 @@ class SkillManager:
         sys_prompt = "Please review the task and its execution plan, and give the task a suitable name\n"
         user_prompt = f"Come up with a detail skill name (skill name should be function-name style, eg. 'get_weather'; skill name should detailed to be unqieu) for the task({task}) execution plan:\n{code}\n###\nSKILL_NAME:"
         skill_name = gpt.complete(
-            prompt=user_prompt, model=self.model_name, system_prompt=sys_prompt
+            prompt=user_prompt,
+            model=self.model_name,
+            system_prompt=sys_prompt,
+            priority=gpt.BACKGROUND,
         )
         return (skill_name, None)
 
@@ -48,6 +48,7 @@ class JarvisServicer(jarvis_pb2_grpc.JarvisServicer, JarvisAgent):
         task_info = None
         while retry_num < 3:
             try:
+                # retries continue a failed run from its last checkpoint
                 task_info = self.agent.execute(
                     executor_id,
                     goal,
@@ -56,15 +57,20 @@ class JarvisServicer(jarvis_pb2_grpc.JarvisServicer, JarvisAgent):
                     task_id,
                     skip_gen,
                     enable_skill_library,
+                    resume=retry_num > 0,
                 )
             except Exception as e:
-                return jarvis_pb2.ExecuteResponse(
-                    executor_id=executor_id,
-                    task_id=task_id,
-                    task=task,
-                    result="",
-                    error=str(e),
-                )
+                retry_num += 1
+                if retry_num >= 3:
+                    return jarvis_pb2.ExecuteResponse(
+                        executor_id=executor_id,
+                        task_id=task_id,
+                        task=task,
+                        result="",
+                        error=str(e),
+                    )
+                logging.error(f"Retrying.... cause of error: {e}")
+                continue
 
             if task_info is not None and task_info.result != EMPTY_FIELD_INDICATOR:
                 break
@@ -2,48 +2,65 @@ from dataclasses import dataclass, field
 import subprocess
 import os
 import inspect
+import functools
 import json
+import ast
 import logging
+import re
 import time
+import threading
 import venv
-from typing import Union, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, List, Dict, Optional
 from abc import ABC
 import uuid
 from urllib.parse import urlparse, urlunparse
-import hashlib
-import platform
 import requests
 import pkgutil
 
-from bs4 import BeautifulSoup
 import yaml
 
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.chrome.webdriver import WebDriver as ChromeWebDriver
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-
+from jarvis.smartgpt import cache
+from jarvis.smartgpt import extractor
+from jarvis.smartgpt import fetcher
 from jarvis.smartgpt import gpt
 from jarvis.smartgpt import jvm
 from jarvis.smartgpt import utils
 from jarvis.smartgpt import preprompts
+from jarvis.smartgpt import profiler
 
 
 TEXT_COMPLETION_MODEL = gpt.GPT_3_5_TURBO_16K
 
-_CACHE = {}
+_CACHE: Optional[cache.ActionCache] = None
 _ENABLE_CACHE = True
+# actions may run on several interpreter threads
+_CACHE_LOCK = threading.Lock()
 
 
-def load_cache():
+def load_cache(path=None):
+    """Opens the action cache at path, ACTION_CACHE_PATH by default."""
     global _CACHE
-    if os.path.exists("cache.json"):
-        with open("cache.json", "r") as f:
-            _CACHE = json.load(f)
-    else:
-        _CACHE = {}
+    options = cache.cache_options()
+    if path is not None:
+        options["path"] = path
+    with _CACHE_LOCK:
+        if _CACHE is not None and _CACHE.path == options["path"]:
+            return
+        if _CACHE is not None:
+            _CACHE.close()
+        _CACHE = cache.ActionCache(**options)
+
+
+def _action_cache() -> cache.ActionCache:
+    if _CACHE is None:
+        load_cache()
+    return _CACHE
+
+
+def cache_stats():
+    """Returns the hits, misses, expirations and evictions by action type."""
+    return _CACHE.stats() if _CACHE is not None else {}
 
 
 def enable_cache():
@@ -58,7 +75,9 @@ def disable_cache():
 
 def get_from_cache(key):
     if _ENABLE_CACHE:
-        return _CACHE.get(key, None)
+        value = _action_cache().get(key)
+        profiler.record(profiler.CACHE_MISSES if value is None else profiler.CACHE_HITS)
+        return value
     else:
         return None
 
@@ -67,9 +86,13 @@ def save_to_cache(key, value):
     if not _ENABLE_CACHE:
         return None
 
-    _CACHE[key] = value
-    with open("cache.json", "w") as f:
-        json.dump(_CACHE, f)
+    _action_cache().set(key, value)
+
+
+@functools.lru_cache(maxsize=None)
+def action_params(action_class):
+    """Returns the constructor parameters of an action class, by name."""
+    return inspect.signature(action_class).parameters
 
 
 @dataclass(frozen=True)
@@ -87,7 +110,7 @@ class Action(ABC):
         action_class = ACTION_CLASSES[action_type]
 
         # Get the constructor parameters for the action class
-        constructor_params = inspect.signature(action_class).parameters
+        constructor_params = action_params(action_class)
 
         # Create a dictionary of constructor arguments from the data
         constructor_args = {}
@@ -135,84 +158,34 @@ class FetchWebContentAction:
 
     @staticmethod
     def get_html(url: str) -> str:
-        # Setting up Chrome Options
-        chrome_options = ChromeOptions()
-        chrome_options.headless = True
-
-        chrome_options.add_argument("--no-sandbox")
-        if platform.system().lower() in ["linux", "linux2"]:
-            chrome_options.add_argument("--disable-dev-shm-usage")
-            chrome_options.add_argument("--remote-debugging-port=9222")
-
-        def initialize_webdriver(chrome_options, use_manager=False):
-            try:
-                if use_manager:
-                    # Installing and setting up Chrome WebDriver with the defined options
-                    driver_path = ChromeDriverManager().install()
-                    return webdriver.Chrome(
-                        executable_path=driver_path, options=chrome_options
-                    )
-                else:
-                    return webdriver.Chrome(options=chrome_options)
-            except Exception as e:
-                logging.error(f"Failed to initialize webdriver: {e}")
-                return None
-
-        # try user installed chrome driver first
-        browser = initialize_webdriver(chrome_options)
-        if browser is None:
-            browser = initialize_webdriver(chrome_options, use_manager=True)
-
-        if browser is None:
-            raise ValueError("Failed to initialize webdriver")
-
+        # pages are fetched over plain HTTP, or by the browser pool if they need JavaScript
         try:
-            browser.get(url)
-            # Extract HTML content from the body of the web page
-            body_element = browser.find_element(By.TAG_NAME, "body")
-            page_html = body_element.get_attribute("innerHTML")
+            return fetcher.default_fetcher().get_html(url)
         except Exception as e:
             logging.error(
                 f"An error occurred while fetching the HTML content from the URL: {e}"
             )
             raise e
-        finally:
-            browser.quit()
-
-        return page_html
 
     @staticmethod
     def extract_text(html: str) -> str:
-        soup = BeautifulSoup(html, "html.parser")
-        for script in soup(["script", "style"]):
-            script.extract()
+        # external links are kept in markdown format, e.g. [text](https://...)
+        return extractor.extract_text(html)
 
-        # modify a tags to include href in markdown format
-        for a in soup.find_all("a"):
-            url = a.get("href", "")
-
-            # Only modify the link if it's an external link (i.e., starts with 'http' or 'https')
-            if url and (url.startswith("http://") or url.startswith("https://")):
-                a.string = f"[{a.get_text()}]({url})"
-
-        text = soup.get_text()
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = "\n".join(chunk for chunk in chunks if chunk)
-        return text
+    @classmethod
+    def fetch_text(cls, url: str) -> str:
+        return cls.extract_text(cls.get_html(cls.ensure_url_scheme(url)))
 
     def run(self):
         # Check if the url is already in the cache
-        cached_key = self.url + self.save_to
+        cached_key = cache.make_key(self.key(), self.url, self.save_to)
         cached_result = get_from_cache(cached_key)
         if cached_result is not None:
             logging.debug("FetchWebContentAction RESULT(cached).")
             return cached_result
 
         try:
-            url = self.ensure_url_scheme(self.url)
-            html = self.get_html(url)
-            text = self.extract_text(html)
+            text = self.fetch_text(self.url)
         except Exception as err:
             logging.error(
                 f"FetchWebContentAction RESULT: An error occurred: {str(err)}"
@@ -229,6 +202,115 @@ class FetchWebContentAction:
             return result_str
 
 
+def fetch_many(
+    urls: List[str],
+    fetch=None,
+    max_workers: Optional[int] = None,
+    limiter: Optional[fetcher.HostLimiter] = None,
+) -> List[Union[str, Exception]]:
+    """Fetches the text of urls concurrently, in the order of urls.
+
+    At most `limiter.per_host` requests go to one host at a time, spaced out by
+    `limiter.delay` seconds. The result of a url is its text, or the exception
+    fetching it raised.
+    """
+    fetch = fetch or FetchWebContentAction.fetch_text
+    if max_workers is None:
+        max_workers = int(os.getenv("FETCH_MAX_WORKERS", "8"))
+    limiter = limiter or fetcher.HostLimiter(**fetcher.limiter_options())
+
+    def fetch_one(url):
+        try:
+            with limiter.slot(url):
+                return fetch(url)
+        except Exception as err:
+            logging.error(f"Failed to fetch {url}: {err}")
+            return err
+
+    if not urls:
+        return []
+    with ThreadPoolExecutor(
+        max_workers=max(min(max_workers, len(urls)), 1), thread_name_prefix="fetch"
+    ) as pool:
+        return list(pool.map(jvm.bind_current(profiler.bind_current(fetch_one)), urls))
+
+
+@dataclass(frozen=True)
+class FetchWebContentsAction:
+    action_id: int
+    urls: Union[str, List[str]]
+    # the key template of the fetched contents, "<idx>" is replaced by the index of the url
+    save_to: str = ""
+    # save "" for the urls that failed instead of failing the instruction
+    best_effort: bool = False
+
+    def key(self):
+        return "FetchWebContents"
+
+    def id(self) -> int:
+        return self.action_id
+
+    def short_string(self):
+        return f"action_id: {self.id()}, Fetch URLs: `{self.urls}`."
+
+    @staticmethod
+    def parse_urls(urls) -> List[str]:
+        if isinstance(urls, str):
+            text = urls.strip()
+            if text.startswith("["):
+                urls = ast.literal_eval(text)
+            else:
+                urls = re.split(r"[\s,]+", text)
+        if not isinstance(urls, (list, tuple)):
+            raise ValueError(f"urls must be a list of URLs, got {urls!r}")
+        return [str(url).strip() for url in urls if url and str(url).strip()]
+
+    @staticmethod
+    def key_for(save_to: str, index: int) -> str:
+        if "<idx>" in save_to:
+            return save_to.replace("<idx>", str(index))
+        # 'page.seq3.str' -> 'page_0.seq3.str'
+        name, dot, rest = save_to.partition(".")
+        return f"{name}_{index}{dot}{rest}"
+
+    def run(self):
+        try:
+            urls = self.parse_urls(self.urls)
+        except (ValueError, SyntaxError) as err:
+            raise ValueError(f"FetchWebContentsAction RESULT: Invalid urls: {err}")
+
+        keys = [self.key_for(self.save_to, i) for i in range(len(urls))]
+        # the text of a url is cached independently of the key it is saved to
+        texts = [get_from_cache(cache.make_key(self.key(), url)) for url in urls]
+        missing = [i for i, text in enumerate(texts) if text is None]
+        fetched = fetch_many([urls[i] for i in missing])
+
+        failed = []
+        for i, result in zip(missing, fetched):
+            if isinstance(result, Exception):
+                failed.append({"url": urls[i], "error": str(result)})
+                texts[i] = ""
+                continue
+            texts[i] = result
+            save_to_cache(cache.make_key(self.key(), urls[i]), result)
+
+        best_effort = utils.str_to_bool(self.best_effort)
+        if failed and (not best_effort or len(failed) == len(urls)):
+            errors = "; ".join(f"{failure['url']}: {failure['error']}" for failure in failed)
+            raise ValueError(
+                f"FetchWebContentsAction RESULT: An error occurred: failed to fetch "
+                f"{len(failed)} of {len(urls)} URLs: {errors}"
+            )
+
+        logging.debug(f"\nFetchWebContentsAction RESULT: {len(urls) - len(failed)} pages")
+        result = {"kvs": [{"key": key, "value": text} for key, text in zip(keys, texts)]}
+        if failed:
+            for failure in failed:
+                logging.warning(f"Saved no content for {failure['url']}: {failure['error']}")
+            result["failed"] = failed
+        return json.dumps(result)
+
+
 @dataclass(frozen=True)
 class WebSearchAction:
     action_id: int
@@ -246,7 +328,7 @@ class WebSearchAction:
 
     def run(self):
         # Check if the query is already in the cache
-        cached_key = self.query + self.save_to
+        cached_key = cache.make_key(self.key(), self.query, self.save_to)
         cached_result = get_from_cache(cached_key)
         if cached_result is not None:
             logging.info(f"\nWebSearchAction RESULT(cached)\n")
@@ -316,8 +398,8 @@ class RunPythonAction(Action):
         return f"action_id: {self.id()}, Run Python code."
 
     def run(self) -> str:
-        # Use the current directory as the working environment
-        work_dir = os.getcwd()
+        # Use the directory of the executor's JVM context as the working environment
+        work_dir = jvm.current_context().workdir
 
         # Generate a random file name for each execution
         file_name = f"run_{uuid.uuid4()}.py"
@@ -405,9 +487,13 @@ class RunPythonAction(Action):
 
     def _run_script(self, venv_path, work_dir, file_name):
         script_full_path = os.path.join(work_dir, file_name)
+        # point the script at the kv store of the current JVM context
+        env = dict(os.environ, **jvm.current_context().env())
         with subprocess.Popen(
             [os.path.join(venv_path, "python"), script_full_path]
             + self.cmd_args.split(),
+            cwd=work_dir,
+            env=env,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             universal_newlines=True,
@@ -440,6 +526,18 @@ class RunPythonAction(Action):
         return output
 
 
+def text_completion_options() -> dict:
+    return {
+        # content beyond the context of the model is split into chunks instead of being truncated
+        "map_reduce": os.getenv("TEXT_COMPLETION_MAP_REDUCE", "true").lower() == "true",
+        "chunk_tokens": int(os.getenv("TEXT_COMPLETION_CHUNK_TOKENS", "8000")),
+        "chunk_overlap": int(os.getenv("TEXT_COMPLETION_CHUNK_OVERLAP", "200")),
+        # 0 reads every chunk, otherwise longer content fails the completion
+        "max_chunks": int(os.getenv("TEXT_COMPLETION_MAX_CHUNKS", "0")),
+        "workers": int(os.getenv("TEXT_COMPLETION_MAP_WORKERS", "4")),
+    }
+
+
 @dataclass(frozen=True)
 class TextCompletionAction(Action):
     action_id: int
@@ -457,19 +555,15 @@ class TextCompletionAction(Action):
     def short_string(self) -> str:
         return f'action_id: {self.id()}, text completion for Request: "{self.request}".'
 
-    def generate_messages(self) -> List[Dict[str, str]]:
-        # Adjust content to fit within model's max tokens
-        content = self.content
-        max_token_count = (
-            gpt.get_max_tokens(gpt.GPT_3_5_TURBO_16K) - 4096
-        )  # leaving some space for the system and user roles and responses
-        content_token_count = gpt.count_tokens(content)
-
-        if content_token_count > max_token_count:
-            # If content is too long, truncate it to fit within model's max tokens.
-            content = gpt.truncate_to_tokens(content, max_token_count)
-
-        user_prompt = preprompts.get("text_completion_user").format(
+    @staticmethod
+    def max_content_tokens() -> int:
+        # leaving some space for the system and user roles and responses
+        return gpt.get_max_tokens(gpt.GPT_3_5_TURBO_16K) - 4096
+
+    def build_messages(
+        self, content: str, prompt_name: str = "text_completion_user"
+    ) -> List[Dict[str, str]]:
+        user_prompt = preprompts.get(prompt_name).format(
             request=self.request,
             output_format=utils.remove_quoted_token(self.output_format, "<to_fill>"),
             content=content,
@@ -488,6 +582,11 @@ class TextCompletionAction(Action):
 
         return messages
 
+    def generate_messages(self) -> List[Dict[str, str]]:
+        # If content is too long, truncate it to fit within model's max tokens.
+        content = gpt.truncate_to_tokens(self.content, self.max_content_tokens())
+        return self.build_messages(content)
+
     def adjust_token_and_model(self, messages: List[Dict[str, str]]) -> str:
         request_token_count = gpt.count_tokens(messages)
         max_token_count = gpt.get_max_tokens(self.model_name)
@@ -500,10 +599,95 @@ class TextCompletionAction(Action):
 
         return model_name
 
+    def cache_key(self) -> str:
+        request, output_format = self.request, self.output_format
+        if os.getenv("TEXT_COMPLETION_CACHE_NORMALIZE", "false").lower() == "true":
+            request = cache.normalize_prompt(request)
+            output_format = cache.normalize_prompt(output_format)
+
+        # the prompt templates are part of the key, so editing them invalidates old answers
+        prompts = "".join(
+            preprompts.get(name)
+            for name in (
+                "text_completion_sys",
+                "text_completion_user",
+                "text_completion_reduce_user",
+            )
+        )
+        return cache.make_key(
+            self.key(),
+            self.model_name,
+            request,
+            cache.digest(self.content),
+            output_format,
+            cache.digest(prompts),
+        )
+
+    def complete(self, messages: List[Dict[str, str]]) -> str:
+        result = gpt.send_messages(messages, self.adjust_token_and_model(messages))
+        if result is None:
+            raise ValueError("Generating text completion appears to have failed.")
+        return utils.strip_json(result)
+
+    def map_reduce(
+        self, chunk_tokens: int, overlap: int, max_chunks: int, workers: int
+    ) -> str:
+        """Completes the request over each chunk of the content concurrently,
+        then merges the partial results, in rounds of completions over as many
+        of them as fit in the context, until one is left."""
+        chunks = gpt.split_to_tokens(self.content, chunk_tokens, overlap)
+        if max_chunks and len(chunks) > max_chunks:
+            raise ValueError(
+                f"the content is split into {len(chunks)} chunks, more than TEXT_COMPLETION_MAX_CHUNKS={max_chunks}"
+            )
+        logging.info(
+            f"TextCompletionAction: map-reduce over {len(chunks)} chunks for Request: {self.request}"
+        )
+
+        def map_chunk(chunk):
+            return self.complete(self.build_messages(chunk))
+
+        def reduce_batch(batch):
+            if len(batch) == 1:
+                return batch[0]
+            content = "\n\n".join(
+                f"Partial result {i} of {len(batch)}:\n```json\n{partial}\n```"
+                for i, partial in enumerate(batch, 1)
+            )
+            return self.complete(self.build_messages(content, "text_completion_reduce_user"))
+
+        with ThreadPoolExecutor(
+            max_workers=max(min(workers, len(chunks)), 1), thread_name_prefix="map"
+        ) as pool:
+            partials = list(pool.map(profiler.bind_current(map_chunk), chunks))
+            while len(set(partials)) > 1:
+                batches = self.reduce_batches(partials)
+                if len(batches) == len(partials):
+                    raise ValueError("the partial results are too long to be merged")
+                logging.info(
+                    f"TextCompletionAction: reducing {len(partials)} partial results in {len(batches)} completions"
+                )
+                partials = list(pool.map(profiler.bind_current(reduce_batch), batches))
+
+        return partials[0]
+
+    def reduce_batches(self, partials: List[str]) -> List[List[str]]:
+        """Groups the partial results into the contents of the reduce completions."""
+        limit = self.max_content_tokens()
+        batches: List[List[str]] = []
+        batch_tokens = 0
+        for partial in partials:
+            # with room for the "Partial result i of n" heading around it
+            tokens = gpt.count_tokens(partial) + 16
+            if not batches or batch_tokens + tokens > limit:
+                batches.append([])
+                batch_tokens = 0
+            batches[-1].append(partial)
+            batch_tokens += tokens
+        return batches
+
     def run(self) -> str:
-        hash_key = self.request + str(jvm.get("idx"))
-        hash_str = hashlib.md5(hash_key.encode()).hexdigest()
-        cached_key = f"{hash_str}"
+        cached_key = self.cache_key()
         cached_result = get_from_cache(cached_key)
 
         if cached_result is not None:
@@ -512,14 +696,20 @@ class TextCompletionAction(Action):
             )
             return cached_result
 
-        messages = self.generate_messages()
-        model_name = self.adjust_token_and_model(messages)
-
         try:
-            result = gpt.send_messages(messages, model_name)
-            if result is None:
-                raise ValueError("Generating text completion appears to have failed.")
-            result = utils.strip_json(result)
+            options = text_completion_options()
+            if (
+                options["map_reduce"]
+                and not gpt.within_tokens(self.content, self.max_content_tokens())
+            ):
+                result = self.map_reduce(
+                    options["chunk_tokens"],
+                    options["chunk_overlap"],
+                    options["max_chunks"],
+                    options["workers"],
+                )
+            else:
+                result = self.complete(self.generate_messages())
 
             save_to_cache(cached_key, result)
             return result
@@ -554,6 +744,7 @@ def _populate_action_classes(action_classes):
 ACTION_CLASSES = _populate_action_classes(
     [
         FetchWebContentAction,
+        FetchWebContentsAction,
         RunPythonAction,
         WebSearchAction,
         TextCompletionAction,
@@ -0,0 +1,204 @@
+"""A pool of warm headless Chrome sessions for fetching web pages.
+
+Starting Chrome takes seconds, far longer than loading most pages. The pool
+keeps up to `size` WebDriver sessions alive between fetches and hands each
+one to a single fetch at a time, so concurrent fetches each get their own
+browser. A session is health checked before it is handed out, so a crashed
+Chrome is replaced, and recycled after `max_pages` pages, so a leaking one
+does not linger. Every session listens on its own remote debugging port.
+"""
+import os
+import atexit
+import socket
+import logging
+import platform
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+# selenium and webdriver_manager are imported when the first browser starts,
+# most runs fetch every page over HTTP
+
+
+def pool_options() -> dict:
+    return {
+        "size": int(os.getenv("BROWSER_POOL_SIZE", "2")),
+        "max_pages": int(os.getenv("BROWSER_MAX_PAGES", "50")),
+        "page_load_timeout": float(os.getenv("BROWSER_PAGE_LOAD_TIMEOUT", "60")),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@functools.lru_cache(maxsize=1)
+def _managed_driver_path() -> str:
+    from webdriver_manager.chrome import ChromeDriverManager
+
+    # downloading the driver once per process is enough
+    return ChromeDriverManager().install()
+
+
+def create_driver(debugging_port: int):
+    """Starts a headless Chrome listening on debugging_port."""
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options as ChromeOptions
+
+    chrome_options = ChromeOptions()
+    chrome_options.headless = True
+
+    chrome_options.add_argument("--no-sandbox")
+    if platform.system().lower() in ["linux", "linux2"]:
+        chrome_options.add_argument("--disable-dev-shm-usage")
+        chrome_options.add_argument(f"--remote-debugging-port={debugging_port}")
+
+    # try user installed chrome driver first
+    try:
+        return webdriver.Chrome(options=chrome_options)
+    except Exception as e:
+        logging.error(f"Failed to initialize webdriver: {e}")
+
+    try:
+        # Installing and setting up Chrome WebDriver with the defined options
+        return webdriver.Chrome(
+            executable_path=_managed_driver_path(), options=chrome_options
+        )
+    except Exception as e:
+        logging.error(f"Failed to initialize webdriver: {e}")
+        raise ValueError("Failed to initialize webdriver") from e
+
+
+class Session:
+    def __init__(self, driver, port: int):
+        self.driver = driver
+        self.port = port
+        self.pages = 0
+
+    def healthy(self) -> bool:
+        try:
+            self.driver.execute_script("return 1")
+            return True
+        except Exception as e:
+            logging.warning(f"Browser session on port {self.port} is unhealthy: {e}")
+            return False
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            logging.warning(f"Failed to quit the browser session on port {self.port}: {e}")
+
+
+class BrowserPool:
+    def __init__(
+        self,
+        size: int = 2,
+        max_pages: int = 50,
+        page_load_timeout: Optional[float] = None,
+        driver_factory: Callable[[int], object] = create_driver,
+    ):
+        self.size = max(size, 1)
+        self.max_pages = max_pages
+        self.page_load_timeout = page_load_timeout
+        self.driver_factory = driver_factory
+        self.idle: List[Session] = []
+        # sessions created and not yet quit, idle or in use
+        self.open = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def _start(self) -> Session:
+        port = _free_port()
+        driver = self.driver_factory(port)
+        if self.page_load_timeout:
+            driver.set_page_load_timeout(self.page_load_timeout)
+        logging.info(f"Started a browser session on port {port}")
+        return Session(driver, port)
+
+    def acquire(self) -> Session:
+        """Returns a healthy session, waiting for one if all of them are in use."""
+        while True:
+            with self.condition:
+                while not self.idle and self.open >= self.size and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    raise RuntimeError("The browser pool is closed")
+                # the most recently used session is the warmest
+                session = self.idle.pop() if self.idle else None
+                if session is None:
+                    self.open += 1
+
+            if session is None:
+                try:
+                    return self._start()
+                except Exception:
+                    self._discard(None)
+                    raise
+            if session.healthy():
+                return session
+            self._discard(session)
+
+    def release(self, session: Session):
+        session.pages += 1
+        if session.pages >= self.max_pages:
+            self._discard(session)
+            return
+        with self.condition:
+            if self.closed:
+                session.quit()
+                self.open -= 1
+                return
+            self.idle.append(session)
+            self.condition.notify()
+
+    def _discard(self, session: Optional[Session]):
+        if session is not None:
+            session.quit()
+        with self.condition:
+            self.open -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def session(self):
+        session = self.acquire()
+        try:
+            yield session.driver
+        finally:
+            # a session broken by the fetch fails the health check of the next one
+            self.release(session)
+
+    def get_html(self, url: str) -> str:
+        """Loads url and returns the HTML of its body."""
+        from selenium.webdriver.common.by import By
+
+        with self.session() as driver:
+            driver.get(url)
+            # Extract HTML content from the body of the web page
+            body_element = driver.find_element(By.TAG_NAME, "body")
+            return body_element.get_attribute("innerHTML")
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+            self.condition.notify_all()
+        for session in idle:
+            session.quit()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool() -> BrowserPool:
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = BrowserPool(**pool_options())
+            atexit.register(_default_pool.close)
+        return _default_pool
@@ -0,0 +1,240 @@
+"""Persistent cache of action results.
+
+Results are kept in a SQLite database in WAL mode, so they survive restarts
+and one insert writes one row instead of the whole cache. Keys are hashes of
+the full inputs of an action (see `make_key`). Every action type has its own
+time to live, entries older than that are misses. The cache is bounded by a
+number of entries and a total size of values; the least recently used
+entries are evicted first. Hits, misses, expirations and evictions are
+counted by action type.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_TTLS = {
+    "WebSearch": 24 * 3600,
+    "FetchWebContent": 6 * 3600,
+    "FetchWebContents": 6 * 3600,
+}
+
+# evicting is done in batches, a tenth of the bound at a time
+_EVICTION_SLACK = 0.1
+
+
+def make_key(kind: str, *inputs) -> str:
+    """Returns the cache key of an action of type kind with the given inputs."""
+    data = json.dumps(inputs, sort_keys=True, default=str, ensure_ascii=False)
+    return f"{kind}:{hashlib.sha256(data.encode('utf-8')).hexdigest()}"
+
+
+def digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_prompt(text: str) -> str:
+    """Folds the case and whitespace of a prompt, so that trivially different
+    prompts share a cache entry."""
+    return " ".join(text.split()).casefold()
+
+
+def parse_ttls(text: Optional[str]) -> Dict[str, float]:
+    """Parses "WebSearch=3600,TextCompletion=0" into TTLs by action type."""
+    ttls = {}
+    for item in (text or "").split(","):
+        if not item.strip():
+            continue
+        kind, _, seconds = item.partition("=")
+        ttls[kind.strip()] = float(seconds)
+    return ttls
+
+
+def default_path() -> str:
+    # results are keyed by their full inputs, so one cache serves every workdir
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "jarvis", "action_cache.db")
+
+
+def cache_options() -> dict:
+    ttls = dict(DEFAULT_TTLS)
+    ttls.update(parse_ttls(os.getenv("ACTION_CACHE_TTLS")))
+    return {
+        "path": os.getenv("ACTION_CACHE_PATH") or default_path(),
+        "max_entries": int(os.getenv("ACTION_CACHE_MAX_ENTRIES", "10000")),
+        "max_bytes": int(os.getenv("ACTION_CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+        "default_ttl": float(os.getenv("ACTION_CACHE_TTL", str(DEFAULT_TTL))),
+        "ttls": ttls,
+    }
+
+
+class ActionCache:
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 10000,
+        max_bytes: int = 512 * 1024 * 1024,
+        default_ttl: float = DEFAULT_TTL,
+        ttls: Optional[Dict[str, float]] = None,
+        timeout: float = 30.0,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # a TTL of 0 or less never expires
+        self.default_ttl = default_ttl
+        self.ttls = ttls if ttls is not None else dict(DEFAULT_TTLS)
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # values are large, so they come last and the table keeps its rowid:
+        # scanning sizes and access times does not read the values
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL, value TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+        # the number and size of the entries, kept up to date by every write so
+        # that checking the bounds does not scan the table
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS totals ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), "
+            "count INTEGER NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "INSERT OR IGNORE INTO totals (id, count, size) "
+            "SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        )
+
+    def ttl(self, kind: str) -> float:
+        return self.ttls.get(kind, self.default_ttl)
+
+    def get(self, key: str, kind: Optional[str] = None) -> Optional[str]:
+        kind = kind or key.partition(":")[0]
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._count(kind, "misses")
+                return None
+
+            value, created = row
+            ttl = self.ttl(kind)
+            if ttl > 0 and now - created > ttl:
+                with self._transaction():
+                    self._delete([key])
+                self._count(kind, "expired")
+                self._count(kind, "misses")
+                return None
+
+            self._conn.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._count(kind, "hits")
+            return value
+
+    def set(self, key: str, value: str, kind: Optional[str] = None):
+        kind = kind or key.partition(":")[0]
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock, self._transaction():
+            old = self._conn.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, kind, size, created, accessed, value) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, size, now, now, value),
+            )
+            self._conn.execute(
+                "UPDATE totals SET count = count + ?, size = size + ? WHERE id = 0",
+                (0 if old else 1, size - (old[0] if old else 0)),
+            )
+            self._count(kind, "writes")
+            self._evict()
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _totals(self):
+        return self._conn.execute("SELECT count, size FROM totals WHERE id = 0").fetchone()
+
+    def _delete(self, keys: List[str]) -> List[tuple]:
+        """Deletes the entries of keys, returns the (kind, size) of those deleted."""
+        deleted = []
+        for key in keys:
+            row = self._conn.execute(
+                "SELECT kind, size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                deleted.append(row)
+        if deleted:
+            self._conn.execute(
+                "UPDATE totals SET count = count - ?, size = size - ? WHERE id = 0",
+                (len(deleted), sum(size for _, size in deleted)),
+            )
+        return deleted
+
+    def _evict(self):
+        count, total = self._totals()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        # evict down to below the bounds, so that the next inserts do not evict again
+        keep_entries = int(self.max_entries * (1 - _EVICTION_SLACK))
+        keep_bytes = int(self.max_bytes * (1 - _EVICTION_SLACK))
+        evicted = []
+        rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed")
+        for key, size in rows:
+            if count <= keep_entries and total <= keep_bytes:
+                break
+            evicted.append(key)
+            count -= 1
+            total -= size
+        rows.close()
+        for kind, _ in self._delete(evicted):
+            self._count(kind, "evictions")
+        logging.info(f"Evicted {len(evicted)} entries from the action cache {self.path}")
+
+    def _count(self, kind: str, event: str):
+        counts = self._stats.setdefault(kind, {})
+        counts[event] = counts.get(event, 0) + 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {kind: dict(counts) for kind, counts in self._stats.items()}
+
+    def clear(self):
+        with self._lock, self._transaction():
+            self._conn.execute("DELETE FROM entries")
+            self._conn.execute("UPDATE totals SET count = 0, size = 0 WHERE id = 0")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,55 @@
+"""Checkpoints of a task execution, to resume it after a failure.
+
+A checkpoint records which task was running, the position of the next
+instruction to run and the generation of the kv store at that point. The
+position is a path with one frame per nested instruction list:
+
+    [{"pc": 2, "iteration": 5}, {"pc": 1}]
+
+means instruction 1 of iteration 5 of the Loop at pc 2. Frames of If
+instructions remember the branch taken ({"pc": 4, "branch": "then"}), frames
+of a batch of concurrent instructions the members already done
+({"pc": 0, "done": [0, 2]}).
+"""
+import os
+import json
+import hashlib
+import logging
+from typing import Optional
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def task_key(instructions, task) -> str:
+    data = json.dumps(
+        {"task": task, "instructions": instructions}, sort_keys=True, default=str
+    )
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logging.warning(f"Ignoring unreadable checkpoint {self.path}: {err}")
+            return None
+
+    def save(self, state: dict) -> None:
+        # write to a temporary file first so that a crash never leaves a torn checkpoint
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
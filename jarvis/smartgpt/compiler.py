@@ -8,8 +8,13 @@ from jarvis.smartgpt.translator import Translator
 
 
 class Compiler:
-    def __init__(self, translator_model: str):
+    def __init__(self, translator_model: str, workdir: str = ""):
         self.translator = Translator(translator_model)
+        # the directory of plan.yaml and the task files, the cwd by default
+        self.workdir = workdir
+
+    def path(self, file_name: str) -> str:
+        return os.path.join(self.workdir, file_name)
 
     def load_yaml(self, file_name: str) -> Dict:
         try:
@@ -45,7 +50,7 @@ class Compiler:
         return task_outcome["overall_outcome"] != origin["overall_outcome"]
 
     def compile_plan(self) -> List[Dict]:
-        plan = self.load_yaml("plan.yaml")
+        plan = self.load_yaml(self.path("plan.yaml"))
         hints = plan.get("hints_from_user", [])
         goal = plan.get("goal", "")
         task_list = plan.get("task_list", [])
@@ -64,7 +69,7 @@ class Compiler:
             )
             instructions_yaml_str = self.translator.translate_to_instructions(task_info)
 
-            self.write_yaml(f"{num}.yaml", instructions_yaml_str)
+            self.write_yaml(self.path(f"{num}.yaml"), instructions_yaml_str)
 
             task_instrs = yaml.safe_load(instructions_yaml_str)
             result.append(task_instrs)
@@ -78,7 +83,7 @@ class Compiler:
         return result
 
     def compile_task_in_plan(self, specified_task_num: int) -> List[Dict]:
-        plan = self.load_yaml("plan.yaml")
+        plan = self.load_yaml(self.path("plan.yaml"))
         hints = plan.get("hints_from_user", [])
         goal = plan.get("goal", "")
         task_list = plan.get("task_list", [])
@@ -92,7 +97,7 @@ class Compiler:
             num = task["task_num"]
             deps = task_dependency.get(str(num), [])
             previous_outcomes = [task_outcomes[i] for i in deps]
-            file_name = f"{num}.yaml"
+            file_name = self.path(f"{num}.yaml")
 
             origin = self.load_yaml(file_name) if os.path.exists(file_name) else None
 
@@ -147,6 +152,6 @@ class Compiler:
         if reference:
             task_info["reference_example"] = reference
         instructions_yaml_str = self.translator.translate_to_instructions(task_info)
-        self.write_yaml(f"{task_num}.yaml", instructions_yaml_str)
+        self.write_yaml(self.path(f"{task_num}.yaml"), instructions_yaml_str)
         result = yaml.safe_load(instructions_yaml_str)
         return result
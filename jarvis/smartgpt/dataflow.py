@@ -0,0 +1,410 @@
+"""Dependency analysis and concurrent scheduling of JVM instructions.
+
+Every basic instruction declares the keys it reads (jvm.get(...) and
+jvm.list_*_with_key_prefix(...) inside its arguments) and the keys it writes
+(save_to, or the keys of output_format for TextCompletion). Keys built at
+runtime are approximated by their literal prefix. Two instructions conflict
+when one writes a key the other reads or writes; conflicting instructions keep
+their program order, the others may run concurrently.
+"""
+import ast
+import json
+import logging
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, FrozenSet, Iterable, List, Optional, Sequence
+
+from jarvis.smartgpt import jvm
+
+# instructions without side effects outside of the keys they declare
+CONCURRENT_ACTIONS = {"WebSearch", "FetchWebContent", "FetchWebContents", "TextCompletion"}
+
+READ_ARGS = {
+    "WebSearch": ("query", "save_to"),
+    "FetchWebContent": ("url", "save_to"),
+    "FetchWebContents": ("urls", "save_to"),
+    "TextCompletion": ("request", "content", "output_format"),
+}
+
+_READ_CALL = re.compile(
+    r"jvm\.(get|list_keys_with_prefix|list_values_with_key_prefix)\("
+)
+
+
+@dataclass(frozen=True)
+class KeyPattern:
+    key: str
+    prefix: bool = False
+
+    def overlaps(self, other: "KeyPattern") -> bool:
+        if self.prefix and other.prefix:
+            return self.key.startswith(other.key) or other.key.startswith(self.key)
+        if self.prefix:
+            return other.key.startswith(self.key)
+        if other.prefix:
+            return self.key.startswith(other.key)
+        return self.key == other.key
+
+
+ANY_KEY = KeyPattern("", prefix=True)
+
+
+@dataclass(frozen=True)
+class Effects:
+    reads: FrozenSet[KeyPattern]
+    writes: FrozenSet[KeyPattern]
+    # barriers are ordered against every other instruction
+    barrier: bool = False
+
+    def conflicts_with(self, other: "Effects") -> bool:
+        if self.barrier or other.barrier:
+            return True
+        return (
+            _overlap(self.writes, other.reads)
+            or _overlap(self.reads, other.writes)
+            or _overlap(self.writes, other.writes)
+        )
+
+
+BARRIER = Effects(frozenset(), frozenset(), barrier=True)
+
+
+def _overlap(patterns, others) -> bool:
+    return any(pattern.overlaps(other) for pattern in patterns for other in others)
+
+
+def analyze(instruction: dict) -> Effects:
+    action_type = instruction.get("type")
+    if action_type not in CONCURRENT_ACTIONS:
+        return BARRIER
+
+    args = instruction.get("args") or {}
+    reads = set()
+    for name in READ_ARGS[action_type]:
+        value = args.get(name)
+        if value is not None and not isinstance(value, str):
+            value = json.dumps(value)
+        reads |= read_keys(value)
+
+    writes = set()
+    if action_type == "TextCompletion":
+        for key in _output_keys(args.get("output_format")):
+            writes.add(template_pattern(key))
+    elif action_type == "FetchWebContents":
+        # one key per url, "<idx>" or a suffix of the name is replaced by its index
+        pattern = template_pattern(args.get("save_to"))
+        writes.add(KeyPattern(pattern.key.split(".")[0], prefix=True))
+    else:
+        writes.add(template_pattern(args.get("save_to")))
+
+    return Effects(frozenset(reads), frozenset(writes))
+
+
+def read_keys(text: Optional[str]) -> FrozenSet[KeyPattern]:
+    """Returns the keys read by the jvm calls found in text."""
+    if not text:
+        return frozenset()
+
+    keys = set()
+    for match in _READ_CALL.finditer(text):
+        end = _closing_parenthesis(text, match.end())
+        if end is None:
+            keys.add(ANY_KEY)
+            continue
+        prefix = match.group(1) != "get"
+        keys.add(_call_pattern(text[match.start() : end + 1], prefix))
+    return frozenset(keys)
+
+
+def template_pattern(template) -> KeyPattern:
+    """Returns the keys a save_to or output_format key template may expand to."""
+    if not isinstance(template, str) or not template.strip():
+        return ANY_KEY
+
+    template = template.strip()
+    if template.startswith(jvm.LAZY_EVAL_PREFIX):
+        end = _closing_parenthesis(template, len(jvm.LAZY_EVAL_PREFIX))
+        if end is None:
+            return ANY_KEY
+        head = _leading_literal(template[len(jvm.LAZY_EVAL_PREFIX) : end])
+        return KeyPattern(_static_head(head), prefix=True)
+
+    head = _static_head(template)
+    if head == template:
+        return KeyPattern(template)
+    return KeyPattern(head, prefix=True)
+
+
+def _static_head(text: str) -> str:
+    # "<idx>" placeholders and evaluations make the rest of a key dynamic
+    for marker in (jvm.LAZY_EVAL_PREFIX, "<"):
+        position = text.find(marker)
+        if position >= 0:
+            text = text[:position]
+    return text
+
+
+def _output_keys(output_format) -> List:
+    if isinstance(output_format, str):
+        try:
+            output_format = json.loads(output_format)
+        except json.JSONDecodeError:
+            return [None]
+    if not isinstance(output_format, dict) or not isinstance(
+        output_format.get("kvs"), list
+    ):
+        return [None]
+    return [kv.get("key") if isinstance(kv, dict) else None for kv in output_format["kvs"]]
+
+
+def _call_pattern(call: str, prefix: bool) -> KeyPattern:
+    try:
+        node = ast.parse(call, mode="eval").body
+    except SyntaxError:
+        return ANY_KEY
+    if not isinstance(node, ast.Call) or not node.args:
+        return ANY_KEY
+
+    key = node.args[0]
+    if isinstance(key, ast.Constant) and isinstance(key.value, str):
+        return KeyPattern(key.value, prefix)
+    return KeyPattern(_leading_literal_node(key), prefix=True)
+
+
+def _leading_literal(expression: str) -> str:
+    try:
+        node = ast.parse(expression.strip(), mode="eval").body
+    except SyntaxError:
+        return ""
+    return _leading_literal_node(node)
+
+
+def _leading_literal_node(node: ast.AST) -> str:
+    """Returns the literal text a string expression is known to start with."""
+    if isinstance(node, ast.Constant):
+        return node.value if isinstance(node.value, str) else ""
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        head = _leading_literal_node(node.left)
+        if isinstance(node.left, ast.Constant) and head:
+            return head + _leading_literal_node(node.right)
+        return head
+    if isinstance(node, ast.JoinedStr) and node.values:
+        return _leading_literal_node(node.values[0])
+    return ""
+
+
+def _closing_parenthesis(text: str, start: int) -> Optional[int]:
+    """Returns the index of the parenthesis closing the one opened before start."""
+    balance = 0
+    quote = None
+    index = start
+    while index < len(text):
+        char = text[index]
+        if quote:
+            if char == "\\":
+                index += 1
+            elif char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
+            balance += 1
+        elif char == ")":
+            if balance == 0:
+                return index
+            balance -= 1
+        index += 1
+    return None
+
+
+def _is_idx(node: ast.AST) -> bool:
+    # jvm.get('idx'), or str() of it
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id == "str"
+        and len(node.args) == 1
+    ):
+        node = node.args[0]
+    return (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Attribute)
+        and isinstance(node.func.value, ast.Name)
+        and node.func.value.id == "jvm"
+        and node.func.attr == "get"
+        and len(node.args) == 1
+        and isinstance(node.args[0], ast.Constant)
+        and node.args[0].value == "idx"
+    )
+
+
+def _is_current_idx_key(node: ast.AST) -> bool:
+    """Whether a key expression is built from literals and exactly the current idx."""
+
+    def parts(node):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return parts(node.left) + parts(node.right)
+        if isinstance(node, ast.JoinedStr):
+            return [
+                value.value if isinstance(value, ast.FormattedValue) else value
+                for value in node.values
+            ]
+        return [node]
+
+    nodes = parts(node)
+    uses_idx = False
+    for part in nodes:
+        if _is_idx(part):
+            uses_idx = True
+        elif not (isinstance(part, ast.Constant) and isinstance(part.value, str)):
+            return False
+    return uses_idx
+
+
+def _iteration_reads(text: Optional[str]) -> List[tuple]:
+    """Returns (pattern, current idx only) for the keys read in text."""
+    if not text:
+        return []
+
+    reads = []
+    for match in _READ_CALL.finditer(text):
+        end = _closing_parenthesis(text, match.end())
+        if end is None:
+            reads.append((ANY_KEY, False))
+            continue
+        call = text[match.start() : end + 1]
+        pattern = _call_pattern(call, match.group(1) != "get")
+        own = False
+        if match.group(1) == "get":
+            try:
+                node = ast.parse(call, mode="eval").body
+                own = bool(node.args) and _is_current_idx_key(node.args[0])
+            except SyntaxError:
+                pass
+        reads.append((pattern, own))
+    return reads
+
+
+def _template_is_current_idx(template) -> bool:
+    if not isinstance(template, str):
+        return False
+    template = template.strip()
+    if template.startswith(jvm.LAZY_EVAL_PREFIX):
+        end = _closing_parenthesis(template, len(jvm.LAZY_EVAL_PREFIX))
+        if end is None:
+            return False
+        try:
+            node = ast.parse(template[len(jvm.LAZY_EVAL_PREFIX) : end].strip(), mode="eval").body
+        except SyntaxError:
+            return False
+        return _is_current_idx_key(node)
+    return "<idx>" in template and jvm.LAZY_EVAL_PREFIX not in template
+
+
+def _iteration_writes(instruction: dict) -> List[tuple]:
+    """Returns (pattern, current idx only) for the keys written by instruction."""
+    args = instruction.get("args") or {}
+    if instruction.get("type") == "TextCompletion":
+        templates = _output_keys(args.get("output_format"))
+    else:
+        templates = [args.get("save_to")]
+    writes = []
+    for template in templates:
+        pattern = template_pattern(template)
+        if instruction.get("type") == "FetchWebContents":
+            pattern = KeyPattern(pattern.key.split(".")[0], prefix=True)
+        writes.append((pattern, _template_is_current_idx(template)))
+    return writes
+
+
+def independent_iterations(instructions: Sequence[dict]) -> bool:
+    """Whether the iterations of a loop over instructions may run concurrently.
+
+    Every instruction must be a basic one, and every key it writes must be
+    dynamic (e.g. "page_<idx>.seq3.str"), so that iterations write disjoint
+    keys. A key written by every iteration would make their order matter.
+    No key read in the body may be written by another iteration: reads that
+    may match a body write must name a key built from exactly the current
+    idx, and so must the writes they match.
+    """
+    writes = []
+    for instruction in instructions:
+        effects = analyze(instruction)
+        if effects.barrier:
+            return False
+        if instruction.get("type") == "FetchWebContents":
+            # its "<idx>" is the index of a url, the keys depend on the
+            # iteration only if they are evaluated
+            save_to = (instruction.get("args") or {}).get("save_to")
+            if not isinstance(save_to, str) or jvm.LAZY_EVAL_PREFIX not in save_to:
+                return False
+        for pattern in effects.writes:
+            if not pattern.prefix or pattern == ANY_KEY:
+                return False
+        writes.extend(_iteration_writes(instruction))
+
+    for instruction in instructions:
+        args = instruction.get("args") or {}
+        for name in READ_ARGS[instruction["type"]]:
+            value = args.get(name)
+            if value is not None and not isinstance(value, str):
+                value = json.dumps(value)
+            for read, read_own in _iteration_reads(value):
+                for write, write_own in writes:
+                    if read.overlaps(write) and not (read_own and write_own):
+                        return False
+    return True
+
+
+def dependencies(effects: Sequence[Effects]) -> List[set]:
+    return [
+        {i for i in range(j) if effects[i].conflicts_with(effects[j])}
+        for j in range(len(effects))
+    ]
+
+
+def run_graph(
+    jobs: Sequence[Callable[[], None]],
+    effects: Sequence[Effects],
+    max_workers: int,
+    done: Iterable[int] = (),
+    on_done: Optional[Callable[[int], None]] = None,
+):
+    """Runs jobs on a bounded pool, each one after the earlier jobs it conflicts with.
+
+    Jobs listed in `done` already ran and are skipped, `on_done` is called
+    with the index of every job that succeeds. After a failure no new job is
+    started; the running ones are awaited and the error of the earliest
+    failed job is raised.
+    """
+    deps = dependencies(effects)
+    done = set(done)
+    pending = [i for i in range(len(jobs)) if i not in done]
+    running = {}
+    errors = {}
+
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="jvm-worker"
+    ) as pool:
+        while pending or running:
+            if not errors:
+                for index in [i for i in pending if deps[i] <= done]:
+                    pending.remove(index)
+                    running[pool.submit(jobs[index])] = index
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    logging.error(f"Instruction {index} of the batch failed: {error}")
+                    errors[index] = error
+                elif on_done is not None:
+                    on_done(index)
+                done.add(index)
+
+    if errors:
+        raise errors[min(errors)]
@@ -0,0 +1,369 @@
+"""Restricted evaluator for the expressions inside jvm.eval(...).
+
+An expression is parsed once and compiled into a tree of closures. Only the
+JVM expression subset is accepted: literals, the read-only `jvm` API, a small
+set of builtins, indexing, arithmetic, comparisons, boolean logic, f-strings
+and comprehensions. Anything else (imports, dunder attributes, lambdas,
+assignments, ...) raises UnsupportedExpression.
+"""
+import ast
+import operator
+from typing import Any, Callable, Dict, Optional
+
+# functions of the jvm module that an expression may call
+# (not `eval`, which would run any string it is given)
+JVM_FUNCTIONS = {"get", "list_keys_with_prefix", "list_values_with_key_prefix"}
+
+SAFE_BUILTINS = {
+    func.__name__: func
+    for func in [
+        abs, all, any, bool, dict, enumerate, float, int, len, list, max, min,
+        range, reversed, round, set, sorted, str, sum, tuple, zip,
+    ]
+}
+
+# methods are only looked up on plain data values
+SAFE_VALUE_TYPES = (str, bytes, list, dict, tuple, set, int, float, bool, type(None))
+UNSAFE_METHODS = {"format", "format_map"}
+
+BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+
+UNARY_OPS = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+COMPARE_OPS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+TRUE_WORDS = {"true", "yes"}
+FALSE_WORDS = {"false", "no", "none", "null", ""}
+
+Scope = Dict[str, Any]
+Closure = Callable[[Scope], Any]
+
+
+class UnsupportedExpression(ValueError):
+    pass
+
+
+def compile_expression(source: str, allow_jvm: bool = True) -> Callable[[], Any]:
+    """Compiles `source` into a function evaluating it.
+
+    Raises SyntaxError for invalid Python and UnsupportedExpression for
+    constructs outside the JVM expression subset. With `allow_jvm` set to
+    False the expression may not access the jvm module at all.
+    """
+    tree = ast.parse(source, mode="eval")
+    closure = _Compiler(allow_jvm).compile(tree.body)
+    return lambda: closure({})
+
+
+def decide_condition(condition) -> Optional[bool]:
+    """Decides an evaluated If condition locally, None if it needs the LLM.
+
+    Booleans, numbers, true/false words, literals such as [] or {} and
+    comparisons or boolean logic over literals are decided by their truth
+    value. Anything else, e.g. a sentence, is left to the LLM.
+    """
+    if condition is None:
+        return False
+    if isinstance(condition, (bool, int, float, list, dict)):
+        return bool(condition)
+    if not isinstance(condition, str):
+        return None
+
+    text = condition.strip()
+    if text.lower() in TRUE_WORDS:
+        return True
+    if text.lower() in FALSE_WORDS:
+        return False
+
+    try:
+        value = compile_expression(text, allow_jvm=False)()
+    except Exception:
+        return None
+    if isinstance(value, str):
+        # a quoted answer like 'no' is judged by its meaning, not its length
+        return decide_condition(value) if value.strip() != text else None
+    if isinstance(value, (bool, int, float, list, dict, tuple, set, type(None))):
+        return bool(value)
+    return None
+
+
+def _jvm_module():
+    # imported lazily, jvm itself depends on this module
+    from jarvis.smartgpt import jvm
+
+    return jvm
+
+
+class _Compiler:
+    def __init__(self, allow_jvm: bool):
+        self.allow_jvm = allow_jvm
+
+    def compile(self, node: ast.AST) -> Closure:
+        method = getattr(self, f"_{type(node).__name__}", None)
+        if method is None:
+            raise UnsupportedExpression(f"{type(node).__name__} is not supported")
+        return method(node)
+
+    def _Constant(self, node: ast.Constant) -> Closure:
+        value = node.value
+        return lambda scope: value
+
+    def _Name(self, node: ast.Name) -> Closure:
+        name = node.id
+        if name.startswith("__"):
+            raise UnsupportedExpression(f"name {name} is not allowed")
+        if name == "jvm":
+            if not self.allow_jvm:
+                raise UnsupportedExpression("jvm is not available")
+            return lambda scope: _jvm_module()
+        builtin = SAFE_BUILTINS.get(name)
+
+        def load(scope):
+            if name in scope:
+                return scope[name]
+            if builtin is not None:
+                return builtin
+            raise NameError(f"name '{name}' is not defined")
+
+        return load
+
+    def _Attribute(self, node: ast.Attribute) -> Closure:
+        attr = node.attr
+        if attr.startswith("_") or attr in UNSAFE_METHODS:
+            raise UnsupportedExpression(f"attribute {attr} is not allowed")
+
+        if isinstance(node.value, ast.Name) and node.value.id == "jvm":
+            if not self.allow_jvm or attr not in JVM_FUNCTIONS:
+                raise UnsupportedExpression(f"jvm.{attr} is not allowed")
+            # looked up on every call, so the jvm API can still be patched
+            return lambda scope: getattr(_jvm_module(), attr)
+
+        value = self.compile(node.value)
+
+        def load(scope):
+            obj = value(scope)
+            if not isinstance(obj, SAFE_VALUE_TYPES):
+                raise UnsupportedExpression(
+                    f"attribute {attr} of {type(obj).__name__} is not allowed"
+                )
+            return getattr(obj, attr)
+
+        return load
+
+    def _Call(self, node: ast.Call) -> Closure:
+        func = self.compile(node.func)
+        if any(isinstance(arg, ast.Starred) for arg in node.args):
+            raise UnsupportedExpression("starred arguments are not supported")
+        if any(keyword.arg is None for keyword in node.keywords):
+            raise UnsupportedExpression("** arguments are not supported")
+        args = [self.compile(arg) for arg in node.args]
+        kwargs = [(keyword.arg, self.compile(keyword.value)) for keyword in node.keywords]
+
+        if not kwargs:
+            if len(args) == 1:
+                arg = args[0]
+                return lambda scope: func(scope)(arg(scope))
+            return lambda scope: func(scope)(*[arg(scope) for arg in args])
+
+        return lambda scope: func(scope)(
+            *[arg(scope) for arg in args],
+            **{name: value(scope) for name, value in kwargs},
+        )
+
+    def _Subscript(self, node: ast.Subscript) -> Closure:
+        value = self.compile(node.value)
+        index = self.compile(node.slice)
+        return lambda scope: value(scope)[index(scope)]
+
+    def _Slice(self, node: ast.Slice) -> Closure:
+        parts = [
+            self.compile(part) if part is not None else (lambda scope: None)
+            for part in (node.lower, node.upper, node.step)
+        ]
+        lower, upper, step = parts
+        return lambda scope: slice(lower(scope), upper(scope), step(scope))
+
+    def _BinOp(self, node: ast.BinOp) -> Closure:
+        op = BIN_OPS.get(type(node.op))
+        if op is None:
+            raise UnsupportedExpression(f"{type(node.op).__name__} is not supported")
+        left = self.compile(node.left)
+        right = self.compile(node.right)
+        return lambda scope: op(left(scope), right(scope))
+
+    def _UnaryOp(self, node: ast.UnaryOp) -> Closure:
+        op = UNARY_OPS.get(type(node.op))
+        if op is None:
+            raise UnsupportedExpression(f"{type(node.op).__name__} is not supported")
+        operand = self.compile(node.operand)
+        return lambda scope: op(operand(scope))
+
+    def _BoolOp(self, node: ast.BoolOp) -> Closure:
+        values = [self.compile(value) for value in node.values]
+        is_and = isinstance(node.op, ast.And)
+
+        def evaluate(scope):
+            # short-circuits and returns the deciding operand, like Python does
+            result = None
+            for value in values:
+                result = value(scope)
+                if bool(result) != is_and:
+                    return result
+            return result
+
+        return evaluate
+
+    def _Compare(self, node: ast.Compare) -> Closure:
+        left = self.compile(node.left)
+        ops = []
+        for op, comparator in zip(node.ops, node.comparators):
+            func = COMPARE_OPS.get(type(op))
+            if func is None:
+                raise UnsupportedExpression(f"{type(op).__name__} is not supported")
+            ops.append((func, self.compile(comparator)))
+
+        def evaluate(scope):
+            current = left(scope)
+            for func, comparator in ops:
+                right = comparator(scope)
+                if not func(current, right):
+                    return False
+                current = right
+            return True
+
+        return evaluate
+
+    def _IfExp(self, node: ast.IfExp) -> Closure:
+        test = self.compile(node.test)
+        body = self.compile(node.body)
+        orelse = self.compile(node.orelse)
+        return lambda scope: body(scope) if test(scope) else orelse(scope)
+
+    def _List(self, node: ast.List) -> Closure:
+        elts = [self.compile(elt) for elt in node.elts]
+        return lambda scope: [elt(scope) for elt in elts]
+
+    def _Tuple(self, node: ast.Tuple) -> Closure:
+        elts = [self.compile(elt) for elt in node.elts]
+        return lambda scope: tuple(elt(scope) for elt in elts)
+
+    def _Set(self, node: ast.Set) -> Closure:
+        elts = [self.compile(elt) for elt in node.elts]
+        return lambda scope: {elt(scope) for elt in elts}
+
+    def _Dict(self, node: ast.Dict) -> Closure:
+        if any(key is None for key in node.keys):
+            raise UnsupportedExpression("** in dict literals is not supported")
+        items = [(self.compile(k), self.compile(v)) for k, v in zip(node.keys, node.values)]
+        return lambda scope: {key(scope): value(scope) for key, value in items}
+
+    def _JoinedStr(self, node: ast.JoinedStr) -> Closure:
+        parts = [self.compile(value) for value in node.values]
+        return lambda scope: "".join(str(part(scope)) for part in parts)
+
+    def _FormattedValue(self, node: ast.FormattedValue) -> Closure:
+        value = self.compile(node.value)
+        convert = {-1: None, ord("s"): str, ord("r"): repr, ord("a"): ascii}[
+            node.conversion
+        ]
+        spec = self.compile(node.format_spec) if node.format_spec else None
+
+        def evaluate(scope):
+            result = value(scope)
+            if convert is not None:
+                result = convert(result)
+            return format(result, spec(scope) if spec else "")
+
+        return evaluate
+
+    def _ListComp(self, node: ast.ListComp) -> Closure:
+        element = self.compile(node.elt)
+        loop = self._comprehension(node.generators)
+        return lambda scope: [element(inner) for inner in loop(scope)]
+
+    def _GeneratorExp(self, node: ast.GeneratorExp) -> Closure:
+        # evaluated eagerly, which only matters for side effects
+        return self._ListComp(node)
+
+    def _SetComp(self, node: ast.SetComp) -> Closure:
+        element = self.compile(node.elt)
+        loop = self._comprehension(node.generators)
+        return lambda scope: {element(inner) for inner in loop(scope)}
+
+    def _DictComp(self, node: ast.DictComp) -> Closure:
+        key = self.compile(node.key)
+        value = self.compile(node.value)
+        loop = self._comprehension(node.generators)
+        return lambda scope: {key(inner): value(inner) for inner in loop(scope)}
+
+    def _comprehension(self, generators):
+        """Returns a function yielding one scope per iteration of the generators."""
+        compiled = []
+        for generator in generators:
+            if generator.is_async:
+                raise UnsupportedExpression("async comprehensions are not supported")
+            compiled.append(
+                (
+                    self._target(generator.target),
+                    self.compile(generator.iter),
+                    [self.compile(cond) for cond in generator.ifs],
+                )
+            )
+
+        def loop(scope, level=0):
+            if level == len(compiled):
+                yield scope
+                return
+            bind, iterable, conditions = compiled[level]
+            for item in iterable(scope):
+                inner = dict(scope)
+                bind(inner, item)
+                if all(condition(inner) for condition in conditions):
+                    yield from loop(inner, level + 1)
+
+        return loop
+
+    def _target(self, target: ast.AST):
+        if isinstance(target, ast.Name):
+            name = target.id
+
+            def bind(scope, value):
+                scope[name] = value
+
+            return bind
+
+        if isinstance(target, ast.Tuple):
+            binds = [self._target(elt) for elt in target.elts]
+
+            def bind(scope, value):
+                values = tuple(value)
+                if len(values) != len(binds):
+                    raise ValueError(f"expected {len(binds)} values to unpack")
+                for inner_bind, inner_value in zip(binds, values):
+                    inner_bind(scope, inner_value)
+
+            return bind
+
+        raise UnsupportedExpression(f"{type(target).__name__} target is not supported")
@@ -0,0 +1,190 @@
+"""Streaming extraction of the plain text of HTML pages.
+
+The text is collected from parser events in a single pass, without building
+a document tree. Scripts and styles are dropped, and so are boilerplate
+elements like navigation bars, sidebars, footers and forms unless
+`skip_boilerplate` is off. A link to an external page is written as
+"[text](url)" in markdown. Every line of the text is stripped and split on
+double spaces, and the non-empty parts are joined with newlines.
+
+lxml's C parser is used when it is installed, the html.parser of the
+standard library otherwise.
+"""
+import os
+import re
+from html.parser import HTMLParser
+from typing import Dict, List, Optional
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+SKIPPED_TAGS = {"script", "style"}
+BOILERPLATE_TAGS = {
+    "nav", "aside", "footer", "form", "noscript", "iframe", "svg", "template", "select",
+}
+BOILERPLATE_ROLES = {"navigation", "complementary", "contentinfo", "search", "menu"}
+VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta",
+    "param", "source", "track", "wbr",
+}
+
+_CHUNK_SEPARATOR = re.compile(r"  +")
+
+
+def default_skip_boilerplate() -> bool:
+    return os.getenv("FETCH_SKIP_BOILERPLATE", "true").lower() == "true"
+
+
+class TextCollector:
+    """Collects the text of a page from start, end and data parser events."""
+
+    def __init__(self, skip_boilerplate: bool = True):
+        self.skip_boilerplate = skip_boilerplate
+        self.parts: List[str] = []
+        # the open elements outside the skipped one
+        self.open: List[str] = []
+        # the tag of the skipped element and the elements open inside it
+        self.skipping: Optional[str] = None
+        self.skipped_open: List[str] = []
+        # the url and text of the external link being collected
+        self.link: Optional[str] = None
+        self.link_parts: List[str] = []
+
+    def skipped(self, tag: str, attrs: Dict[str, Optional[str]]) -> bool:
+        if tag in SKIPPED_TAGS:
+            return True
+        if not self.skip_boilerplate:
+            return False
+        if tag in BOILERPLATE_TAGS:
+            return True
+        return (attrs.get("role") or "").lower() in BOILERPLATE_ROLES
+
+    def start(self, tag: str, attrs: Dict[str, Optional[str]]):
+        tag = tag.lower()
+        if tag in VOID_TAGS:
+            return
+        if self.skipping is not None:
+            self.skipped_open.append(tag)
+            return
+        if self.skipped(tag, attrs):
+            self.skipping, self.skipped_open = tag, []
+            return
+        self.open.append(tag)
+        if tag == "a":
+            self.flush_link()
+            url = attrs.get("href") or ""
+            # Only rewrite external links, i.e. ones starting with 'http' or 'https'
+            if url.startswith("http://") or url.startswith("https://"):
+                self.link = url
+
+    def end(self, tag: str):
+        tag = tag.lower()
+        if self.skipping is not None:
+            if tag in self.skipped_open:
+                _pop_to(self.skipped_open, tag)
+                return
+            if tag == self.skipping:
+                self.skipping = None
+                return
+            if tag not in self.open:
+                # a stray end tag
+                return
+            # closing an enclosing element implies the end of a skipped element
+            # left open by malformed HTML, the text after it is kept
+            self.skipping = None
+        if tag in self.open:
+            _pop_to(self.open, tag)
+        if tag == "a":
+            self.flush_link()
+
+    def data(self, data: str):
+        if self.skipping is not None:
+            return
+        if self.link is not None:
+            self.link_parts.append(data)
+        else:
+            self.parts.append(data)
+
+    def flush_link(self):
+        if self.link is not None:
+            self.parts.append(f"[{''.join(self.link_parts)}]({self.link})")
+            self.link = None
+            self.link_parts = []
+
+    def close(self) -> str:
+        self.flush_link()
+        text = "".join(self.parts)
+        chunks = (
+            chunk.strip()
+            for line in text.splitlines()
+            for chunk in _CHUNK_SEPARATOR.split(line.strip())
+        )
+        return "\n".join(chunk for chunk in chunks if chunk)
+
+
+def _pop_to(stack: List[str], tag: str):
+    """Pops the innermost open `tag` and the elements open inside it."""
+    del stack[len(stack) - 1 - stack[::-1].index(tag) :]
+
+
+class _StdlibParser(HTMLParser):
+    def __init__(self, collector: TextCollector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        self.collector.end(tag)
+
+    def handle_data(self, data):
+        self.collector.data(data)
+
+
+class _LxmlTarget:
+    def __init__(self, collector: TextCollector):
+        self.collector = collector
+
+    def start(self, tag, attrib):
+        if isinstance(tag, str):
+            self.collector.start(tag, dict(attrib))
+
+    def end(self, tag):
+        if isinstance(tag, str):
+            self.collector.end(tag)
+
+    def data(self, data):
+        self.collector.data(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return self.collector.close()
+
+
+def extract_text(
+    html: str, skip_boilerplate: Optional[bool] = None, engine: Optional[str] = None
+) -> str:
+    """Returns the plain text of html.
+
+    `engine` is "lxml" or "stdlib", by default lxml if it is installed.
+    """
+    if skip_boilerplate is None:
+        skip_boilerplate = default_skip_boilerplate()
+    if engine is None:
+        engine = "lxml" if etree is not None else "stdlib"
+    collector = TextCollector(skip_boilerplate)
+
+    if engine == "lxml" and html.strip():
+        parser = etree.HTMLParser(target=_LxmlTarget(collector), encoding="utf-8")
+        parser.feed(html.encode("utf-8"))
+        return parser.close()
+
+    parser = _StdlibParser(collector)
+    parser.feed(html)
+    parser.close()
+    return collector.close()
@@ -0,0 +1,266 @@
+"""Tiered fetching of web pages.
+
+Most pages are rendered by the server, so a page is first fetched with a
+plain HTTP request on a pooled keep-alive session. Only when the response
+looks like it needs JavaScript to render (little visible text, a "please
+enable JavaScript" notice, an empty app mount point), or the request fails,
+the page is loaded again by a browser from the browser pool.
+
+Validators (ETag and Last-Modified) of the pages fetched over HTTP are kept,
+so fetching one again is a conditional GET answered by 304 Not Modified.
+The fetcher counts how many fetches every tier served.
+"""
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from jarvis.smartgpt import browser
+from jarvis.smartgpt import profiler
+
+TIER_HTTP = "http"
+TIER_NOT_MODIFIED = "http_not_modified"
+TIER_BROWSER = "browser"
+
+DEFAULT_JS_MARKERS = (
+    "enable javascript",
+    "javascript is required",
+    "javascript is disabled",
+    "requires javascript",
+    "you need to enable javascript",
+)
+
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/119.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+_EMPTY_MOUNT_POINT = re.compile(
+    r"<div[^>]+id=[\"'](root|app|__next|__nuxt)[\"'][^>]*>\s*</div>", re.IGNORECASE
+)
+_INVISIBLE = re.compile(
+    r"<(script|style|noscript|template)\b.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL
+)
+_TAG = re.compile(r"<[^>]+>")
+
+
+def fetcher_options() -> dict:
+    markers = os.getenv("FETCH_JS_MARKERS")
+    return {
+        "timeout": float(os.getenv("FETCH_TIMEOUT", "20")),
+        "min_text_chars": int(os.getenv("FETCH_MIN_TEXT_CHARS", "200")),
+        "js_markers": DEFAULT_JS_MARKERS
+        if markers is None
+        else tuple(m.strip().lower() for m in markers.split(",") if m.strip()),
+        "mode": os.getenv("FETCH_MODE", "auto"),
+        "max_validator_bytes": int(os.getenv("FETCH_VALIDATOR_CACHE_BYTES", str(32 * 1024 * 1024))),
+    }
+
+
+def visible_text_length(html: str) -> int:
+    """A cheap estimate of the amount of text a page shows."""
+    text = _TAG.sub(" ", _INVISIBLE.sub(" ", html))
+    return len(" ".join(text.split()))
+
+
+class Fetcher:
+    def __init__(
+        self,
+        timeout: float = 20,
+        min_text_chars: int = 200,
+        js_markers: Sequence[str] = DEFAULT_JS_MARKERS,
+        mode: str = "auto",
+        session: Optional[requests.Session] = None,
+        browser_pool: Optional[browser.BrowserPool] = None,
+        max_validators: int = 1024,
+        max_validator_bytes: int = 32 * 1024 * 1024,
+    ):
+        if mode not in ("auto", "http", "browser"):
+            raise ValueError(f"Unknown fetch mode {mode}")
+        self.timeout = timeout
+        self.min_text_chars = min_text_chars
+        self.js_markers = tuple(js_markers)
+        # "http" never escalates to the browser, "browser" never tries HTTP
+        self.mode = mode
+        self.session = session or _new_session()
+        self._browser_pool = browser_pool
+        self.max_validators = max_validators
+        self.max_validator_bytes = max_validator_bytes
+        # url -> (etag, last modified, html, size) of the pages served over HTTP
+        self.validators = OrderedDict()
+        self.validator_bytes = 0
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+
+    @property
+    def browser_pool(self) -> browser.BrowserPool:
+        return self._browser_pool or browser.default_pool()
+
+    def get_html(self, url: str) -> str:
+        start = time.perf_counter()
+        html = None
+        if self.mode != "browser":
+            html, tier = self.fetch_http(url)
+        if html is None:
+            html, tier = self.browser_pool.get_html(url), TIER_BROWSER
+        self._count(url, tier, time.perf_counter() - start)
+        return html
+
+    def fetch_http(self, url: str):
+        """Returns the HTML and tier of url, or None if it needs the browser."""
+        headers = {}
+        with self.lock:
+            cached = self.validators.get(url)
+        if cached is not None:
+            etag, last_modified, _, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as err:
+            if self.mode == "http":
+                raise
+            logging.info(f"Fetching {url} over HTTP failed, falling back to the browser: {err}")
+            return None, None
+
+        if response.status_code == 304 and cached is not None:
+            return cached[2], TIER_NOT_MODIFIED
+
+        reason = self.browser_reason(response)
+        if reason is not None and self.mode != "http":
+            logging.info(f"Fetching {url} with the browser: {reason}")
+            return None, None
+        if self.mode == "http":
+            response.raise_for_status()
+
+        html = response.text
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self._remember(url, etag, last_modified, html)
+        return html, TIER_HTTP
+
+    def _remember(self, url: str, etag, last_modified, html: str) -> None:
+        # the least recently fetched pages are dropped beyond either bound
+        size = len(html.encode("utf-8"))
+        with self.lock:
+            previous = self.validators.pop(url, None)
+            if previous is not None:
+                self.validator_bytes -= previous[3]
+            if size > self.max_validator_bytes:
+                return
+            self.validators[url] = (etag, last_modified, html, size)
+            self.validator_bytes += size
+            while (
+                len(self.validators) > self.max_validators
+                or self.validator_bytes > self.max_validator_bytes
+            ):
+                _, (_, _, _, evicted_size) = self.validators.popitem(last=False)
+                self.validator_bytes -= evicted_size
+
+    def browser_reason(self, response) -> Optional[str]:
+        """Returns why the response needs the browser, None if it does not."""
+        if response.status_code >= 400:
+            return f"status {response.status_code}"
+        content_type = response.headers.get("Content-Type", "text/html").lower()
+        if "html" not in content_type:
+            if content_type.startswith("text/") or "json" in content_type:
+                return None
+            return f"content type {content_type}"
+
+        html = response.text
+        lowered = html.lower()
+        marker = next((m for m in self.js_markers if m in lowered), None)
+        if marker is not None:
+            return f"the page says '{marker}'"
+        if _EMPTY_MOUNT_POINT.search(html):
+            return "the page has an empty app mount point"
+        if visible_text_length(html) < self.min_text_chars:
+            return "the page has almost no text"
+        return None
+
+    def _count(self, url: str, tier: str, seconds: float):
+        logging.info(f"Fetched {url} via {tier} in {seconds:.2f}s")
+        profiler.record(f"fetch_{tier}")
+        with self.lock:
+            self.counts[tier] = self.counts.get(tier, 0) + 1
+            self.seconds[tier] = self.seconds.get(tier, 0.0) + seconds
+
+    def metrics(self) -> Dict[str, dict]:
+        """Returns the number of fetches and the time spent by tier."""
+        with self.lock:
+            return {
+                tier: {"count": count, "seconds": round(self.seconds[tier], 3)}
+                for tier, count in self.counts.items()
+            }
+
+
+class HostLimiter:
+    """Limits the concurrent requests to every host and spaces them out."""
+
+    def __init__(self, per_host: int = 2, delay: float = 0.5):
+        self.per_host = max(per_host, 1)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.slots: Dict[str, threading.Semaphore] = {}
+        # host -> the earliest time of its next request
+        self.next_start: Dict[str, float] = {}
+
+    @contextmanager
+    def slot(self, url: str):
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            semaphore = self.slots.setdefault(host, threading.Semaphore(self.per_host))
+        with semaphore:
+            with self.lock:
+                now = time.monotonic()
+                start = max(now, self.next_start.get(host, now))
+                self.next_start[host] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+
+def limiter_options() -> dict:
+    return {
+        "per_host": int(os.getenv("FETCH_PER_HOST", "2")),
+        "delay": float(os.getenv("FETCH_HOST_DELAY", "0.5")),
+    }
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    # requests sends Accept-Encoding: gzip, deflate and decodes the response
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def default_fetcher() -> Fetcher:
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = Fetcher(**fetcher_options())
+        return _default_fetcher
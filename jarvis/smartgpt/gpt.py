@@ -1,23 +1,25 @@
 import os
-from typing import Optional, List, Dict
+import time
+import heapq
+import random
+import hashlib
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import TYPE_CHECKING, Callable, Optional, List, Dict, Tuple
 from dataclasses import dataclass, field
 
-import openai
-import tiktoken
-
-from langchain.chat_models import ChatOpenAI
-from langchain.llms.openai import OpenAI, AzureOpenAI
-from langchain.schema.language_model import BaseLanguageModel
-from langchain.schema.messages import (
-    HumanMessage,
-    SystemMessage,
-    BaseMessage,
-    ChatMessage,
-)
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.embeddings.base import Embeddings
+# langchain, openai and tiktoken take about a second to import, and tiktoken
+# loads its encoding from the network: they are imported when first used
+if TYPE_CHECKING:
+    from langchain.schema.language_model import BaseLanguageModel
+    from langchain.schema.messages import BaseMessage
+    from langchain.embeddings.base import Embeddings
 
 import jarvis.smartgpt.initializer  # ignore this line
+from jarvis.smartgpt import profiler
 
 GPT_4 = "gpt-4"
 GPT_4_TURBO = "gpt-4-1106-preview"
@@ -61,6 +63,9 @@ class ModelInfo:
     name: str
     max_tokens: int
     prompt_token_cost: float
+    # requests and tokens per minute allowed by the API, 0 is unlimited
+    rpm: int = field(default=0, kw_only=True)
+    tpm: int = field(default=0, kw_only=True)
 
 
 @dataclass
@@ -93,6 +98,8 @@ OPEN_AI_CHAT_MODELS = {
             completion_token_cost=0.002,
             max_tokens=4096,
             supports_functions=True,
+            rpm=3500,
+            tpm=90000,
         ),
         ChatModelInfo(
             name="gpt-3.5-turbo-16k-0613",
@@ -100,6 +107,8 @@ OPEN_AI_CHAT_MODELS = {
             completion_token_cost=0.004,
             max_tokens=16384,
             supports_functions=True,
+            rpm=3500,
+            tpm=180000,
         ),
         ChatModelInfo(
             name="gpt-4-0613",
@@ -107,6 +116,8 @@ OPEN_AI_CHAT_MODELS = {
             completion_token_cost=0.06,
             max_tokens=8191,
             supports_functions=True,
+            rpm=200,
+            tpm=40000,
         ),
         ChatModelInfo(
             name="gpt-4-32k-0613",
@@ -114,6 +125,8 @@ OPEN_AI_CHAT_MODELS = {
             completion_token_cost=0.12,
             max_tokens=32768,
             supports_functions=True,
+            rpm=200,
+            tpm=80000,
         ),
         ChatModelInfo(
             name="gpt-4-1106-preview",
@@ -121,6 +134,8 @@ OPEN_AI_CHAT_MODELS = {
             completion_token_cost=0.003,
             max_tokens=12800,
             supports_functions=True,
+            rpm=500,
+            tpm=150000,
         ),
         ChatModelInfo(
             name="gpt-3.5-turbo-1106",
@@ -128,6 +143,8 @@ OPEN_AI_CHAT_MODELS = {
             completion_token_cost=0.002,
             max_tokens=16385,
             supports_functions=True,
+            rpm=3500,
+            tpm=90000,
         ),
         ChatModelInfo(
             name="gpt-4-vision-preview",
@@ -135,6 +152,8 @@ OPEN_AI_CHAT_MODELS = {
             completion_token_cost=0.02,
             max_tokens=16385,
             supports_functions=True,
+            rpm=100,
+            tpm=40000,
         )
     ]
 }
@@ -158,6 +177,8 @@ OPEN_AI_COMPLETION_MODELS = {
             prompt_token_cost=0.0015,
             completion_token_cost=0.002,
             max_tokens=4097,
+            rpm=3500,
+            tpm=90000,
         ),
     ]
 }
@@ -170,6 +191,8 @@ OPEN_AI_EMBEDDING_MODELS = {
             prompt_token_cost=0.0001,
             max_tokens=8191,
             embedding_dimensions=1536,
+            rpm=3000,
+            tpm=1000000,
         ),
     ]
 }
@@ -183,49 +206,470 @@ OPEN_AI_MODELS: dict[str, ChatModelInfo | EmbeddingModelInfo | CompletionModelIn
 # tokenization helper function
 TOKEN_BUFFER = 50
 TOKENS_PER_MESSAGE = 4
-ENCODING = tiktoken.encoding_for_model("gpt-4")
+_ENCODING_LOCK = threading.Lock()
+
+
+def _encoding():
+    # ENCODING becomes a module attribute once loaded, see __getattr__
+    encoding = globals().get("ENCODING")
+    if encoding is None:
+        with _ENCODING_LOCK:
+            encoding = globals().get("ENCODING")
+            if encoding is None:
+                import tiktoken
+
+                encoding = tiktoken.encoding_for_model("gpt-4")
+                globals()["ENCODING"] = encoding
+    return encoding
+
+
+def __getattr__(name: str):
+    if name == "ENCODING":
+        return _encoding()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_max_tokens(model: str) -> int:
     return OPEN_AI_MODELS[model].max_tokens - TOKEN_BUFFER
 
 
+# token counts of recent strings, by their content: the same content is
+# counted again and again when it is truncated, sent and profiled
+_TOKEN_COUNTS: "OrderedDict[object, int]" = OrderedDict()
+_TOKEN_COUNTS_LOCK = threading.Lock()
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "4096"))
+# strings longer than this are counted piece by piece, see count_text_tokens
+TOKEN_STREAM_CHARS = int(os.getenv("TOKEN_STREAM_CHARS", str(1024 * 1024)))
+_STREAM_PIECE_CHARS = 64 * 1024
+
+
+def _count_key(text: str):
+    # short strings are their own key, hashing long ones keeps the cache small
+    if len(text) <= 256:
+        return text
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def _cached_count(key) -> Optional[int]:
+    with _TOKEN_COUNTS_LOCK:
+        count = _TOKEN_COUNTS.get(key)
+        if count is not None:
+            _TOKEN_COUNTS.move_to_end(key)
+        return count
+
+
+def _cache_count(key, count: int):
+    with _TOKEN_COUNTS_LOCK:
+        _TOKEN_COUNTS[key] = count
+        _TOKEN_COUNTS.move_to_end(key)
+        while len(_TOKEN_COUNTS) > TOKEN_COUNT_CACHE_SIZE:
+            _TOKEN_COUNTS.popitem(last=False)
+
+
+# the tokens of the last long text encoded on a thread, since a text is often
+# counted first, then truncated or split
+_last_tokens = threading.local()
+
+
+def encode(text: str) -> List[int]:
+    """Encodes text, remembering its token count."""
+    key = _count_key(text)
+    last = getattr(_last_tokens, "value", None)
+    if last is not None and last[0] == key:
+        return last[1]
+
+    tokens = _encoding().encode(text)
+    _cache_count(key, len(tokens))
+    if not isinstance(key, str):
+        _last_tokens.value = (key, tokens)
+    return tokens
+
+
+def _stream_pieces(text: str):
+    # cut after a newline where possible, so that few tokens span two pieces
+    start = 0
+    while start < len(text):
+        end = start + _STREAM_PIECE_CHARS
+        if end < len(text):
+            newline = text.rfind("\n", start, end)
+            if newline > start:
+                end = newline + 1
+        yield text[start:end]
+        start = end
+
+
+def count_text_tokens(text: str) -> int:
+    """Returns the number of tokens of text.
+
+    Texts longer than TOKEN_STREAM_CHARS are encoded piece by piece instead of
+    at once; the count is then approximate, by a token or so per piece.
+    """
+    if not text:
+        return 0
+    key = _count_key(text)
+    count = _cached_count(key)
+    if count is not None:
+        return count
+
+    if len(text) > TOKEN_STREAM_CHARS:
+        count = sum(len(_encoding().encode(piece)) for piece in _stream_pieces(text))
+        _cache_count(key, count)
+        return count
+    return len(encode(text))
+
+
 def count_tokens(messages) -> int:
     # abstracted token count logic
     if isinstance(messages, str):
-        return len(ENCODING.encode(messages))
+        return count_text_tokens(messages)
 
-    return sum(len(ENCODING.encode(item["content"])) for item in messages) + (
+    return sum(count_text_tokens(item["content"]) for item in messages) + (
         len(messages) * TOKENS_PER_MESSAGE
     )
 
 
+def _fits_bytes(content: str, max_token_count: int) -> bool:
+    # every token is at least one byte, and every character at least one byte
+    return len(content) <= max_token_count and len(content.encode("utf-8")) <= max_token_count
+
+
+def _fits_cached(content: str, max_token_count: int) -> bool:
+    if _fits_bytes(content, max_token_count):
+        return True
+    count = _cached_count(_count_key(content))
+    return count is not None and count <= max_token_count
+
+
+def within_tokens(content: str, max_token_count: int) -> bool:
+    """Whether content has at most max_token_count tokens, without encoding
+    content that is short enough in bytes."""
+    if _fits_bytes(content, max_token_count):
+        return True
+    return count_text_tokens(content) <= max_token_count
+
+
 def truncate_to_tokens(content: str, max_token_count: int) -> str:
     """Truncates the content to fit within the model's max tokens."""
 
-    if count_tokens(content) <= max_token_count:
+    if _fits_cached(content, max_token_count):
         # No need to truncate
         return content
 
-    tokens = ENCODING.encode(content)
+    tokens = encode(content)
+    if len(tokens) <= max_token_count:
+        return content
 
     # Truncate tokens
     truncated_tokens = tokens[:max_token_count]
 
     # Convert truncated tokens back to string
-    truncated_str = ENCODING.decode(truncated_tokens)
+    truncated_str = _encoding().decode(truncated_tokens)
 
     return truncated_str
 
 
+def split_to_tokens(content: str, chunk_tokens: int, overlap: int = 0) -> List[str]:
+    """Splits the content into chunks of at most chunk_tokens tokens.
+
+    Consecutive chunks share `overlap` tokens, so that a sentence cut at the
+    end of a chunk is whole at the start of the next one.
+    """
+    if _fits_cached(content, chunk_tokens):
+        return [content]
+    tokens = encode(content)
+    if len(tokens) <= chunk_tokens:
+        return [content]
+
+    step = max(chunk_tokens - overlap, 1)
+    chunks = []
+    for start in range(0, len(tokens), step):
+        chunks.append(_encoding().decode(tokens[start : start + chunk_tokens]))
+        if start + chunk_tokens >= len(tokens):
+            break
+    return chunks
+
+
+def record_tokens(request, response: Optional[str]):
+    """Records the tokens of an LLM call in the running profiler span, if any."""
+    if not profiler.active():
+        return
+    profiler.record(profiler.LLM_TOKENS_IN, count_tokens(request))
+    profiler.record(profiler.LLM_TOKENS_OUT, count_tokens(response or ""))
+
+
+## LLM request scheduling
+# requests of a lower priority are sent first
+INTERACTIVE = 0
+BACKGROUND = 10
+
+# errors worth retrying, by the name of their class in openai<1 and >=1
+_RETRYABLE_ERRORS = {
+    "RateLimitError",
+    "ServiceUnavailableError",
+    "Timeout",
+    "APITimeoutError",
+    "APIConnectionError",
+    "APIError",
+    "InternalServerError",
+}
+
+
+def _error_status(err: Exception) -> Optional[int]:
+    return getattr(err, "http_status", None) or getattr(err, "status_code", None)
+
+
+def is_rate_limited(err: Exception) -> bool:
+    return _error_status(err) == 429 or type(err).__name__ == "RateLimitError"
+
+
+def is_retryable(err: Exception) -> bool:
+    status = _error_status(err)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(err).__name__ in _RETRYABLE_ERRORS
+
+
+def _retry_after(err: Exception) -> float:
+    headers = getattr(err, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError, AttributeError):
+        return 0.0
+
+
+class TokenBucket:
+    """Allows `per_minute` units a minute, in bursts of up to a minute's worth.
+
+    A bucket of 0 per minute is unlimited. Taking more than is available
+    leaves the bucket in debt, which delays the next requests.
+    """
+
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.level = per_minute
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds to wait until amount is available."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        # a request larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float):
+        if self.rate <= 0:
+            return
+        self._refill()
+        self.level -= amount
+
+
+class _ModelState:
+    def __init__(self, rpm: int, tpm: int, clock):
+        self.requests = TokenBucket(rpm, clock)
+        self.tokens = TokenBucket(tpm, clock)
+        self.cond = threading.Condition()
+        # (priority, sequence) of the waiting requests
+        self.queue: List[Tuple[int, int]] = []
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.metrics = {
+            "requests": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "failures": 0,
+            "max_queue_depth": 0,
+            "wait_seconds": 0.0,
+        }
+
+
+def parse_rate_limits(text: Optional[str]) -> Dict[str, Tuple[int, int]]:
+    """Parses "gpt-4=500:30000,gpt-3.5-turbo=3500:90000" into (rpm, tpm) by model."""
+    limits = {}
+    for item in (text or "").split(","):
+        if not item.strip():
+            continue
+        model, _, limit = item.partition("=")
+        rpm, _, tpm = limit.partition(":")
+        limits[model.strip()] = (int(rpm or 0), int(tpm or 0))
+    return limits
+
+
+def scheduler_options() -> dict:
+    return {
+        "limits": parse_rate_limits(os.getenv("LLM_RATE_LIMITS")),
+        "max_concurrency": int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+        "max_retries": int(os.getenv("LLM_MAX_RETRIES", "5")),
+        "backoff_base": float(os.getenv("LLM_BACKOFF_BASE", "1")),
+        "backoff_max": float(os.getenv("LLM_BACKOFF_MAX", "60")),
+        "completion_tokens": int(os.getenv("LLM_COMPLETION_TOKENS", "512")),
+    }
+
+
+class LLMScheduler:
+    """Sends the LLM requests of all threads within the limits of each model.
+
+    Every model has a bucket of requests and a bucket of tokens per minute,
+    sized from its ModelInfo, and at most `max_concurrency` requests in
+    flight. Waiting requests are sent by priority, then in order of arrival.
+    Failed requests that are worth retrying are retried with a jittered
+    exponential backoff; a rate limited one pauses all requests to the model.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[int, int]]] = None,
+        max_concurrency: int = 8,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        completion_tokens: int = 512,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.limits = limits or {}
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # expected tokens of a response, reserved before it is known
+        self.completion_tokens = completion_tokens
+        self.clock = clock
+        self.sleep = sleep
+        self._states: Dict[str, _ModelState] = {}
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    def _state(self, model: str) -> _ModelState:
+        with self._lock:
+            state = self._states.get(model)
+            if state is None:
+                info = OPEN_AI_MODELS.get(model)
+                rpm, tpm = self.limits.get(
+                    model, (info.rpm, info.tpm) if info is not None else (0, 0)
+                )
+                state = self._states[model] = _ModelState(rpm, tpm, self.clock)
+            return state
+
+    def _acquire(self, state: _ModelState, tokens: int, priority: int):
+        ticket = (priority, next(self._sequence))
+        start = self.clock()
+        with state.cond:
+            heapq.heappush(state.queue, ticket)
+            state.metrics["max_queue_depth"] = max(
+                state.metrics["max_queue_depth"], len(state.queue)
+            )
+            while True:
+                if state.queue[0] == ticket and state.in_flight < self.max_concurrency:
+                    wait = max(
+                        state.paused_until - self.clock(),
+                        state.requests.delay(1),
+                        state.tokens.delay(tokens),
+                    )
+                    if wait <= 0:
+                        break
+                    state.cond.wait(wait)
+                else:
+                    state.cond.wait()
+
+            heapq.heappop(state.queue)
+            state.requests.take(1)
+            state.tokens.take(tokens)
+            state.in_flight += 1
+            state.metrics["requests"] += 1
+            state.metrics["wait_seconds"] += self.clock() - start
+            # the next request in the queue may go too
+            state.cond.notify_all()
+        if profiler.active():
+            profiler.record(profiler.LLM_WAIT_MS, int((self.clock() - start) * 1000))
+
+    def _release(self, state: _ModelState, tokens_delta: int = 0):
+        with state.cond:
+            state.in_flight -= 1
+            state.tokens.take(tokens_delta)
+            state.cond.notify_all()
+
+    def backoff(self, attempt: int, err: Optional[Exception] = None) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        # half of the delay is random, so that the retries of concurrent requests spread out
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if err is not None:
+            delay = max(delay, _retry_after(err))
+        return delay
+
+    def call(self, model: str, send: Callable[[], str], tokens: int, priority: int = INTERACTIVE) -> str:
+        """Sends a request of `tokens` prompt tokens to model with `send`."""
+        state = self._state(model)
+        reserved = tokens + self.completion_tokens
+        attempt = 0
+        while True:
+            self._acquire(state, reserved, priority)
+            try:
+                response = send()
+            except Exception as err:
+                self._release(state)
+                if not is_retryable(err) or attempt >= self.max_retries:
+                    with state.cond:
+                        state.metrics["failures"] += 1
+                    raise
+
+                delay = self.backoff(attempt, err)
+                attempt += 1
+                logging.warning(
+                    f"LLM request to {model} failed ({type(err).__name__}: {err}), retry {attempt} in {delay:.1f}s"
+                )
+                if profiler.active():
+                    profiler.record(profiler.LLM_RETRIES)
+                with state.cond:
+                    state.metrics["retries"] += 1
+                    if is_rate_limited(err):
+                        # every request to the model waits, not only this one
+                        state.metrics["rate_limited"] += 1
+                        state.paused_until = max(state.paused_until, self.clock() + delay)
+                        state.cond.notify_all()
+                if not is_rate_limited(err):
+                    self.sleep(delay)
+                continue
+
+            used = count_tokens(response) if isinstance(response, str) else 0
+            self._release(state, used - self.completion_tokens)
+            return response
+
+    def metrics(self) -> Dict[str, dict]:
+        """Returns the counters, queue depth and requests in flight by model."""
+        metrics = {}
+        with self._lock:
+            states = dict(self._states)
+        for model, state in states.items():
+            with state.cond:
+                metrics[model] = dict(
+                    state.metrics, queue_depth=len(state.queue), in_flight=state.in_flight
+                )
+        return metrics
+
+
+SCHEDULER = LLMScheduler(**scheduler_options())
+
+
 ## LLM helper functions
+# the clients do not retry on their own, LLMScheduler does
 def create_chat_client(
     model: str,
     temperature: float = 0.7,
     use_azure: bool = False,
     deployment_engine: Optional[str] = None,
     model_kwargs: Optional[dict] = None,
-) -> BaseLanguageModel:
+) -> "BaseLanguageModel":
+    from langchain.chat_models import ChatOpenAI
+
     if use_azure:
         if deployment_engine is None:
             raise ValueError("Deployment engine must be specified for Azure API")
@@ -235,6 +679,7 @@ def create_chat_client(
             )
         return ChatOpenAI(
             temperature=temperature,
+            max_retries=0,
             model_kwargs={
                 "engine": deployment_engine,
                 **model_kwargs,
@@ -244,6 +689,7 @@ def create_chat_client(
         return ChatOpenAI(
             temperature=temperature,
             model=model,
+            max_retries=0,
         )
 
 
@@ -253,7 +699,9 @@ def create_completion_client(
     use_azure: bool = False,
     deployment_engine: Optional[str] = None,
     model_kwargs: Optional[dict] = None,
-) -> BaseLanguageModel:
+) -> "BaseLanguageModel":
+    from langchain.llms.openai import OpenAI, AzureOpenAI
+
     if use_azure:
         if deployment_engine is None:
             raise ValueError("Deployment engine must be specified for Azure API")
@@ -267,12 +715,14 @@ def create_completion_client(
             temperature=temperature,
             model_kwargs=model_kwargs,
             max_tokens=-1,
+            max_retries=0,
         )
     else:
         return OpenAI(
             temperature=temperature,
             model=model,
             max_tokens=-1,
+            max_retries=0,
         )
 
 
@@ -281,7 +731,9 @@ def create_embedding_client(
     use_azure: bool = False,
     deployment_engine: Optional[str] = None,
     model_kwargs: Optional[dict] = None,
-) -> Embeddings:
+) -> "Embeddings":
+    from langchain.embeddings.openai import OpenAIEmbeddings
+
     if use_azure:
         if deployment_engine is None:
             raise ValueError("Deployment engine must be specified for Azure API")
@@ -335,41 +787,123 @@ class BaseLLM:
     def predict(self, prompt: str) -> str:
         return self._llm.predict(prompt)
 
-    def chat(self, messages: List[BaseMessage]) -> BaseMessage:
+    def chat(self, messages: List["BaseMessage"]) -> "BaseMessage":
         return self._llm.predict_messages(messages)
 
 
+class ScheduledEmbeddings:
+    """An embeddings client whose requests go through SCHEDULER.
+
+    They are counted against the token and request limits of the model and
+    retried with backoff like the completions. It has the embed_documents and
+    embed_query methods vector stores such as Chroma call.
+    """
+
+    def __init__(self, model: str, client: "Embeddings", priority: int = INTERACTIVE):
+        self.model = model
+        self.client = client
+        self.priority = priority
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._call(lambda: self.client.embed_documents(texts), texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call(lambda: self.client.embed_query(text), [text])
+
+    def _call(self, send, texts: List[str]):
+        tokens = sum(count_tokens(text) for text in texts)
+        response = SCHEDULER.call(self.model, send, tokens, self.priority)
+        if profiler.active():
+            profiler.record(profiler.LLM_TOKENS_IN, tokens)
+        return response
+
+
+def create_embedding_model(model: str) -> ScheduledEmbeddings:
+    if API_TYPE != "azure":
+        return ScheduledEmbeddings(model, create_embedding_client(model))
+    return ScheduledEmbeddings(
+        model,
+        create_embedding_client(
+            model,
+            use_azure=True,
+            deployment_engine=azure_deployment_map.get(model),
+            model_kwargs=azure_openai_model_kwargs,
+        ),
+    )
+
+
+class ModelHub(Mapping):
+    """Models by name, each created on first use and then shared."""
+
+    def __init__(self, factories: Dict[str, Callable[[str], object]]):
+        self._factories = factories
+        self._models: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str):
+        model = self._models.get(name)
+        if model is None:
+            factory = self._factories[name]
+            with self._lock:
+                model = self._models.get(name)
+                if model is None:
+                    model = self._models[name] = factory(name)
+        return model
+
+    def __contains__(self, name) -> bool:
+        return name in self._factories
+
+    def __iter__(self):
+        return iter(self._factories)
+
+    def __len__(self) -> int:
+        return len(self._factories)
+
+    def created(self) -> List[str]:
+        return list(self._models)
+
+
 # declare llm models
-OPEN_AI_MODELS_HUB = {
-    "gpt-4": BaseLLM("gpt-4"),
-    "gpt-4-1106-preview": BaseLLM("gpt-4-1106-preview"),
-    "gpt-3.5-turbo": BaseLLM("gpt-3.5-turbo"),
-    "gpt-3.5-turbo-16k": BaseLLM("gpt-3.5-turbo-16k"),
-    "gpt-3.5-turbo-instruct": BaseLLM("gpt-3.5-turbo-instruct"),
-    "text-embedding-ada-002": create_embedding_client("text-embedding-ada-002")
-    if API_TYPE != "azure"
-    else create_embedding_client(
-        "text-embedding-ada-002",
-        use_azure=True,
-        deployment_engine=azure_deployment_map.get("text-embedding-ada-002"),
-        model_kwargs=azure_openai_model_kwargs,
-    ),
-}
+OPEN_AI_MODELS_HUB = ModelHub(
+    {
+        "gpt-4": BaseLLM,
+        "gpt-4-1106-preview": BaseLLM,
+        "gpt-3.5-turbo": BaseLLM,
+        "gpt-3.5-turbo-16k": BaseLLM,
+        "gpt-3.5-turbo-instruct": BaseLLM,
+        "text-embedding-ada-002": create_embedding_model,
+    }
+)
 
 
-def complete(prompt: str, model: str, system_prompt: Optional[str] = None) -> str:
+def complete(
+    prompt: str,
+    model: str,
+    system_prompt: Optional[str] = None,
+    priority: int = INTERACTIVE,
+) -> str:
     if system_prompt:
         prompt = f"{system_prompt}\n##User question\n{prompt}\n"
     if model not in OPEN_AI_MODELS_HUB:
         raise ValueError(f"Not found model {model}")
-    return OPEN_AI_MODELS_HUB[model].predict(prompt)
+    response = SCHEDULER.call(
+        model,
+        lambda: OPEN_AI_MODELS_HUB[model].predict(prompt),
+        count_tokens(prompt),
+        priority,
+    )
+    record_tokens(prompt, response)
+    return response
 
 
 def complete_with_messages(
     model: str,
     messages: List[Dict[str, str]],
     prompt: Optional[str] = None,
+    priority: int = INTERACTIVE,
 ) -> str:
+    from langchain.schema.messages import HumanMessage, SystemMessage, ChatMessage
+
     chat_messages = []
     for message in messages:
         if message["role"] == "user":
@@ -387,16 +921,26 @@ def complete_with_messages(
     if model not in OPEN_AI_MODELS_HUB:
         raise ValueError(f"Not found model {model}")
 
-    return OPEN_AI_MODELS_HUB[model].chat(chat_messages).content
+    request = [{"content": message.content} for message in chat_messages]
+    response = SCHEDULER.call(
+        model,
+        lambda: OPEN_AI_MODELS_HUB[model].chat(chat_messages).content,
+        count_tokens(request),
+        priority,
+    )
+    record_tokens(request, response)
+    return response
 
 
-def send_messages(messages: List[Dict[str, str]], model: str) -> str:
-    return complete_with_messages(model, messages)
+def send_messages(
+    messages: List[Dict[str, str]], model: str, priority: int = INTERACTIVE
+) -> str:
+    return complete_with_messages(model, messages, priority=priority)
 
 
 def chat(
-    model: str, messages: List[Dict[str, str]], prompt=None
+    model: str, messages: List[Dict[str, str]], prompt=None, priority: int = INTERACTIVE
 ) -> List[Dict[str, str]]:
-    response = complete_with_messages(model, messages, prompt)
+    response = complete_with_messages(model, messages, prompt, priority)
     messages.append({"role": "assistant", "content": response})
     return messages
@@ -1,82 +1,57 @@
+import os
+import copy
+import functools
 import json
 import logging
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from jarvis.smartgpt import actions
+from jarvis.smartgpt import checkpoint
+from jarvis.smartgpt import dataflow
+from jarvis.smartgpt import ir
 from jarvis.smartgpt import jvm
+from jarvis.smartgpt import profiler as profiling
 from jarvis.smartgpt import utils
+from jarvis.smartgpt import expression as restricted
 
 
 class JVMInstruction:
-    def __init__(self, instruction, act, task):
+    def __init__(self, instruction, act, task, context=None, op=None):
         self.instruction = instruction
         self.act = act
         self.task = task
+        self.context = context
+        # the compiled instruction, compiled on demand if not given
+        self.op = op
 
     def execute(self):
-        action_type = self.instruction.get("type")
-
-        action_class = self.act.get(action_type)
-        if action_class is None:
-            print(f"Unknown action type: {action_type}")
-            return
-
-        action_id = self.instruction.get("seq")
-        # clone the args dict!
-        args = dict(self.instruction.get("args"))
-
-        if action_type == "WebSearch":
-            args["query"] = self.eval_and_patch(args["query"])
-            args["save_to"] = self.eval_and_patch(args["save_to"])
-
-        if action_type == "FetchWebContent":
-            args["url"] = self.eval_and_patch(args["url"])
-            args["save_to"] = self.eval_and_patch(args["save_to"])
-
-        if action_type == "RunPython":
-            # if file_name is empty, use the default file
-            file_name = args.get("file_name")
-            if file_name is None or file_name == "":
-                args["file_name"] = f"tmp_{action_id}.py"
-            # if timeout is empty, use the default timeout
-            timeout = args.get("timeout")
-            if timeout is None or timeout == "":
-                args["timeout"] = 30
-
-        if action_type == "TextCompletion":
-            args["request"] = self.eval_and_patch(args.get("request"))
-            args["content"] = self.eval_and_patch(args.get("content"))
-            args["output_format"] = self.eval_and_patch(
-                json.dumps(args.get("output_format"), indent=2)
-            )
-
-        action_data = {"type": action_type, "action_id": action_id}
-        action_data.update(args)
-
-        action = actions.Action.from_dict(action_data)
-        if action is None:
-            print(f"Failed to create action from data: {action_data}")
+        if self.context is None:
+            return self._execute()
+        with jvm.use_context(self.context):
+            return self._execute()
+
+    def _execute(self):
+        op = self.op or ir.compile_instruction(self.instruction, self.act)
+        if op.action_class is None:
+            print(f"Unknown action type: {op.action_type}")
             return
 
+        action = op.build()
         logging.info(f"Running action: {action}\n")
         result = action.run()
-        logging.info(f"\nresult of {action_type}: {result}\n")
+        logging.info(f"\nresult of {op.action_type}: {result}\n")
 
-        if action_type != "RunPython":
+        if op.action_type != "RunPython":
             self.post_exec(result)
         else:
-            jvm.load_kv_store()
+            jvm.refresh_kv_store()
 
     def eval_and_patch(self, text) -> str:
         if text is None:
             return ""
 
-        while True:
-            tmp_text = jvm.eval(text)
-            if tmp_text is None:
-                break
-            text = tmp_text
-
-        return text
+        return jvm.eval_all(text)
 
     def post_exec(self, result: str):
         try:
@@ -104,75 +79,295 @@ class JVMInstruction:
 
 
 class JVMInterpreter:
-    def __init__(self):
-        self.pc = 0
+    def __init__(self, context=None, max_workers=None, loop_fanout=None, profiler=None):
+        self.context = context or jvm.current_context()
+        # records a span for every instruction and loop iteration, if given
+        self.profiler = profiler
+        # independent basic instructions run concurrently on this many threads
+        if max_workers is None:
+            max_workers = int(os.getenv("JVM_MAX_WORKERS", "4"))
+        self.max_workers = max_workers
+        # iterations of independent loops run concurrently, up to this many at once
+        if loop_fanout is None:
+            loop_fanout = int(os.getenv("JVM_LOOP_FANOUT", "4"))
+        self.loop_fanout = loop_fanout
+        # compiled programs by the id of their instruction list
+        self.programs = {}
+        # the position of the running instruction, one frame per nested instruction list
+        self.frames = []
+        self.checkpoint = checkpoint.Checkpoint(
+            os.path.join(self.context.workdir, checkpoint.CHECKPOINT_FILE)
+        )
+        self.task_key = None
         self.actions = {
             "WebSearch": actions.WebSearchAction,
             "FetchWebContent": actions.FetchWebContentAction,
+            "FetchWebContents": actions.FetchWebContentsAction,
             "RunPython": actions.RunPythonAction,
             "TextCompletion": actions.TextCompletionAction,
         }
 
-        jvm.load_kv_store()
-        actions.disable_cache()
-        actions.load_cache()
-        jvm.set_loop_idx(0)
-
-    def run(self, instrs, task):
-        if instrs is not None:
-            while self.pc < len(instrs):
-                logging.info(
-                    f"Running Instruction [pc={self.pc}, seq={instrs[self.pc].get('seq')}]: \n{instrs[self.pc]}"
-                )
-                jvm_instruction = JVMInstruction(instrs[self.pc], self.actions, task)
-
-                action_type = instrs[self.pc].get("type")
-                if action_type == "If":
-                    self.conditional(jvm_instruction)
-                elif action_type == "Loop":
-                    self.loop(jvm_instruction)
+        self.context.load()
+        # results are cached by their full inputs, so the cache is safe to share between tasks
+        if os.getenv("JVM_ACTION_CACHE", "false").lower() == "true":
+            actions.enable_cache()
+            actions.load_cache()
+        else:
+            actions.disable_cache()
+        self.reset_idx()
+
+    @property
+    def pc(self):
+        return self.frames[-1]["pc"] if self.frames else 0
+
+    def run(self, instrs, task, resume=False):
+        """Runs instrs, or with `resume` continues after the last checkpoint of them."""
+        program = self.compile(instrs)
+        self.task_key = checkpoint.task_key(instrs, task)
+        path = self.resume_path() if resume else None
+
+        self.frames = []
+        try:
+            with self.span("task", "task", task=task, resume=path is not None):
+                self.run_program(program, task, path)
+        except Exception as err:
+            # the checkpoint points at the failed instruction, record the
+            # generation its partial writes left the store at
+            self.save_checkpoint(error=str(err))
+            self.frames = []
+            raise
+        self.checkpoint.clear()
+
+    def resume_path(self):
+        state = self.checkpoint.load()
+        if state is None or state.get("task") != self.task_key:
+            logging.info("No checkpoint of this task, running it from the start")
+            return None
+        if state.get("generation") != self.context.generation():
+            logging.warning(
+                "The kv store changed since the checkpoint, running the task from the start"
+            )
+            return None
+        logging.info(f"Resuming the task at {state['path']}")
+        return state["path"]
+
+    def span(self, name, category, parent=None, **args):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.span(name, category, parent, **args)
+
+    def instruction_span(self, op, pc, parent=None):
+        return self.span(
+            op.instruction.get("type", "Unknown"), "instruction", parent, pc=pc, seq=op.seq
+        )
+
+    def save_checkpoint(self, **extra):
+        if self.checkpoint is None or self.task_key is None:
+            return
+        state = {
+            "task": self.task_key,
+            "path": copy.deepcopy(self.frames),
+            "generation": self.context.generation(),
+        }
+        state.update(extra)
+        self.checkpoint.save(state)
+
+    def reset_idx(self):
+        # keep a pending checkpoint valid across this bookkeeping write
+        state = self.checkpoint.load()
+        if state is not None and state.get("generation") != self.context.generation():
+            state = None
+        self.context.set("idx", 0)
+        if state is not None:
+            state["generation"] = self.context.generation()
+            self.checkpoint.save(state)
+
+    def compile(self, instrs):
+        """Compiles instrs once, later runs of the same list reuse the program."""
+        if instrs is None:
+            return ()
+        compiled = self.programs.get(id(instrs))
+        # the list is kept with its program so its id can not be reused
+        if compiled is None or compiled[0] is not instrs:
+            compiled = (instrs, ir.compile_program(instrs, self.actions))
+            self.programs[id(instrs)] = compiled
+        return compiled[1]
+
+    def run_program(self, program, task, path=None):
+        """Runs program, starting at the position `path` leads to, if given."""
+        frame = {"pc": 0}
+        resume = None
+        if path:
+            resume = dict(path[0])
+            frame["pc"] = resume.pop("pc")
+
+        self.frames.append(frame)
+        with jvm.use_context(self.context):
+            self._run(program, task, resume, path[1:] if path else None)
+        # on errors the frames are kept, they point at the failed instruction
+        self.frames.pop()
+
+    def _run(self, program, task, resume=None, inner_path=None):
+        frame = self.frames[-1]
+        while frame["pc"] < len(program):
+            done = resume.get("done") if resume else None
+            batch = self.concurrent_batch(program)
+            if len(batch) > 1 and (self.max_workers > 1 or done):
+                self.run_concurrently(batch, task, done or ())
+                frame["pc"] += len(batch)
+                frame.pop("done", None)
+                self.save_checkpoint()
+                resume = inner_path = None
+                continue
+
+            op = program[frame["pc"]]
+            logging.info(
+                f"Running Instruction [pc={frame['pc']}, seq={op.seq}]: \n{op.instruction}"
+            )
+            with self.instruction_span(op, frame["pc"]):
+                if isinstance(op, ir.IfOp):
+                    self.conditional(op, task, resume, inner_path)
+                elif isinstance(op, ir.LoopOp):
+                    self.loop(op, task, resume, inner_path)
                 else:
-                    jvm_instruction.execute()
-                self.pc += 1
-
-    def loop(self, jvm_instruction: JVMInstruction):
-        args = jvm_instruction.instruction.get("args", {})
-        # Extract the count and the list of instructions for the loop
-        loop_count = 0
-        # if loop_count is integer
+                    JVMInstruction(
+                        op.instruction, self.actions, task, self.context, op
+                    ).execute()
+            frame["pc"] += 1
+            frame.pop("branch", None)
+            frame.pop("iteration", None)
+            self.save_checkpoint()
+            resume = inner_path = None
+
+    def concurrent_batch(self, program):
+        """Returns the run of basic instructions starting at pc."""
+        end = self.pc
+        while end < len(program) and program[end].concurrent:
+            end += 1
+        return program[self.pc : end]
+
+    def run_concurrently(self, ops, task, done=()):
         logging.info(
-            f"loop instruction (seq={jvm_instruction.instruction.get('seq', 'N/A')}) args: {args}"
+            f"Running Instructions [pc={self.pc}, seq={[op.seq for op in ops]}] "
+            f"on up to {self.max_workers} workers"
+        )
+        frame = self.frames[-1]
+        frame["done"] = sorted(done)
+
+        def on_done(index):
+            frame["done"].append(index)
+            self.save_checkpoint()
+
+        parent = profiling.current_span()
+
+        def job(pc, op):
+            with self.instruction_span(op, pc, parent):
+                JVMInstruction(
+                    op.instruction, self.actions, task, self.context, op
+                ).execute()
+
+        jobs = [
+            jvm.bind_current(functools.partial(job, frame["pc"] + offset, op))
+            for offset, op in enumerate(ops)
+        ]
+        dataflow.run_graph(
+            jobs, [op.effects for op in ops], max(self.max_workers, 1), done, on_done
         )
-        if isinstance(args["count"], int):
-            loop_count = args["count"]
-        elif isinstance(args["count"], str):
-            if args["count"].isdigit():
-                loop_count = int(args["count"])
+
+    def loop(self, op: ir.LoopOp, task, resume=None, inner_path=None):
+        logging.info(
+            f"loop instruction (seq={op.instruction.get('seq', 'N/A')}) args: {op.instruction.get('args')}"
+        )
+        loop_count = op.count
+        if isinstance(loop_count, str):
+            # loop_count needs to be evaluated in the context of jvm
+            loop_count = jvm.eval(loop_count)
+            if loop_count is None:
+                loop_count = 0
             else:
-                # loop_count needs to be evaluated in the context of jvm
-                loop_count = jvm.eval(args["count"])
-                if loop_count is None:
-                    loop_count = 0
-                else:
-                    loop_count = int(loop_count)
+                loop_count = int(loop_count)
 
-        loop_instructions = args.get("instructions", [])
-        logging.debug(f"Looping: {loop_instructions}")
+        start = resume.get("iteration", 0) if resume else 0
+        if self.loop_fanout > 1 and loop_count - start > 1 and op.independent:
+            self.run_iterations_concurrently(op.body, start, loop_count, task)
+            return
 
-        # Execute the loop instructions the given number of times
-        old_pc = self.pc
-        for i in range(loop_count):
+        frame = self.frames[-1]
+        for i in range(start, loop_count):
             # Set the loop index in jvm, to adopt gpt behaviour error
             jvm.set_loop_idx(i)
-            # logging.info(f"loop idx: {i}")
-            # As each loop execution should start from the first instruction, we reset the program counter
-            self.pc = 0
-            self.run(loop_instructions, jvm_instruction.task)
-        self.pc = old_pc
+            frame["iteration"] = i
+            # As each loop execution should start from the first instruction
+            with self.span("iteration", "iteration", idx=i):
+                self.run_program(op.body, task, inner_path if i == start else None)
+
+    def run_iterations_concurrently(self, body, start, loop_count, task):
+        """Runs loop iterations concurrently, each with its own scope.
+
+        The writes of every iteration are kept in its scope and committed to
+        the store in iteration order, as a sequential loop would have made
+        them. If an iteration fails, only the iterations before it are
+        committed.
+        """
+        logging.info(
+            f"Running {loop_count - start} loop iterations on up to {self.loop_fanout} workers"
+        )
+        scopes = [{"idx": i} for i in range(start, loop_count)]
+        parent = profiling.current_span()
+
+        def iteration(scope):
+            # every iteration has its own position and does not checkpoint
+            interpreter = copy.copy(self)
+            interpreter.frames = []
+            interpreter.checkpoint = None
+            with jvm.use_scope(scope), self.span(
+                "iteration", "iteration", parent, idx=scope["idx"]
+            ):
+                interpreter.run_program(body, task)
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.loop_fanout, len(scopes)),
+            thread_name_prefix="jvm-loop",
+        ) as pool:
+            futures = [pool.submit(jvm.bind_current(iteration), s) for s in scopes]
+            wait(futures)
+
+        failed = next((i for i, f in enumerate(futures) if f.exception()), None)
+        committed = len(scopes) if failed is None else failed
+        for scope in scopes[:committed]:
+            jvm.set_loop_idx(scope["idx"])
+            for key, value in scope.items():
+                if key != "idx":
+                    jvm.set(key, value)
+
+        if failed is not None:
+            jvm.set_loop_idx(start + failed)
+            self.frames[-1]["iteration"] = start + failed
+            raise futures[failed].exception()
+
+    def conditional(self, op: ir.IfOp, task, resume=None, inner_path=None):
+        frame = self.frames[-1]
+        if resume and "branch" in resume:
+            # the condition was evaluated before the checkpoint
+            condition_eval_result = resume["branch"] == "then"
+        else:
+            condition_eval_result = self.evaluate_condition(op)
+            frame["branch"] = "then" if condition_eval_result else "else"
+            self.save_checkpoint()
+            inner_path = None
 
-    def conditional(self, jvm_instruction: JVMInstruction):
-        condition = jvm_instruction.instruction.get("args", {}).get("condition", None)
-        condition = jvm_instruction.eval_and_patch(condition)
+        # maybe use pc to jump is a better idea.
+        self.run_program(op.then if condition_eval_result else op.orelse, task, inner_path)
+
+    def evaluate_condition(self, op: ir.IfOp) -> bool:
+        condition = op.condition
+        if isinstance(condition, ir.Template):
+            condition = condition.render()
+
+        decided = restricted.decide_condition(condition)
+        if decided is not None:
+            logging.info(f"The condition is decided locally to {decided}.")
+            return decided
 
         evaluation_action = actions.TextCompletionAction(
             action_id=-1,
@@ -195,24 +390,9 @@ class JVMInterpreter:
             raise
 
         logging.info(f"The condition is evaluated to {condition_eval_result}.")
-
-        old_pc = self.pc
-        if condition_eval_result:
-            # instruction.instruction["then"] is a list of instructions
-            if "then" in jvm_instruction.instruction.get("args", {}):
-                self.pc = 0
-                self.run(
-                    jvm_instruction.instruction["args"]["then"], jvm_instruction.task
-                )
-        else:
-            # maybe use pc to jump is a better idea.
-            if "else" in jvm_instruction.instruction.get("args", {}):
-                self.pc = 0
-                self.run(
-                    jvm_instruction.instruction["args"]["else"], jvm_instruction.task
-                )
-        self.pc = old_pc
+        return condition_eval_result
 
     def reset(self):
-        self.pc = 0
-        jvm.set_loop_idx(0)
+        self.frames = []
+        self.programs.clear()
+        self.reset_idx()
@@ -0,0 +1,290 @@
+"""Compiled form of JVM instructions.
+
+The interpreter compiles the YAML instruction list of a task once. Compiling
+validates the instructions, resolves their action classes and the constructor
+arguments those take, applies the interpreter's defaults and classifies every
+argument as a constant or a template to evaluate. Templates whose evaluations
+do not touch the jvm are folded into constants, the expressions of the others
+are compiled. Running an instruction, e.g. on every loop iteration, then only
+calls the compiled expressions of its dynamic templates.
+"""
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Tuple, Union
+
+from jarvis.smartgpt import actions
+from jarvis.smartgpt import dataflow
+from jarvis.smartgpt import jvm
+from jarvis.smartgpt import expression as restricted
+
+# arguments evaluated before creating the action, in evaluation order
+TEMPLATE_ARGS = {
+    "WebSearch": ("query", "save_to"),
+    "FetchWebContent": ("url", "save_to"),
+    "FetchWebContents": ("urls", "save_to"),
+    "TextCompletion": ("request", "content", "output_format"),
+}
+
+
+@dataclass(frozen=True)
+class Template:
+    """An argument with evaluations, rendered when the instruction runs.
+
+    The text is split around its evaluations and their expressions are
+    compiled once, so rendering only calls them and joins the pieces. Nested
+    evaluations, "jvm.get(" texts and expressions that fail to compile are
+    rendered with jvm.eval_all, as are the renderings that fail or bring in
+    new evaluations, so the result is always the same as jvm.eval_all's.
+    """
+
+    text: str
+    # the text between the evaluations, None to render with jvm.eval_all
+    pieces: Optional[Tuple[str, ...]] = field(default=None, init=False, compare=False, repr=False)
+    evaluations: Tuple[Callable[[], Any], ...] = field(default=(), init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.text.startswith("jvm.get("):
+            return
+        found = _evaluations(self.text)
+        if not found:
+            return
+        try:
+            evaluations = tuple(jvm.compile_expression(expression) for _, _, expression in found)
+        except Exception:
+            return
+        pieces = []
+        last = 0
+        for start, end, _ in found:
+            pieces.append(self.text[last:start])
+            last = end + 1
+        pieces.append(self.text[last:])
+        object.__setattr__(self, "pieces", tuple(pieces))
+        object.__setattr__(self, "evaluations", evaluations)
+
+    def render(self):
+        if self.pieces is None:
+            return jvm.eval_all(self.text)
+        values = []
+        # right to left, like jvm.eval_all
+        for evaluate in reversed(self.evaluations):
+            try:
+                values.append(str(evaluate()))
+            except Exception:
+                return jvm.eval_all(self.text)
+        values.reverse()
+        parts = [self.pieces[0]]
+        for value, piece in zip(values, self.pieces[1:]):
+            parts.append(value)
+            parts.append(piece)
+        rendered = "".join(parts)
+        if jvm.LAZY_EVAL_PREFIX in rendered or rendered.startswith("jvm.get("):
+            # a value brought in another evaluation
+            return jvm.eval_all(self.text)
+        return rendered
+
+
+@dataclass(frozen=True)
+class ActionOp:
+    instruction: dict
+    seq: Any
+    action_type: str
+    # None for unknown action types, which are skipped like before
+    action_class: Optional[type]
+    # constructor arguments, each a constant or a Template
+    args: Tuple[Tuple[str, Any], ...]
+    effects: dataflow.Effects
+
+    @property
+    def concurrent(self) -> bool:
+        return self.action_type in dataflow.CONCURRENT_ACTIONS
+
+    def build(self):
+        kwargs = {
+            name: value.render() if isinstance(value, Template) else value
+            for name, value in self.args
+        }
+        return self.action_class(action_id=self.seq, **kwargs)
+
+
+@dataclass(frozen=True)
+class LoopOp:
+    instruction: dict
+    seq: Any
+    # a constant count, or the text evaluated with jvm.eval
+    count: Union[int, str]
+    body: Tuple["Op", ...]
+    # whether the iterations write disjoint keys and may run concurrently
+    independent: bool
+
+    concurrent = False
+
+
+@dataclass(frozen=True)
+class IfOp:
+    instruction: dict
+    seq: Any
+    condition: Union[str, Template]
+    then: Tuple["Op", ...]
+    orelse: Tuple["Op", ...]
+
+    concurrent = False
+
+
+Op = Union[ActionOp, LoopOp, IfOp]
+
+
+def compile_program(instructions, action_classes) -> Tuple[Op, ...]:
+    if instructions is None:
+        return ()
+    return tuple(compile_instruction(instr, action_classes) for instr in instructions)
+
+
+def compile_instruction(instruction: dict, action_classes) -> Op:
+    action_type = instruction.get("type")
+    seq = instruction.get("seq")
+    args = instruction.get("args") or {}
+
+    if action_type == "Loop":
+        if "count" not in args:
+            raise ValueError(f"Loop instruction (seq={seq}) has no count")
+        body = args.get("instructions", [])
+        return LoopOp(
+            instruction,
+            seq,
+            _loop_count(args["count"]),
+            compile_program(body, action_classes),
+            dataflow.independent_iterations(body or []),
+        )
+
+    if action_type == "If":
+        return IfOp(
+            instruction,
+            seq,
+            template(args.get("condition")),
+            compile_program(args.get("then"), action_classes),
+            compile_program(args.get("else"), action_classes),
+        )
+
+    action_class = action_classes.get(action_type)
+    if action_class is None:
+        return ActionOp(instruction, seq, action_type, None, (), dataflow.BARRIER)
+
+    args = dict(args)
+    if action_type == "RunPython":
+        # if timeout is empty, use the default timeout
+        if args.get("timeout") is None or args.get("timeout") == "":
+            args["timeout"] = 30
+    if action_type == "TextCompletion":
+        args.setdefault("request", None)
+        args.setdefault("content", None)
+        args["output_format"] = json.dumps(args.get("output_format"), indent=2)
+
+    templates = TEMPLATE_ARGS.get(action_type, ())
+    compiled = []
+    for name, param in actions.action_params(action_class).items():
+        if name in ("self", "action_id"):
+            continue
+        if name not in args:
+            if param.default is param.empty:
+                raise ValueError(
+                    f"{action_type} instruction (seq={seq}) has no argument {name}"
+                )
+            continue
+        value = args[name]
+        if name in templates:
+            value = template(value)
+        compiled.append((name, value))
+    # keep the evaluation order of the templates
+    compiled.sort(key=lambda arg: templates.index(arg[0]) if arg[0] in templates else -1)
+
+    return ActionOp(
+        instruction,
+        seq,
+        action_type,
+        action_class,
+        tuple(compiled),
+        dataflow.analyze(instruction),
+    )
+
+
+def template(value):
+    """Returns value as a constant, or as a Template if it has evaluations."""
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        return value
+    if not value.startswith("jvm.get(") and jvm.LAZY_EVAL_PREFIX not in value:
+        return value
+
+    evaluations = _evaluations(value)
+    if value.startswith("jvm.get(") or evaluations is None:
+        return Template(value)
+
+    # compiling without the jvm rejects any expression that reads it, nothing is run yet
+    try:
+        compiled = [
+            restricted.compile_expression(expression, allow_jvm=False)
+            for _, _, expression in evaluations
+        ]
+    except (SyntaxError, restricted.UnsupportedExpression):
+        return Template(value)
+
+    # nothing reads the jvm, the result is the same on every run
+    pieces = []
+    last = 0
+    for (start, end, _), evaluate in zip(evaluations, compiled):
+        try:
+            evaluated = evaluate()
+        except Exception:
+            # left to the run, which reports the error
+            return Template(value)
+        pieces.append(value[last:start])
+        pieces.append(str(evaluated))
+        last = end + 1
+    pieces.append(value[last:])
+    folded = "".join(pieces)
+    if folded.startswith("jvm.get(") or jvm.LAZY_EVAL_PREFIX in folded:
+        return Template(value)
+    logging.debug(f"Folded {value} into {folded}")
+    return folded
+
+
+def _evaluations(text: str):
+    """Returns the start, closing parenthesis and expression of the evaluations in text.
+
+    Returns None if they are nested or unbalanced.
+    """
+    evaluations = []
+    prefix_len = len(jvm.LAZY_EVAL_PREFIX)
+    start = text.find(jvm.LAZY_EVAL_PREFIX)
+    while start >= 0:
+        # match parentheses the way jvm.eval_all does
+        balance = 0
+        end = None
+        for index in range(start + prefix_len, len(text)):
+            if text[index] == "(":
+                balance += 1
+            elif text[index] == ")":
+                if balance == 0:
+                    end = index
+                    break
+                balance -= 1
+        if end is None:
+            return None
+        expression = text[start + prefix_len : end]
+        if jvm.LAZY_EVAL_PREFIX in expression:
+            return None
+        evaluations.append((start, end, expression.strip()))
+        start = text.find(jvm.LAZY_EVAL_PREFIX, end)
+    return evaluations
+
+
+def _loop_count(count):
+    if isinstance(count, int):
+        return count
+    if isinstance(count, str):
+        if count.isdigit():
+            return int(count)
+        return count
+    return 0
@@ -1,80 +1,289 @@
 import os
+import re
 import ast
-import logging
 import json
+import logging
+import functools
+import threading
+from contextlib import contextmanager
 
 from jarvis.smartgpt import utils
+from jarvis.smartgpt import kvstore
+from jarvis.smartgpt import profiler
+from jarvis.smartgpt import expression as restricted
+
+# RunPython scripts are pointed at the store of their executor by JVM_KV_STORE_PATH,
+# otherwise the store is resolved against the current working directory
+kv_store_file = os.getenv("JVM_KV_STORE_PATH", "kv_store.json")
+kv_store_engine = kvstore.default_engine()
+
+
+class JVMContext:
+    """The context database of one executor.
+
+    A context owns its store (absolute path, engine and decoded values cache),
+    the blob files large values are spilled to, and a lock, so several
+    executors can run in parallel threads of one process. The module level
+    functions used by the instructions (`jvm.get`, `jvm.set`, ...) operate on
+    the context bound to the current thread.
+    """
+
+    def __init__(self, path=None, engine=None):
+        self.path = os.path.abspath(path or kv_store_file)
+        self.engine = engine or kv_store_engine
+        self.lock = threading.RLock()
+        self.blobs = kvstore.BlobStore(
+            os.path.splitext(self.path)[0] + ".blobs", **kvstore.blob_options()
+        )
+        self._store = None
+
+    @property
+    def store(self) -> kvstore.KVStore:
+        with self.lock:
+            if self._store is None:
+                self._store = kvstore.open_store(
+                    self.engine, self.path, **kvstore.engine_options(self.engine)
+                )
+                self._store.load()
+            return self._store
+
+    @property
+    def workdir(self) -> str:
+        return os.path.dirname(self.path)
+
+    def env(self) -> dict:
+        """Environment variables pointing a child process at this context."""
+        return {"JVM_KV_STORE_PATH": self.path, "JVM_KV_STORE_ENGINE": self.engine}
+
+    def load(self):
+        with self.lock:
+            self.store.load()
+
+    def refresh(self):
+        with self.lock:
+            self.store.refresh()
+
+    def reset(self):
+        with self.lock:
+            self.store.reset()
+            self.blobs.clear()
+
+    def generation(self):
+        with self.lock:
+            return self.store.generation()
+
+    def compact(self):
+        with self.lock:
+            if isinstance(self.store, kvstore.WALStore):
+                self.store.compact()
+            # drop the blobs of values that have been overwritten since
+            live_refs = [
+                value
+                for _, value in self.store.items_with_prefix("")
+                if kvstore.is_blob_ref(value)
+            ]
+            self.blobs.collect(live_refs)
+
+    def close(self):
+        with self.lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+    def get(self, key, default=None):
+        try:
+            with self.lock:
+                value = self.store.get(key, None)
+            if value is None:
+                return default
+            value = self.blobs.resolve(value)
+            if profiler.active():
+                profiler.record(profiler.KV_BYTES_READ, _value_size(value))
+            return _decode(value)
+        except Exception as err:
+            logging.fatal(f"get, An error occurred: {err}")
+            return default
+
+    def set(self, key, value):
+        try:
+            encoded = kvstore.encode_value(value)
+            if profiler.active():
+                profiler.record(profiler.KV_BYTES_WRITTEN, _value_size(encoded))
+            with self.lock:
+                self.store.set(key, self.blobs.spill(encoded))
+        except Exception as err:
+            logging.fatal(f"set, An error occurred: {err}")
+
+    def list_values_with_key_prefix(self, prefix):
+        try:
+            with self.lock:
+                items = self.store.items_with_prefix(prefix)
+            values = []
+            for key, value in items:
+                try:
+                    value = self.blobs.resolve(value)
+                    if profiler.active():
+                        profiler.record(profiler.KV_BYTES_READ, _value_size(value))
+                    values.append(_decode(value))
+                except Exception as err:
+                    logging.fatal(f"list_values_with_key_prefix, key {key}: {err}")
+                    values.append(None)
+            return values
+        except Exception as err:
+            logging.fatal(f"list_values_with_key_prefix, An error occurred: {err}")
+            return []
+
+    def list_keys_with_prefix(self, prefix):
+        try:
+            with self.lock:
+                return self.store.keys_with_prefix(prefix)
+        except Exception as err:
+            logging.fatal(f"list_keys_with_prefix, An error occurred: {err}")
+            return []
+
+
+_local = threading.local()
+_default_context = None
+_default_context_lock = threading.Lock()
+
+
+def default_context() -> JVMContext:
+    # the default context follows the working directory, as the store file used to
+    global _default_context
+    with _default_context_lock:
+        path = os.path.abspath(kv_store_file)
+        if _default_context is None or _default_context.path != path:
+            if _default_context is not None:
+                _default_context.close()
+            _default_context = JVMContext(path)
+        return _default_context
+
+
+def current_context() -> JVMContext:
+    context = getattr(_local, "context", None)
+    if context is None:
+        return default_context()
+    return context
+
 
-# initialize a dictionary when the module is imported
-kv_store_file = "kv_store.json"
-kv_store = {}
+@contextmanager
+def use_context(context: JVMContext):
+    """Bind `context` to the current thread for the module level functions."""
+    previous = getattr(_local, "context", None)
+    _local.context = context
+    try:
+        yield context
+    finally:
+        _local.context = previous
 
 
 def reset_kv_store():
-    global kv_store
-    kv_store = {}
-    save_kv_store()
+    current_context().reset()
 
 
 def load_kv_store():
-    global kv_store
-    # Load the kv_store dictionary from the file if it exists
-    if os.path.exists(kv_store_file):
-        with open(kv_store_file, "r") as f:
-            kv_store = json.load(f)
-    else:
-        kv_store = {}
+    # Load the kv_store from the snapshot and write-ahead log if they exist
+    current_context().load()
 
 
-def save_kv_store():
-    with open(kv_store_file, "w") as f:
-        json.dump(kv_store, f)
+def refresh_kv_store():
+    # Merge only the changes made by another process, e.g. a RunPython script
+    current_context().refresh()
 
 
-def get(key, default=None):
+def compact_kv_store():
+    current_context().compact()
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_list_literal(text):
+    return tuple(ast.literal_eval(text))
+
+
+def _decode(value):
+    if isinstance(value, str) and value.startswith("[") and value.endswith("]"):
+        # This is a list saved as repr() by older versions, parse it only once
+        return list(_parse_list_literal(value))
+    return _copy(kvstore.decode_value(value))
+
+
+def _value_size(value) -> int:
+    # the size of a stored value, as counted by the profiler
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return len(json.dumps(value, default=str).encode("utf-8"))
+
+
+def _copy(value):
+    # hand out copies so that callers can not mutate the stored value
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+def current_scope():
+    return getattr(_local, "scope", None)
+
+
+@contextmanager
+def use_scope(scope: dict):
+    """Layer iteration-local bindings over the current context.
+
+    While a scope is bound, jvm.set writes into it and jvm.get reads from it
+    first, so concurrent loop iterations each see their own "idx" and their
+    own results until the loop commits them to the store.
+    """
+    previous = current_scope()
+    _local.scope = scope
     try:
-        value = kv_store.get(key, None)
-        if value is None:
-            return default
-        if isinstance(value, str) and value.startswith("[") and value.endswith("]"):
-            # This is a list
-            return list(ast.literal_eval(value))
-        return value
-    except Exception as err:
-        logging.fatal(f"get, An error occurred: {err}")
-        return default
+        yield scope
+    finally:
+        _local.scope = previous
+
+
+def bind_current(func):
+    """Wrap func so it runs with the context and scope of the calling thread."""
+    context = current_context()
+    scope = current_scope()
+
+    def run(*args, **kwargs):
+        with use_context(context), use_scope(scope):
+            return func(*args, **kwargs)
+
+    return run
+
+
+def get(key, default=None):
+    scope = current_scope()
+    if scope is not None and key in scope:
+        return _copy(scope[key])
+    return current_context().get(key, default)
 
 
 def set(key, value):
-    try:
-        if isinstance(value, list):
-            value = repr(value)
-        kv_store[key] = value
-        save_kv_store()
-    except Exception as err:
-        logging.fatal(f"set, An error occurred: {err}")
+    scope = current_scope()
+    if scope is not None:
+        scope[key] = _copy(value)
+        return
+    current_context().set(key, value)
 
 
 def list_values_with_key_prefix(prefix):
-    try:
-        values = []
-        for key in kv_store.keys():
-            if key.startswith(prefix):
-                values.append(get(key))
-        # logging.info(f"list_values_with_key_prefix, values: {values}")
-        return values
-    except Exception as err:
-        logging.fatal(f"list_values_with_key_prefix, An error occurred: {err}")
-        return []
+    scope = current_scope()
+    if not scope or not any(key.startswith(prefix) for key in scope):
+        return current_context().list_values_with_key_prefix(prefix)
+    return [get(key) for key in list_keys_with_prefix(prefix)]
 
 
 def list_keys_with_prefix(prefix):
-    try:
-        keys = [key for key in kv_store.keys() if key.startswith(prefix)]
+    keys = current_context().list_keys_with_prefix(prefix)
+    scope = current_scope()
+    if not scope:
         return keys
-    except Exception as err:
-        logging.fatal(f"list_keys_with_prefix, An error occurred: {err}")
-        return []
+    local = [key for key in scope if key.startswith(prefix)]
+    return [key for key in keys if key not in scope] + local
 
 
 def set_loop_idx(value):
@@ -82,52 +291,95 @@ def set_loop_idx(value):
 
 
 LAZY_EVAL_PREFIX = "jvm.eval("
+# longer texts are mostly patched results holding fetched content, they are not cached
+TEMPLATE_CACHE_MAX_LEN = 4096
+_UNBALANCED = "unbalanced"
 
 
-def eval(text, lazy_eval_prefix=LAZY_EVAL_PREFIX):
-    if not isinstance(text, str):
-        return text
+def eval_strict() -> bool:
+    # expressions outside the restricted subset are rejected, unless this is turned off
+    return os.getenv("JVM_EVAL_STRICT", "true").lower() == "true"
 
-    if not text.startswith("jvm.get("):
-        # find last occurrence of "jvm.eval("
-        start = text.rfind(lazy_eval_prefix)
-        if start == -1:
-            return None
-        prefix_len = len(lazy_eval_prefix)
-        # find the corresponding closing tag with parentheses balance
-        rest = text[start + prefix_len :]
-        balance = 0
-        end = 0
-        for char in rest:
-            if char == "(":
-                balance += 1
-            elif char == ")":
-                if balance == 0:
-                    break
-                balance -= 1
-            end += 1
 
-        if balance != 0:
-            logging.critical(f"Error: parentheses are not balanced in {text}")
-            return None
+@functools.lru_cache(maxsize=1024)
+def compile_expression(expression):
+    """Compiles the expression of a jvm.eval into a function evaluating it.
+
+    Raises UnsupportedExpression for expressions outside the restricted subset
+    in strict mode, and SyntaxError for invalid ones.
+    """
+    try:
+        return restricted.compile_expression(expression)
+    except restricted.UnsupportedExpression as err:
+        if eval_strict():
+            raise
+        logging.warning(f"Evaluating {expression} outside the sandbox: {str(err)}")
+
+    code = compile(expression, "<jvm.eval>", "eval")
+    return lambda: utils.sys_eval(code)
+
+
+@functools.lru_cache(maxsize=1024)
+def _cached_parse_template(text, lazy_eval_prefix):
+    return _parse_template(text, lazy_eval_prefix)
 
-        logging.debug(
-            f"eval_and_patch_template_before_exec, {start}-{end} text: {text}\n"
-        )
 
-        # adjust the end position relative to the original string
-        end = end + start + prefix_len
-        # evaluate the substring between jvm.eval( and )
-        expression = text[start + prefix_len : end].strip()
+def _parse_template(text, lazy_eval_prefix):
+    """Splits text around the last lazy evaluation.
+
+    Returns (start, end, expression) where text[start:end + 1] is replaced by
+    the value of expression, None if there is nothing to evaluate, or
+    _UNBALANCED if the parentheses of the last evaluation are not balanced.
+    """
+    if text.startswith("jvm.get("):
+        return 0, len(text), text.strip()
+
+    # find last occurrence of "jvm.eval("
+    start = text.rfind(lazy_eval_prefix)
+    if start == -1:
+        return None
+    prefix_len = len(lazy_eval_prefix)
+    # find the corresponding closing tag with parentheses balance
+    rest = text[start + prefix_len :]
+    balance = 0
+    end = 0
+    for char in rest:
+        if char == "(":
+            balance += 1
+        elif char == ")":
+            if balance == 0:
+                break
+            balance -= 1
+        end += 1
+
+    if balance != 0:
+        return _UNBALANCED
+
+    # adjust the end position relative to the original string
+    end = end + start + prefix_len
+    # evaluate the substring between jvm.eval( and )
+    return start, end, text[start + prefix_len : end].strip()
+
+
+def eval(text, lazy_eval_prefix=LAZY_EVAL_PREFIX):
+    if not isinstance(text, str):
+        return text
+
+    if len(text) <= TEMPLATE_CACHE_MAX_LEN:
+        template = _cached_parse_template(text, lazy_eval_prefix)
     else:
-        start = 0
-        end = len(text)
-        prefix_len = 0
+        template = _parse_template(text, lazy_eval_prefix)
+
+    if template is None:
+        return None
+    if template is _UNBALANCED:
+        logging.critical(f"Error: parentheses are not balanced in {text}")
+        return None
 
-    expression = text[start + prefix_len : end].strip()
+    start, end, expression = template
     logging.debug(f"eval_and_patch_template_before_exec, expression: {expression}\n")
     try:
-        evaluated = utils.sys_eval(expression)
+        evaluated = compile_expression(expression)()
     except Exception as err:
         logging.critical(f"Failed to evaluate {expression}. Error: {str(err)}")
         return None
@@ -137,3 +389,124 @@ def eval(text, lazy_eval_prefix=LAZY_EVAL_PREFIX):
     logging.debug(f"text after patched: {text}\n")
 
     return text
+
+
+_PARENTHESES = re.compile(r"[()]")
+
+
+def eval_all(text, lazy_eval_prefix=LAZY_EVAL_PREFIX):
+    """Patches every lazy evaluation in text in a single right-to-left pass.
+
+    Gives the same result as calling `eval` until it returns None, but finds
+    all "jvm.eval(" occurrences once and keeps the already patched right part
+    of the text as a list of pieces, instead of rescanning and rebuilding the
+    whole string for every evaluation.
+    """
+    if not isinstance(text, str):
+        return text
+
+    while True:
+        if text.startswith("jvm.get("):
+            patched = eval(text, lazy_eval_prefix)
+            if patched is None:
+                return text
+            text = patched
+            continue
+
+        text, restart = _patch_right_to_left(text, lazy_eval_prefix)
+        if not restart:
+            return text
+
+
+def _patch_right_to_left(text, lazy_eval_prefix):
+    """Returns the patched text, and whether it has to be scanned again.
+
+    The text is scanned again only in the rare case an evaluated value brings
+    in a new "jvm.eval(" or turns the text into a "jvm.get(" expression.
+    """
+    starts = [m.start() for m in re.finditer(re.escape(lazy_eval_prefix), text)]
+    prefix_len = len(lazy_eval_prefix)
+    probe_len = prefix_len - 1
+    # text[:boundary] is untouched, the patched rest is kept in reversed pieces
+    boundary = len(text)
+    tail = []
+
+    def materialize():
+        return text[:boundary] + "".join(reversed(tail))
+
+    for start in reversed(starts):
+        # find the corresponding closing tag with parentheses balance
+        balance = 0
+        closing = None
+        for m in _PARENTHESES.finditer(text, start + prefix_len, boundary):
+            if m.group() == "(":
+                balance += 1
+            elif balance == 0:
+                closing = m.start()
+                break
+            else:
+                balance -= 1
+
+        if closing is not None:
+            expression = text[start + prefix_len : closing]
+            rest = [text[closing + 1 : boundary]] if closing + 1 < boundary else []
+            consumed = 0
+        else:
+            expression, rest, consumed, balance = _scan_tail(
+                text[start + prefix_len : boundary], tail, balance
+            )
+            if balance != 0:
+                logging.critical(
+                    f"Error: parentheses are not balanced in {materialize()}"
+                )
+                return materialize(), False
+
+        expression = expression.strip()
+        logging.debug(f"eval_and_patch_template_before_exec, expression: {expression}\n")
+        try:
+            evaluated = str(compile_expression(expression)())
+        except Exception as err:
+            logging.critical(f"Failed to evaluate {expression}. Error: {str(err)}")
+            return materialize(), False
+
+        # replace the evaluated part, the consumed tail pieces belonged to it
+        del tail[len(tail) - consumed :]
+        tail.extend(reversed(rest))
+        tail.append(evaluated)
+        boundary = start
+
+        head = ""
+        for piece in reversed(tail):
+            head += piece
+            if len(head) >= len(evaluated) + probe_len:
+                break
+        head = head[: len(evaluated) + probe_len]
+        probe = text[max(0, start - probe_len) : start] + head
+        if lazy_eval_prefix in probe or (
+            start < len("jvm.get(") and (text[:start] + head).startswith("jvm.get(")
+        ):
+            return materialize(), True
+
+    return materialize(), False
+
+
+def _scan_tail(expression_head, tail, balance):
+    """Continues the parentheses balance into the patched pieces of the text.
+
+    Returns the expression, the pieces left after the closing parenthesis,
+    the number of consumed pieces and the final balance.
+    """
+    parts = [expression_head]
+    for consumed, piece in enumerate(reversed(tail), 1):
+        for m in _PARENTHESES.finditer(piece):
+            if m.group() == "(":
+                balance += 1
+            elif balance == 0:
+                parts.append(piece[: m.start()])
+                rest = [piece[m.start() + 1 :]] if m.start() + 1 < len(piece) else []
+                return "".join(parts), rest, consumed, 0
+            else:
+                balance -= 1
+        parts.append(piece)
+    # without a closing parenthesis the expression runs to the end of the text
+    return "".join(parts), [], len(tail), balance
@@ -0,0 +1,692 @@
+import os
+import gzip
+import json
+import mmap
+import base64
+import shutil
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Tuple
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# marks a JSON object as an encoded value rather than a plain dict
+TYPE_TAG = "__jvm_type__"
+
+
+def encode_value(value: Any) -> Any:
+    """Encode a value into its JSON representation.
+
+    Lists and dicts are stored as native JSON arrays and objects, binary blobs
+    are base64 encoded, and containers holding binary blobs are packed with
+    msgpack when it is installed.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return {TYPE_TAG: "bytes", "data": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, (list, tuple, dict)) and _contains_bytes(value):
+        if msgpack is None:
+            raise TypeError("msgpack is required to store containers of bytes")
+        packed = msgpack.packb(value, use_bin_type=True)
+        return {TYPE_TAG: "msgpack", "data": base64.b64encode(packed).decode("ascii")}
+    # copy containers so later changes by the caller do not leak into the store
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+def decode_value(value: Any) -> Any:
+    if not isinstance(value, dict) or TYPE_TAG not in value:
+        return value
+    if value[TYPE_TAG] == "bytes":
+        return base64.b64decode(value["data"])
+    if value[TYPE_TAG] == "msgpack":
+        if msgpack is None:
+            raise TypeError("msgpack is required to read containers of bytes")
+        return msgpack.unpackb(base64.b64decode(value["data"]), raw=False)
+    raise ValueError(f"Unknown encoded value type: {value[TYPE_TAG]}")
+
+
+def _contains_bytes(value: Any) -> bool:
+    if isinstance(value, (bytes, bytearray)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return any(_contains_bytes(item) for item in value)
+    if isinstance(value, dict):
+        return any(_contains_bytes(item) for item in value.values())
+    return False
+
+
+class KVStore(ABC):
+    """Storage engine backing the JVM context database."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @abstractmethod
+    def load(self) -> None:
+        pass
+
+    @abstractmethod
+    def get(self, key: str, default: Any = None) -> Any:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    @abstractmethod
+    def keys(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def reset(self) -> None:
+        pass
+
+    @abstractmethod
+    def generation(self) -> List:
+        """A JSON value that changes whenever the stored data changes.
+
+        It is derived from the files on disk, so it can be compared across
+        processes, e.g. to check a checkpoint still matches the store.
+        """
+
+    def refresh(self) -> None:
+        """Pick up the writes of another process, e.g. a RunPython script."""
+        self.load()
+
+    def keys_with_prefix(self, prefix: str) -> List[str]:
+        return [key for key in self.keys() if key.startswith(prefix)]
+
+    def items_with_prefix(self, prefix: str) -> List[Tuple[str, Any]]:
+        return [(key, self.get(key)) for key in self.keys_with_prefix(prefix)]
+
+    def close(self) -> None:
+        pass
+
+
+class JSONStore(KVStore):
+    """Keeps the whole store in memory and rewrites the JSON file on every write."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.data: Dict[str, Any] = {}
+        self.snapshot_stat = None
+
+    def load(self) -> None:
+        self.data = self._read_snapshot()
+
+    def refresh(self) -> None:
+        if self._stat(self.path) != self.snapshot_stat:
+            self.load()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        self.data[key] = value
+        self._write_snapshot()
+
+    def keys(self) -> List[str]:
+        return list(self.data.keys())
+
+    def reset(self) -> None:
+        self.data = {}
+        self._write_snapshot()
+
+    def generation(self) -> List:
+        # the snapshot is replaced on every write
+        return list(self._stat(self.path) or ())
+
+    def _read_snapshot(self) -> Dict[str, Any]:
+        self.snapshot_stat = self._stat(self.path)
+        if self.snapshot_stat is None:
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def _write_snapshot(self) -> None:
+        # write to a temporary file first so that a crash never leaves a torn snapshot
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.snapshot_stat = self._stat(self.path)
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class WALStore(JSONStore):
+    """Append-only write-ahead log on top of a JSON snapshot.
+
+    Every `set` appends one JSON record to the log instead of rewriting the
+    snapshot. Once the log holds `compact_records` records it is folded into
+    the snapshot. `load` replays the log over the snapshot and drops a torn
+    trailing record left behind by a crash. `refresh` only replays the records
+    appended since the last load, unless another process compacted the log.
+    `set` refreshes first when the log is not the size it last saw, so the
+    records of other writers are applied before, and in the order of, its own.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compact_records: int = 1000,
+        fsync: bool = False,
+    ):
+        super().__init__(path)
+        self.wal_path = os.path.splitext(path)[0] + ".wal"
+        self.compact_records = compact_records
+        self.fsync = fsync
+        self.wal_records = 0
+        # number of bytes of the log already applied to `data`
+        self.wal_offset = 0
+
+    def load(self) -> None:
+        self.data = self._read_snapshot()
+        self.wal_offset = 0
+        self.wal_records = self._replay()
+        if self.wal_records >= self.compact_records:
+            self.compact()
+
+    def refresh(self) -> None:
+        if self._stat(self.path) != self.snapshot_stat or self._wal_size() < self.wal_offset:
+            # the log was compacted by another process
+            self.load()
+            return
+
+        changed = self._replay()
+        self.wal_records += changed
+        logging.debug(f"Merged {changed} changed keys from {self.wal_path}")
+
+    def set(self, key: str, value: Any) -> None:
+        record = (json.dumps({"k": key, "v": value}) + "\n").encode()
+        if self._wal_size() != self.wal_offset or self._stat(self.path) != self.snapshot_stat:
+            # another process appended to or compacted the log since we read it
+            self.refresh()
+        with open(self.wal_path, "ab") as f:
+            f.write(record)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            end = f.tell()
+
+        if end - len(record) == self.wal_offset:
+            self.data[key] = value
+            self.wal_records += 1
+            self.wal_offset = end
+        else:
+            # another writer appended in between, apply the log in its order
+            self.refresh()
+
+        if self.wal_records >= self.compact_records:
+            self.compact()
+
+    def reset(self) -> None:
+        super().reset()
+        self._truncate_wal()
+
+    def generation(self) -> List:
+        return super().generation() + [self._wal_size()]
+
+    def compact(self) -> None:
+        """Fold the log into the snapshot and truncate it."""
+        # A crash between these two steps only leaves records that are
+        # replayed on top of a snapshot that already contains them.
+        self._write_snapshot()
+        self._truncate_wal()
+        logging.debug(f"Compacted JVM kv store into {self.path}")
+
+    def _truncate_wal(self) -> None:
+        with open(self.wal_path, "w"):
+            pass
+        self.wal_records = 0
+        self.wal_offset = 0
+
+    def _wal_size(self) -> int:
+        try:
+            return os.path.getsize(self.wal_path)
+        except FileNotFoundError:
+            return 0
+
+    def _replay(self) -> int:
+        """Apply the records after `wal_offset`, returns how many were applied.
+
+        A trailing record without a newline is torn and truncated, a corrupt
+        record in the middle of the log is skipped.
+        """
+        if not os.path.exists(self.wal_path):
+            return 0
+
+        records = 0
+        valid_offset = self.wal_offset
+        torn = False
+        with open(self.wal_path, "rb") as f:
+            f.seek(valid_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # only the last line can lack its newline
+                    logging.warning(
+                        f"Dropping torn record at offset {valid_offset} of {self.wal_path}"
+                    )
+                    torn = True
+                    break
+                try:
+                    record = json.loads(line)
+                    self.data[record["k"]] = record["v"]
+                    records += 1
+                except (ValueError, KeyError, TypeError) as err:
+                    logging.warning(
+                        f"Skipping corrupt record at offset {valid_offset} of {self.wal_path}: {err}"
+                    )
+                valid_offset += len(line)
+
+        if torn:
+            with open(self.wal_path, "r+b") as f:
+                f.truncate(valid_offset)
+
+        self.wal_offset = valid_offset
+        return records
+
+
+class SQLiteStore(KVStore):
+    """SQLite database in WAL mode, queried directly instead of held in memory.
+
+    Keys are the primary key of a WITHOUT ROWID table, so prefix lookups are
+    range scans over the key B-tree. Values keep their insertion order through
+    the `seq` column, matching the order of the dict based engines. Decoded
+    values are kept in an LRU cache so hot keys are not parsed on every read;
+    every write bumps the `gen` of its key, so `refresh` only has to evict the
+    keys written by other processes since the last refresh.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0, cache_size: int = 256):
+        super().__init__(path)
+        self.db_path = os.path.splitext(path)[0] + ".db"
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._epoch = 0
+        self._data_version = None
+        is_new = not os.path.exists(self.db_path)
+        self._conn = sqlite3.connect(
+            self.db_path,
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "seq INTEGER NOT NULL, gen INTEGER NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_seq ON kv (seq)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_gen ON kv (gen)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self._conn.execute(
+            "INSERT OR IGNORE INTO meta (name, value) VALUES ('epoch', 0)"
+        )
+        if is_new:
+            self._import_snapshot()
+        self.load()
+
+    def load(self) -> None:
+        # every read goes to the database, only the cache may be stale
+        with self._lock:
+            self._cache.clear()
+            self._generation = self._max_generation()
+            self._epoch = self._read_epoch()
+            self._data_version = self._read_data_version()
+
+    def refresh(self) -> None:
+        with self._lock:
+            data_version = self._read_data_version()
+            if data_version == self._data_version:
+                # nobody else has committed anything
+                return
+            self._data_version = data_version
+
+            if self._read_epoch() != self._epoch:
+                # the store was reset by another process
+                self._cache.clear()
+                self._epoch = self._read_epoch()
+                self._generation = self._max_generation()
+                return
+
+            rows = self._conn.execute(
+                "SELECT key, gen FROM kv WHERE gen > ?", (self._generation,)
+            ).fetchall()
+            for key, gen in rows:
+                self._cache.pop(key, None)
+                self._generation = max(self._generation, gen)
+        logging.debug(f"Evicted {len(rows)} changed keys of {self.db_path}")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return default
+            value = json.loads(row[0])
+            self._remember(key, value)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO kv (key, value, seq, gen) "
+                "VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM kv), "
+                "(SELECT COALESCE(MAX(gen), 0) + 1 FROM kv)) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, gen = excluded.gen",
+                (key, json.dumps(value)),
+            )
+            self._remember(key, value)
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM kv ORDER BY seq").fetchall()
+        return [row[0] for row in rows]
+
+    def keys_with_prefix(self, prefix: str) -> List[str]:
+        return [row[0] for row in self._scan_prefix("key", prefix)]
+
+    def items_with_prefix(self, prefix: str) -> List[Tuple[str, Any]]:
+        return [
+            (key, json.loads(value))
+            for key, value in self._scan_prefix("key, value", prefix)
+        ]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM kv")
+            self._conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'epoch'")
+            self._cache.clear()
+            self._epoch = self._read_epoch()
+            self._generation = 0
+
+    def generation(self) -> List:
+        with self._lock:
+            return [self._read_epoch(), self._max_generation()]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _max_generation(self) -> int:
+        return self._conn.execute("SELECT COALESCE(MAX(gen), 0) FROM kv").fetchone()[0]
+
+    def _read_epoch(self) -> int:
+        return self._conn.execute(
+            "SELECT value FROM meta WHERE name = 'epoch'"
+        ).fetchone()[0]
+
+    def _read_data_version(self) -> int:
+        # changes whenever another connection commits to the database
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _remember(self, key: str, value: Any) -> None:
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _scan_prefix(self, columns: str, prefix: str) -> List[Tuple]:
+        upper = _prefix_upper_bound(prefix)
+        if upper is None:
+            query = f"SELECT {columns} FROM kv WHERE key >= ? ORDER BY seq"
+            params: Tuple = (prefix,)
+        else:
+            query = f"SELECT {columns} FROM kv WHERE key >= ? AND key < ? ORDER BY seq"
+            params = (prefix, upper)
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def _import_snapshot(self) -> None:
+        # migrate an existing kv_store.json (and its log) into the new database
+        legacy = WALStore(self.path)
+        legacy.load()
+        if not legacy.data:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO kv (key, value, seq, gen) VALUES (?, ?, ?, ?)",
+                [
+                    (key, json.dumps(value), seq, seq)
+                    for seq, (key, value) in enumerate(legacy.data.items(), 1)
+                ],
+            )
+        logging.info(f"Imported {len(legacy.data)} keys into {self.db_path}")
+
+
+def _prefix_upper_bound(prefix: str):
+    """The smallest string greater than every string starting with `prefix`."""
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class BlobStore:
+    """Content-addressed files for values too large for the main store.
+
+    Values whose serialized size reaches `threshold` bytes are written once to
+    `<directory>/<sha256[:2]>/<sha256>`, optionally gzip or zstd compressed,
+    and the main store only keeps a small reference to them. Blob files are
+    memory-mapped on read and, being immutable, their decoded values are kept
+    in an LRU cache bounded by `cache_bytes`.
+    """
+
+    SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(
+        self,
+        directory: str,
+        threshold: int = 64 * 1024,
+        compression: str = "gzip",
+        cache_bytes: int = 64 * 1024 * 1024,
+    ):
+        if compression not in self.SUFFIXES:
+            raise ValueError(f"Unknown blob compression: {compression}")
+        if compression == "zstd" and zstandard is None:
+            logging.warning("zstandard is not installed, compressing blobs with gzip")
+            compression = "gzip"
+        self.directory = directory
+        self.threshold = threshold
+        self.compression = compression
+        self.cache_bytes = cache_bytes
+        self._cache: OrderedDict = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def spill(self, value: Any) -> Any:
+        """Returns a reference to the blob holding `value` if it is large enough."""
+        if self.threshold <= 0:
+            return value
+        if isinstance(value, str):
+            # a character takes at most 4 bytes in UTF-8
+            if len(value) * 4 < self.threshold:
+                return value
+            data, value_type = value.encode("utf-8"), "str"
+        elif isinstance(value, (list, dict)):
+            data, value_type = json.dumps(value).encode("utf-8"), "json"
+        else:
+            return value
+
+        if len(data) < self.threshold:
+            return value
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest, self.compression)
+        if not os.path.exists(path):
+            self._write(path, self._compress(data, self.compression))
+        self._remember(digest, value, len(data))
+        return {
+            TYPE_TAG: "blob",
+            "sha256": digest,
+            "type": value_type,
+            "codec": self.compression,
+            "size": len(data),
+        }
+
+    def resolve(self, value: Any) -> Any:
+        """Returns the value a blob reference points to, other values as they are."""
+        if not is_blob_ref(value):
+            return value
+
+        digest = value["sha256"]
+        with self._lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                return self._cache[digest][0]
+
+        text = self._load_text(self._path(digest, value["codec"]), value["codec"])
+        resolved = text if value["type"] == "str" else json.loads(text)
+        self._remember(digest, resolved, value["size"])
+        return resolved
+
+    def collect(self, live_refs: List[Dict]) -> int:
+        """Removes the blob files not referenced by `live_refs`, returns how many."""
+        live = {ref["sha256"] for ref in live_refs}
+        removed = 0
+        if not os.path.isdir(self.directory):
+            return removed
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                if file_name.split(".")[0] not in live:
+                    os.remove(os.path.join(root, file_name))
+                    removed += 1
+        return removed
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        with self._lock:
+            self._cache.clear()
+            self._cached_bytes = 0
+
+    def _path(self, digest: str, compression: str) -> str:
+        return os.path.join(
+            self.directory, digest[:2], digest + self.SUFFIXES[compression]
+        )
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def _load_text(cls, path: str, compression: str) -> str:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # decompress or decode straight from the mapping, without copying it first
+                return str(cls._decompress(mapped, compression), "utf-8")
+
+    @staticmethod
+    def _compress(data: bytes, compression: str) -> bytes:
+        if compression == "gzip":
+            return gzip.compress(data)
+        if compression == "zstd":
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    @staticmethod
+    def _decompress(data, compression: str):
+        if compression == "gzip":
+            return gzip.decompress(data)
+        if compression == "zstd":
+            if zstandard is None:
+                raise TypeError("zstandard is required to read zstd compressed blobs")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return data
+
+    def _remember(self, digest: str, value: Any, size: int) -> None:
+        if size > self.cache_bytes:
+            return
+        with self._lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                return
+            self._cache[digest] = (value, size)
+            self._cached_bytes += size
+            while self._cached_bytes > self.cache_bytes:
+                _, (_, evicted_size) = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted_size
+
+
+def is_blob_ref(value: Any) -> bool:
+    return isinstance(value, dict) and value.get(TYPE_TAG) == "blob"
+
+
+def blob_options() -> Dict[str, Any]:
+    options: Dict[str, Any] = {}
+    threshold = os.getenv("JVM_BLOB_THRESHOLD")
+    if threshold:
+        options["threshold"] = int(threshold)
+    compression = os.getenv("JVM_BLOB_COMPRESSION")
+    if compression:
+        options["compression"] = compression
+    return options
+
+
+STORE_ENGINES = {
+    "json": JSONStore,
+    "wal": WALStore,
+    "sqlite": SQLiteStore,
+}
+
+
+def open_store(engine: str, path: str, **kwargs) -> KVStore:
+    store_class = STORE_ENGINES.get(engine)
+    if store_class is None:
+        raise ValueError(f"Unknown JVM kv store engine: {engine}")
+    return store_class(path, **kwargs)
+
+
+def engine_options(engine: str) -> Dict[str, Any]:
+    """Engine options read from the environment, so RunPython children share them."""
+    options: Dict[str, Any] = {}
+    if engine == "wal":
+        compact_records = os.getenv("JVM_WAL_COMPACT_RECORDS")
+        if compact_records:
+            options["compact_records"] = int(compact_records)
+        options["fsync"] = os.getenv("JVM_WAL_FSYNC", "false").lower() == "true"
+    return options
+
+
+def default_engine() -> str:
+    return os.getenv("JVM_KV_STORE_ENGINE", "wal")
@@ -1,3 +1,4 @@
+import os
 import re
 import time
 import logging
@@ -11,7 +12,7 @@ from jarvis.smartgpt import clarifier
 from jarvis.smartgpt import preprompts
 
 
-def gen_plan(model: str, goal: str) -> Dict:
+def gen_plan(model: str, goal: str, workdir: str = "") -> Dict:
     if not goal:
         # input the goal
         input_goal = input("Please input your goal:\n")
@@ -31,7 +32,7 @@ def gen_plan(model: str, goal: str) -> Dict:
         resp = gpt.complete(user_prompt, model, system_prompt)
 
         # resp = reorder_tasks(utils.strip_yaml(resp))
-        with open("plan.yaml", "w") as stream:
+        with open(os.path.join(workdir, "plan.yaml"), "w") as stream:
             stream.write(resp)
 
         return yaml.safe_load(resp)
@@ -105,12 +106,12 @@ def reorder_tasks(plan_yaml_str: str) -> str:
     return sorted_plan_yaml_str
 
 
-def evaluate_plan(model: str, goal: str):
+def evaluate_plan(model: str, goal: str, workdir: str = ""):
     try:
-        with open("plan.yaml", "r") as file:
+        with open(os.path.join(workdir, "plan.yaml"), "r") as file:
             plan = file.read()
     except Exception as e:
-        logging.error(f"Error loading 'plan.yaml' in current workdir, Error: {e}")
+        logging.error(f"Error loading 'plan.yaml' in {workdir or 'current workdir'}, Error: {e}")
         return None
 
     messages = []
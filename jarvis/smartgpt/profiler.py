@@ -0,0 +1,193 @@
+"""Per-instruction profiling of JVM runs.
+
+The interpreter opens a span for every instruction and loop iteration it
+runs. While a span is open on a thread, the counters recorded on that thread
+(bytes read from and written to the kv store, LLM tokens in and out, time
+waiting for and retries of LLM requests, action cache hits and misses) are
+added to it and to its enclosing spans. Spans of instructions running on
+worker threads keep the span that started them as their parent.
+
+A profile is exported as JSON, or as a Chrome trace-event file that can be
+opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+KV_BYTES_READ = "kv_bytes_read"
+KV_BYTES_WRITTEN = "kv_bytes_written"
+LLM_TOKENS_IN = "llm_tokens_in"
+LLM_TOKENS_OUT = "llm_tokens_out"
+LLM_WAIT_MS = "llm_wait_ms"
+LLM_RETRIES = "llm_retries"
+CACHE_HITS = "cache_hits"
+CACHE_MISSES = "cache_misses"
+
+_local = threading.local()
+# the spans of concurrent workers share their parents
+_record_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name: str, category: str, args: dict, parent: Optional["Span"]):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.parent = parent
+        self.thread = threading.current_thread().name
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+        self.counters: Dict[str, int] = {}
+
+    def to_dict(self, origin: float) -> dict:
+        data = {
+            "name": self.name,
+            "category": self.category,
+            "thread": self.thread,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "args": self.args,
+            "counters": dict(self.counters),
+        }
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class Profiler:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, category: str, parent: Optional[Span] = None, **args):
+        """Records the execution of the enclosed block as a span.
+
+        The span is nested in `parent`, or in the innermost span open on the
+        current thread.
+        """
+        stack = _stack()
+        if parent is None and stack:
+            parent = stack[-1]
+        span = Span(name, category, args, parent)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as err:
+            span.error = str(err)
+            raise
+        finally:
+            span.end = time.perf_counter()
+            stack.pop()
+            with self.lock:
+                self.spans.append(span)
+
+    def totals(self) -> Dict[str, int]:
+        # spans without a parent include the counters of their children
+        totals = {}
+        with self.lock:
+            roots = [span for span in self.spans if span.parent is None]
+        for span in roots:
+            for name, value in span.counters.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return {
+            "spans": [span.to_dict(self.origin) for span in spans],
+            "totals": self.totals(),
+        }
+
+    def to_chrome_trace(self) -> dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        thread_ids = {}
+        events = []
+        for span in spans:
+            tid = thread_ids.setdefault(span.thread, len(thread_ids) + 1)
+            args = dict(span.args, **span.counters)
+            if span.error is not None:
+                args["error"] = span.error
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": round((span.start - self.origin) * 1e6, 1),
+                    "dur": round((span.end - span.start) * 1e6, 1),
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+        for thread, tid in thread_ids.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": thread},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+
+    def dump_chrome_trace(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f, default=str)
+
+
+def _stack() -> List[Span]:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def current_span() -> Optional[Span]:
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def active() -> bool:
+    """Whether a span is open on the current thread, to skip costly measurements."""
+    return bool(getattr(_local, "stack", None))
+
+
+def record(counter: str, amount: int = 1):
+    """Adds amount to counter of the spans open on the current thread."""
+    span = current_span()
+    if span is None:
+        return
+    with _record_lock:
+        while span is not None:
+            span.counters[counter] = span.counters.get(counter, 0) + amount
+            span = span.parent
+
+
+def bind_current(func):
+    """Wrap func so the counters it records go to the span open on the calling thread."""
+    span = current_span()
+
+    def run(*args, **kwargs):
+        if span is None:
+            return func(*args, **kwargs)
+        stack = _stack()
+        stack.append(span)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+
+    return run
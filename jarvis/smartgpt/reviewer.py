@@ -37,7 +37,7 @@ class Reviewer(ABC):
         )
         messages.append({"role": "user", "content": review_content})
 
-        review_response = gpt.send_messages(messages, self.model)
+        review_response = gpt.send_messages(messages, self.model, priority=gpt.BACKGROUND)
         messages.append({"role": "assistant", "content": review_response})
 
         review_response = utils.strip_yaml(review_response)
@@ -77,13 +77,13 @@ class SimulationReviewer(Reviewer):
         )
         messages.append({"role": "user", "content": review_content})
 
-        response = gpt.send_messages(messages, self.model)
+        response = gpt.send_messages(messages, self.model, priority=gpt.BACKGROUND)
         messages.append({"role": "assistant", "content": response})
 
         messages.append(
             {"role": "user", "content": preprompts.get("reviewer_simulation_output")}
         )
-        response = gpt.send_messages(messages, self.model)
+        response = gpt.send_messages(messages, self.model, priority=gpt.BACKGROUND)
         messages.append({"role": "assistant", "content": response})
 
         if "CORRECT!" in response:
@@ -123,7 +123,7 @@ class SyntaxReviewer(Reviewer):
             }
         )
 
-        resp = gpt.send_messages(messages, self.model)
+        resp = gpt.send_messages(messages, self.model, priority=gpt.BACKGROUND)
         messages.append({"role": "assistant", "content": resp})
 
         if "CORRECT!" in resp:
@@ -80,7 +80,7 @@ class Translator:
             }
         )
 
-        resp = gpt.send_messages(messages, self.model)
+        resp = gpt.send_messages(messages, self.model, priority=gpt.BACKGROUND)
         messages.append({"role": "asssistant", "content": resp})
         self._trace_reviser_gen(task_info, messages)
 
@@ -104,7 +104,7 @@ class Translator:
         messages = self.build_system_prompt(few_shot_data=reference_example)
         messages.append({"role": "user", "content": user_prompt})
 
-        resp = gpt.send_messages(messages, self.model)
+        resp = gpt.send_messages(messages, self.model, priority=gpt.BACKGROUND)
         messages.append({"role": "asssistant", "content": resp})
         self._trace_llm_gen(task_info, messages)
 
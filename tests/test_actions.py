@@ -1,13 +1,40 @@
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch
 
 import yaml
 
+from jarvis.smartgpt import actions
+from jarvis.smartgpt import fetcher
 from jarvis.smartgpt.actions import FetchWebContentAction
+from jarvis.smartgpt.actions import FetchWebContentsAction
 from jarvis.smartgpt.actions import WebSearchAction
 from jarvis.smartgpt.actions import RunPythonAction
 from jarvis.smartgpt.actions import TextCompletionAction
 
+
+def setUpModule():
+    # actions not patched away cache their results, keep them out of the user's cache
+    global _cache_dir, _cache_path
+    _cache_dir = tempfile.TemporaryDirectory()
+    _cache_path = patch.dict(
+        os.environ, {"ACTION_CACHE_PATH": os.path.join(_cache_dir.name, "action_cache.db")}
+    )
+    _cache_path.start()
+
+
+def tearDownModule():
+    if actions._CACHE is not None:
+        actions._CACHE.close()
+        actions._CACHE = None
+    _cache_path.stop()
+    _cache_dir.cleanup()
+
+
 class TestFetchWebContentAction(unittest.TestCase):
     def setUp(self):
         self.action = FetchWebContentAction(1, "https://news.ycombinator.com/", "content_fetched_0.seq3.str")
@@ -55,6 +82,111 @@ class TestFetchWebContentAction(unittest.TestCase):
         mock_get_html.assert_called_once()
 
 
+class TestFetchWebContentsAction(unittest.TestCase):
+    def test_parse_urls(self):
+        self.assertEqual(
+            FetchWebContentsAction.parse_urls("['https://a.io', 'https://b.io']"),
+            ["https://a.io", "https://b.io"],
+        )
+        self.assertEqual(
+            FetchWebContentsAction.parse_urls("https://a.io\nhttps://b.io, https://c.io"),
+            ["https://a.io", "https://b.io", "https://c.io"],
+        )
+        self.assertEqual(FetchWebContentsAction.parse_urls(["https://a.io", ""]), ["https://a.io"])
+
+    def test_key_for(self):
+        self.assertEqual(FetchWebContentsAction.key_for("page_<idx>.seq3.str", 2), "page_2.seq3.str")
+        self.assertEqual(FetchWebContentsAction.key_for("page.seq3.str", 2), "page_2.seq3.str")
+
+    def test_run(self):
+        pages = {
+            "https://a.io": "<html><body><p>A</p></body></html>",
+            "https://b.io": "<html><body><p>B</p></body></html>",
+        }
+
+        def get_html(url):
+            if url not in pages:
+                raise ValueError("connection refused")
+            return pages[url]
+
+        urls = "['https://a.io', 'https://down.io', 'https://b.io']"
+        with patch.object(actions, "_ENABLE_CACHE", False), patch.object(
+            FetchWebContentAction, "get_html", side_effect=get_html
+        ):
+            with self.assertRaisesRegex(ValueError, "1 of 3 URLs: https://down.io: connection refused"):
+                FetchWebContentsAction(1, urls, "page_<idx>.seq3.str").run()
+            with self.assertLogs(level="WARNING") as logs:
+                result = json.loads(
+                    FetchWebContentsAction(1, urls, "page_<idx>.seq3.str", best_effort="true").run()
+                )
+
+        self.assertEqual(
+            result["kvs"],
+            [
+                {"key": "page_0.seq3.str", "value": "A"},
+                {"key": "page_1.seq3.str", "value": ""},
+                {"key": "page_2.seq3.str", "value": "B"},
+            ],
+        )
+        self.assertEqual(result["failed"], [{"url": "https://down.io", "error": "connection refused"}])
+        self.assertTrue(any("https://down.io" in line for line in logs.output))
+
+        # best effort still fails when nothing could be fetched
+        with patch.object(actions, "_ENABLE_CACHE", False), patch.object(
+            FetchWebContentAction, "get_html", side_effect=ValueError("down")
+        ):
+            with self.assertRaises(ValueError):
+                FetchWebContentsAction(1, urls, "page_<idx>.seq3.str", best_effort=True).run()
+
+
+class TestFetchMany(unittest.TestCase):
+    def test_per_host_limit(self):
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+
+        def fetch(url):
+            host = url.split("/")[2]
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peak[host] = max(peak.get(host, 0), running[host])
+            time.sleep(0.02)
+            with lock:
+                running[host] -= 1
+            return url
+
+        urls = [f"https://{host}/{i}" for host in ("a.io", "b.io") for i in range(4)]
+        results = actions.fetch_many(
+            urls, fetch, max_workers=8, limiter=fetcher.HostLimiter(per_host=2, delay=0)
+        )
+
+        self.assertEqual(results, urls)
+        self.assertEqual(peak, {"a.io": 2, "b.io": 2})
+
+    def test_counters_go_to_the_calling_span(self):
+        def fetch(url):
+            actions.profiler.record("fetch_http")
+            return url
+
+        prof = actions.profiler.Profiler()
+        with prof.span("FetchWebContents", "instruction") as span:
+            actions.fetch_many(
+                ["https://a.io/1", "https://b.io/2"],
+                fetch,
+                limiter=fetcher.HostLimiter(per_host=2, delay=0),
+            )
+
+        self.assertEqual(span.counters, {"fetch_http": 2})
+
+    def test_politeness_delay(self):
+        limiter = fetcher.HostLimiter(per_host=4, delay=0.05)
+        urls = ["https://a.io/1", "https://a.io/2", "https://a.io/3"]
+
+        start = time.monotonic()
+        actions.fetch_many(urls, lambda url: url, limiter=limiter)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+
 class TestWebSearchAction(unittest.TestCase):
     def setUp(self):
         self.action = WebSearchAction(1, "hacker news", "search_url.seq3.list")
@@ -173,6 +305,107 @@ class TestTextCompletion(unittest.TestCase):
         mock_save_to_cache.assert_not_called()
         mock_send_message.assert_called_once()
 
+    @patch('jarvis.smartgpt.actions.preprompts.get', return_value="prompt")
+    def test_cache_key(self, mock_get):
+        def key(**kwargs):
+            args = dict(action_id=1, request="Summarize", content="page 1", output_format="fmt")
+            args.update(kwargs)
+            return TextCompletionAction(**args).cache_key()
+
+        self.assertTrue(key().startswith("TextCompletion:"))
+        self.assertEqual(key(), key(action_id=2))
+        self.assertNotEqual(key(), key(content="page 2"))
+        self.assertNotEqual(key(), key(output_format="other"))
+        self.assertNotEqual(key(), key(model_name="gpt-4"))
+        self.assertNotEqual(key(), key(request=" summarize\n"))
+
+        with patch.dict(os.environ, {"TEXT_COMPLETION_CACHE_NORMALIZE": "true"}):
+            self.assertEqual(key(), key(request=" summarize\n"))
+            self.assertNotEqual(key(), key(content="page 1 "))
+
+        original = key()
+        mock_get.return_value = "edited prompt"
+        self.assertNotEqual(key(), original)
+
+    def test_split_to_tokens(self):
+        content = " ".join(f"word{i}" for i in range(200))
+        chunks = actions.gpt.split_to_tokens(content, 50, overlap=10)
+
+        self.assertGreater(len(chunks), 1)
+        encode = actions.gpt.ENCODING.encode
+        for chunk, following in zip(chunks, chunks[1:]):
+            self.assertLessEqual(len(encode(chunk)), 50)
+            self.assertEqual(encode(chunk)[-10:], encode(following)[:10])
+        self.assertTrue(content.endswith(chunks[-1]))
+        self.assertEqual(actions.gpt.split_to_tokens("short", 50), ["short"])
+
+    def map_reduce(self, content, chunks, max_content_tokens=300, env=None):
+        calls = []
+        lock = threading.Lock()
+
+        def send_messages(messages, model):
+            prompt = messages[-1]["content"]
+            with lock:
+                calls.append(prompt)
+                count = len(calls)
+            if prompt.startswith("reduce"):
+                return f'{{"kvs": "merged {prompt.count("Partial result")} in call {count}"}}'
+            return '{"kvs": "' + prompt + '"}'
+
+        action = TextCompletionAction(1, "Summarize", content, "fmt")
+        with patch.dict(os.environ, dict(env or {}, TEXT_COMPLETION_MAP_REDUCE="true")), patch(
+            "jarvis.smartgpt.actions.preprompts.get",
+            side_effect=lambda name: {
+                "text_completion_user": "map {content}",
+                "text_completion_reduce_user": "reduce {content}",
+            }.get(name, ""),
+        ), patch("jarvis.smartgpt.actions.get_from_cache", return_value=None), patch(
+            "jarvis.smartgpt.actions.save_to_cache"
+        ), patch.object(
+            TextCompletionAction, "max_content_tokens", return_value=max_content_tokens
+        ), patch(
+            "jarvis.smartgpt.actions.gpt.split_to_tokens", return_value=chunks
+        ), patch(
+            "jarvis.smartgpt.actions.gpt.send_messages", side_effect=send_messages
+        ):
+            return action.run(), calls
+
+    def test_map_reduce(self):
+        # well beyond the patched limit, however the words are tokenized
+        result, calls = self.map_reduce("word " * 1000, ["a", "b", "c"])
+
+        self.assertEqual(result, '{"kvs": "merged 3 in call 4"}')
+        self.assertEqual(sorted(calls[:3]), ["map a", "map b", "map c"])
+        self.assertEqual(len(calls), 4)
+        self.assertIn("Partial result 3 of 3", calls[3])
+
+    def test_short_content_is_completed_at_once(self):
+        result, calls = self.map_reduce("word " * 10, ["a", "b", "c"])
+
+        self.assertEqual(result, '{"kvs": "map ' + "word " * 10 + '"}')
+        self.assertEqual(len(calls), 1)
+
+    def test_map_reduce_merges_in_rounds(self):
+        chunks = [f"chunk {i}" for i in range(20)]
+        with patch.object(actions.gpt, "count_tokens", return_value=84):
+            # 4 partial results fit in one reduce completion
+            result, calls = self.map_reduce("word " * 1000, chunks, max_content_tokens=400)
+
+        self.assertEqual(result, '{"kvs": "merged 2 in call 27"}')
+        maps = [call for call in calls if call.startswith("map")]
+        reduces = [call for call in calls if call.startswith("reduce")]
+        self.assertEqual(sorted(maps), sorted(f"map {chunk}" for chunk in chunks))
+        # 20 partial results in 5 completions, then 4 of the 5 in one, then the last 2
+        self.assertEqual(len(reduces), 7)
+
+    def test_map_reduce_chunk_limit(self):
+        result, calls = self.map_reduce(
+            "word " * 1000, ["a", "b", "c"], env={"TEXT_COMPLETION_MAX_CHUNKS": "2"}
+        )
+
+        self.assertIn("An error occurred", result)
+        self.assertIn("TEXT_COMPLETION_MAX_CHUNKS=2", result)
+        self.assertEqual(calls, [])
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,114 @@
+import threading
+import unittest
+
+from jarvis.smartgpt import browser
+
+
+class FakeDriver:
+    def __init__(self, port):
+        self.port = port
+        self.alive = True
+        self.quit_called = False
+        self.urls = []
+
+    def set_page_load_timeout(self, timeout):
+        self.timeout = timeout
+
+    def execute_script(self, script):
+        if not self.alive:
+            raise RuntimeError("chrome not reachable")
+        return 1
+
+    def get(self, url):
+        self.urls.append(url)
+
+    def find_element(self, by, value):
+        driver = self
+
+        class Body:
+            def get_attribute(self, name):
+                return f"<p>{driver.urls[-1]}</p>"
+
+        return Body()
+
+    def quit(self):
+        self.quit_called = True
+
+
+class TestBrowserPool(unittest.TestCase):
+    def setUp(self):
+        self.drivers = []
+
+        def factory(port):
+            driver = FakeDriver(port)
+            self.drivers.append(driver)
+            return driver
+
+        self.factory = factory
+
+    def test_sessions_are_reused(self):
+        pool = browser.BrowserPool(size=2, driver_factory=self.factory)
+
+        self.assertEqual(pool.get_html("https://a"), "<p>https://a</p>")
+        self.assertEqual(pool.get_html("https://b"), "<p>https://b</p>")
+
+        self.assertEqual(len(self.drivers), 1)
+        self.assertEqual(self.drivers[0].urls, ["https://a", "https://b"])
+
+        pool.close()
+        self.assertTrue(self.drivers[0].quit_called)
+        with self.assertRaises(RuntimeError):
+            pool.acquire()
+
+    def test_sessions_are_recycled(self):
+        pool = browser.BrowserPool(size=1, max_pages=2, driver_factory=self.factory)
+        for url in ["https://a", "https://b", "https://c"]:
+            pool.get_html(url)
+
+        self.assertEqual(len(self.drivers), 2)
+        self.assertTrue(self.drivers[0].quit_called)
+        self.assertEqual(self.drivers[1].urls, ["https://c"])
+
+    def test_unhealthy_sessions_are_replaced(self):
+        pool = browser.BrowserPool(size=1, driver_factory=self.factory)
+        pool.get_html("https://a")
+        self.drivers[0].alive = False
+
+        pool.get_html("https://b")
+
+        self.assertEqual(len(self.drivers), 2)
+        self.assertTrue(self.drivers[0].quit_called)
+        self.assertEqual(pool.open, 1)
+
+    def test_concurrent_fetches_use_separate_sessions(self):
+        pool = browser.BrowserPool(size=2, driver_factory=self.factory)
+        barrier = threading.Barrier(2, timeout=5)
+        results = {}
+
+        def fetch(url):
+            with pool.session() as driver:
+                barrier.wait()
+                results[url] = driver
+
+        threads = [threading.Thread(target=fetch, args=(url,)) for url in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIsNot(results["a"], results["b"])
+        self.assertNotEqual(results["a"].port, results["b"].port)
+
+        # a third fetch waits for and reuses an idle session
+        pool.get_html("https://c")
+        self.assertEqual(len(self.drivers), 2)
+
+    def test_failed_start_frees_its_slot(self):
+        def factory(port):
+            raise ValueError("Failed to initialize webdriver")
+
+        pool = browser.BrowserPool(size=1, driver_factory=factory)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                pool.get_html("https://a")
+        self.assertEqual(pool.open, 0)
@@ -0,0 +1,146 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from jarvis.smartgpt import actions
+from jarvis.smartgpt import cache
+
+
+class TestActionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "action_cache.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_make_key(self):
+        key = cache.make_key("WebSearch", "query", "urls.seq1.list")
+        self.assertTrue(key.startswith("WebSearch:"))
+        self.assertEqual(key, cache.make_key("WebSearch", "query", "urls.seq1.list"))
+        self.assertNotEqual(key, cache.make_key("WebSearch", "query", "urls.seq2.list"))
+        # inputs are not simply concatenated
+        self.assertNotEqual(cache.make_key("K", "ab", "c"), cache.make_key("K", "a", "bc"))
+
+    def test_persistence(self):
+        store = cache.ActionCache(self.path)
+        store.set("WebSearch:1", "result")
+        store.close()
+
+        store = cache.ActionCache(self.path)
+        self.assertEqual(store.get("WebSearch:1"), "result")
+        self.assertIsNone(store.get("WebSearch:2"))
+        self.assertEqual(store.stats(), {"WebSearch": {"hits": 1, "misses": 1}})
+        store.close()
+
+    def test_ttl_by_action_type(self):
+        store = cache.ActionCache(
+            self.path, default_ttl=0, ttls={"WebSearch": 60}
+        )
+        with mock.patch.object(cache.time, "time", return_value=1000):
+            store.set("WebSearch:1", "urls")
+            store.set("TextCompletion:1", "answer")
+
+        with mock.patch.object(cache.time, "time", return_value=1061):
+            self.assertIsNone(store.get("WebSearch:1"))
+            # a TTL of 0 never expires
+            self.assertEqual(store.get("TextCompletion:1"), "answer")
+
+        self.assertEqual(store.stats()["WebSearch"]["expired"], 1)
+        store.close()
+
+    def test_lru_eviction(self):
+        store = cache.ActionCache(self.path, max_entries=10, default_ttl=0)
+        now = 1000.0
+        for i in range(10):
+            with mock.patch.object(cache.time, "time", return_value=now + i):
+                store.set(f"K:{i}", str(i))
+        # use the oldest entry, so the second oldest is the least recently used
+        with mock.patch.object(cache.time, "time", return_value=now + 20):
+            store.get("K:0")
+        with mock.patch.object(cache.time, "time", return_value=now + 21):
+            store.set("K:10", "10")
+
+        self.assertEqual(store.get("K:0"), "0")
+        self.assertIsNone(store.get("K:1"))
+        self.assertIsNone(store.get("K:2"))
+        self.assertEqual(store.get("K:10"), "10")
+        self.assertEqual(store.stats()["K"]["evictions"], 2)
+        store.close()
+
+    def test_size_bound(self):
+        store = cache.ActionCache(self.path, max_bytes=100, default_ttl=0)
+        for i in range(5):
+            with mock.patch.object(cache.time, "time", return_value=1000 + i):
+                store.set(f"K:{i}", "x" * 30)
+
+        total = store._conn.execute(
+            "SELECT SUM(size) FROM entries"
+        ).fetchone()[0]
+        self.assertLessEqual(total, 90)
+        self.assertEqual(store.get("K:4"), "x" * 30)
+        store.close()
+
+    def test_totals_follow_every_write(self):
+        store = cache.ActionCache(self.path, max_entries=5, ttls={"E": 60}, default_ttl=0)
+
+        def check():
+            self.assertEqual(
+                store._totals(),
+                store._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+                ).fetchone(),
+            )
+
+        for i in range(8):
+            store.set(f"K:{i}", "v" * i)
+            check()
+        store.set("K:7", "replaced")
+        check()
+        with mock.patch.object(cache.time, "time", return_value=1000):
+            store.set("E:1", "expiring")
+        store.get("E:1")
+        check()
+        store.clear()
+        self.assertEqual(store._totals(), (0, 0))
+        store.close()
+
+    def test_totals_of_an_existing_database(self):
+        store = cache.ActionCache(self.path)
+        store.set("K:1", "abc")
+        store._conn.execute("DROP TABLE totals")
+        store.close()
+
+        store = cache.ActionCache(self.path)
+        self.assertEqual(store._totals(), (1, 3))
+        store.close()
+
+    def test_default_path(self):
+        path = os.path.join(self.tmp_dir.name, "jarvis", "action_cache.db")
+        with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.tmp_dir.name}):
+            self.assertEqual(cache.default_path(), path)
+            # the directory is created when the cache is opened
+            cache.ActionCache(cache.default_path()).close()
+        self.assertTrue(os.path.exists(path))
+
+
+class TestActionsCache(unittest.TestCase):
+    def test_save_and_get(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(
+            actions, "_CACHE", None
+        ), mock.patch.object(actions, "_ENABLE_CACHE", True):
+            actions.load_cache(os.path.join(tmp_dir, "action_cache.db"))
+            key = cache.make_key("FetchWebContent", "https://a.io", "page.seq1.str")
+
+            self.assertIsNone(actions.get_from_cache(key))
+            actions.save_to_cache(key, "content")
+            self.assertEqual(actions.get_from_cache(key), "content")
+            self.assertEqual(
+                actions.cache_stats(),
+                {"FetchWebContent": {"misses": 1, "writes": 1, "hits": 1}},
+            )
+
+            actions.disable_cache()
+            self.assertIsNone(actions.get_from_cache(key))
+            actions._CACHE.close()
@@ -0,0 +1,155 @@
+import threading
+import time
+import unittest
+
+from jarvis.smartgpt import dataflow
+from jarvis.smartgpt.dataflow import ANY_KEY, KeyPattern
+
+
+class TestAnalyze(unittest.TestCase):
+    def test_fetch_reads_and_writes(self):
+        effects = dataflow.analyze(
+            {
+                "type": "FetchWebContent",
+                "args": {
+                    "url": "jvm.eval(jvm.get('urls.seq1.list')[jvm.get('idx')])",
+                    "save_to": "jvm.eval('page_' + str(jvm.get('idx')) + '.seq2.str')",
+                },
+            }
+        )
+        self.assertFalse(effects.barrier)
+        self.assertEqual(
+            effects.reads,
+            {KeyPattern("urls.seq1.list"), KeyPattern("idx")},
+        )
+        self.assertEqual(effects.writes, {KeyPattern("page_", prefix=True)})
+
+    def test_text_completion_output_keys(self):
+        effects = dataflow.analyze(
+            {
+                "type": "TextCompletion",
+                "args": {
+                    "request": "Summarize",
+                    "content": "jvm.eval('\\n'.join(jvm.list_values_with_key_prefix('page_')))",
+                    "output_format": {
+                        "kvs": [
+                            {"key": "summary.seq3.str", "value": "<to_fill>"},
+                            {"key": "topic_<idx>.seq3.str", "value": "<to_fill>"},
+                        ]
+                    },
+                },
+            }
+        )
+        self.assertEqual(effects.reads, {KeyPattern("page_", prefix=True)})
+        self.assertEqual(
+            effects.writes,
+            {KeyPattern("summary.seq3.str"), KeyPattern("topic_", prefix=True)},
+        )
+
+    def test_bulk_fetch_writes_one_key_per_url(self):
+        for save_to, prefix in [("page_<idx>.seq3.str", "page_"), ("page.seq3.str", "page")]:
+            with self.subTest(save_to=save_to):
+                instruction = {
+                    "type": "FetchWebContents",
+                    "args": {"urls": "jvm.eval(jvm.get('urls.seq1.list'))", "save_to": save_to},
+                }
+                effects = dataflow.analyze(instruction)
+                self.assertEqual(effects.reads, {KeyPattern("urls.seq1.list")})
+                self.assertEqual(effects.writes, {KeyPattern(prefix, prefix=True)})
+                # every iteration of a loop would write the same keys
+                self.assertFalse(dataflow.independent_iterations([instruction]))
+
+    def test_iterations_reading_keys_of_other_iterations(self):
+        def completion(content, key="jvm.eval('summary_' + str(jvm.get('idx')) + '.seq3.str')"):
+            return {
+                "type": "TextCompletion",
+                "args": {
+                    "request": "Summarize",
+                    "content": content,
+                    "output_format": {"kvs": [{"key": key, "value": "<to_fill>"}]},
+                },
+            }
+
+        page = "jvm.eval(jvm.get('page_' + str(jvm.get('idx')) + '.seq2.str'))"
+        self.assertTrue(dataflow.independent_iterations([completion(page)]))
+
+        for content in [
+            # a running summary reads the summaries of the earlier iterations
+            "jvm.eval(jvm.list_values_with_key_prefix('summary_'))",
+            "jvm.eval(jvm.get('summary_' + str(jvm.get('idx') - 1) + '.seq3.str'))",
+            "jvm.eval(jvm.get('summary_0.seq3.str'))",
+        ]:
+            with self.subTest(content=content):
+                self.assertFalse(dataflow.independent_iterations([completion(content)]))
+
+        # the key read is the current one, but another iteration writes it
+        own = "jvm.eval(jvm.get('summary_' + str(jvm.get('idx')) + '.seq3.str'))"
+        shifted = "jvm.eval('summary_' + str(jvm.get('idx') + 1) + '.seq3.str')"
+        self.assertFalse(dataflow.independent_iterations([completion(own, shifted)]))
+
+    def test_unknown_keys_and_barriers(self):
+        effects = dataflow.analyze(
+            {"type": "WebSearch", "args": {"query": "jvm.eval(jvm.get(key))", "save_to": ""}}
+        )
+        self.assertEqual(effects.reads, {ANY_KEY})
+        self.assertEqual(effects.writes, {ANY_KEY})
+        self.assertTrue(dataflow.analyze({"type": "RunPython", "args": {}}).barrier)
+        self.assertTrue(dataflow.analyze({"type": "Loop", "args": {}}).barrier)
+
+    def test_dependencies(self):
+        search = dataflow.analyze(
+            {"type": "WebSearch", "args": {"query": "a", "save_to": "a.seq1.list"}}
+        )
+        other_search = dataflow.analyze(
+            {"type": "WebSearch", "args": {"query": "b", "save_to": "b.seq2.list"}}
+        )
+        fetch = dataflow.analyze(
+            {
+                "type": "FetchWebContent",
+                "args": {"url": "jvm.eval(jvm.get('a.seq1.list')[0])", "save_to": "page.seq3.str"},
+            }
+        )
+        self.assertEqual(
+            dataflow.dependencies([search, other_search, fetch]), [set(), set(), {0}]
+        )
+
+
+class TestRunGraph(unittest.TestCase):
+    def test_independent_jobs_overlap(self):
+        independent = dataflow.Effects(frozenset(), frozenset())
+        barrier = threading.Barrier(3, timeout=5)
+        dataflow.run_graph([barrier.wait] * 3, [independent] * 3, max_workers=3)
+
+    def test_conflicting_jobs_keep_program_order(self):
+        key = frozenset({KeyPattern("k")})
+        effects = [
+            dataflow.Effects(frozenset(), key),
+            dataflow.Effects(frozenset(), frozenset()),
+            dataflow.Effects(key, frozenset()),
+        ]
+        order = []
+
+        def job(index, delay):
+            def run():
+                time.sleep(delay)
+                order.append(index)
+
+            return run
+
+        dataflow.run_graph([job(0, 0.05), job(1, 0), job(2, 0)], effects, max_workers=3)
+        self.assertLess(order.index(0), order.index(2))
+
+    def test_earliest_error_is_raised(self):
+        effects = [dataflow.Effects(frozenset(), frozenset())] * 2
+        def fail(message):
+            def run():
+                raise ValueError(message)
+
+            return run
+
+        with self.assertRaisesRegex(ValueError, "first"):
+            dataflow.run_graph([fail("first"), fail("second")], effects, max_workers=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
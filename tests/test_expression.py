@@ -0,0 +1,121 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from jarvis.smartgpt import jvm
+from jarvis.smartgpt import expression
+
+
+def evaluate(source):
+    return expression.compile_expression(source)()
+
+
+class TestRestrictedExpression(unittest.TestCase):
+    def test_jvm_subset(self):
+        values = {
+            "name.seq1.str": "jarvis",
+            "items.seq2.list": ["a", "b", "c"],
+            "idx": 1,
+        }
+        with patch.object(jvm, "get", side_effect=lambda key, default=None: values.get(key, default)):
+            self.assertEqual(evaluate("jvm.get('name.seq1.str')"), "jarvis")
+            self.assertEqual(evaluate("len(jvm.get('items.seq2.list'))"), 3)
+            self.assertEqual(evaluate("jvm.get('items.seq2.list')[jvm.get('idx')]"), "b")
+            self.assertEqual(evaluate("jvm.get('items.seq2.list')[-2:]"), ["b", "c"])
+            self.assertEqual(evaluate("'item.seq3.' + str(jvm.get('idx') + 1)"), "item.seq3.2")
+            self.assertEqual(evaluate("', '.join(jvm.get('items.seq2.list'))"), "a, b, c")
+            self.assertEqual(evaluate("f\"{jvm.get('idx'):03d}\""), "001")
+            self.assertEqual(
+                evaluate("[x.upper() for x in jvm.get('items.seq2.list') if x != 'b']"),
+                ["A", "C"],
+            )
+            self.assertEqual(evaluate("jvm.get('missing') or 'default'"), "default")
+            self.assertTrue(evaluate("0 < jvm.get('idx') <= 1 and 'a' in jvm.get('items.seq2.list')"))
+
+    def test_comprehension_over_prefix(self):
+        with patch.object(jvm, "list_values_with_key_prefix", return_value=["x", "y"]) as mock:
+            self.assertEqual(
+                evaluate("{i: v for i, v in enumerate(jvm.list_values_with_key_prefix('page'))}"),
+                {0: "x", 1: "y"},
+            )
+        mock.assert_called_once_with("page")
+
+    def test_rejects_unsafe_forms(self):
+        for source in [
+            "__import__('os').system('true')",
+            "().__class__.__bases__",
+            "jvm.set('key', 1)",
+            "jvm.os",
+            "(lambda: 1)()",
+            "'{0.__class__}'.format(1)",
+            "2 ** 10",
+            "[*range(3)]",
+        ]:
+            with self.subTest(source=source):
+                with self.assertRaises(expression.UnsupportedExpression):
+                    evaluate(source)
+
+    def test_attributes_of_non_data_values(self):
+        with self.assertRaises(expression.UnsupportedExpression):
+            evaluate("jvm.get.cache_info")
+
+    def test_unknown_name(self):
+        with self.assertRaises(NameError):
+            evaluate("open")
+
+
+class TestDecideCondition(unittest.TestCase):
+    def test_decided_locally(self):
+        for condition, expected in [
+            (True, True),
+            ("True", True),
+            (" yes ", True),
+            ("false", False),
+            ("None", False),
+            ("0", False),
+            ("[]", False),
+            ("['a']", True),
+            ("''", False),
+            ("'no'", False),
+            ("3 > 2", True),
+            ("len([1, 2]) == 3", False),
+            ("1 < 2 and not []", True),
+        ]:
+            with self.subTest(condition=condition):
+                self.assertIs(expression.decide_condition(condition), expected)
+
+    def test_left_to_the_llm(self):
+        for condition in [
+            "The article mentions a product launch",
+            "Paris == 'Paris'",
+            "'maybe'",
+            "jvm.get('result.seq2.bool')",
+        ]:
+            with self.subTest(condition=condition):
+                self.assertIsNone(expression.decide_condition(condition))
+
+
+class TestJVMEvalSandbox(unittest.TestCase):
+    def setUp(self):
+        jvm.compile_expression.cache_clear()
+
+    def tearDown(self):
+        jvm.compile_expression.cache_clear()
+
+    def test_fallback_outside_the_subset(self):
+        with patch.dict(os.environ, {"JVM_EVAL_STRICT": "false"}):
+            self.assertEqual(jvm.eval("jvm.eval(2 ** 3)"), "8")
+
+    def test_strict_by_default(self):
+        with patch.dict(os.environ):
+            os.environ.pop("JVM_EVAL_STRICT", None)
+            self.assertIsNone(jvm.eval("jvm.eval(2 ** 3)"))
+            self.assertIsNone(jvm.eval("jvm.eval(__import__('os').getcwd())"))
+
+    def test_eval_is_not_callable_from_an_expression(self):
+        with self.assertRaises(expression.UnsupportedExpression):
+            expression.compile_expression("jvm.eval('__import__(\"os\").getcwd()')")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+from jarvis.smartgpt import extractor
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head><title>The title</title><style>p { color: red }</style></head>
+<body>
+<nav><ul><li><a href="/">Home</a></li><li><a href="/about">About</a></li></ul></nav>
+<div role="navigation"><div>Breadcrumbs</div></div>
+<main>
+<h1>Heading</h1>
+<p>First   paragraph with <b>bold</b> text.  Second  sentence.</p>
+<p>A <a href="https://example.com/ref">reference <i>link</i></a> and a <a href="/local">local one</a>.</p>
+<!-- a comment -->
+<script>console.log("hidden");</script>
+<p>Entities: &amp; &lt;tag&gt; &eacute;<br>after break</p>
+</main>
+<footer>Copyright 2023</footer>
+</body>
+</html>
+"""
+
+
+class TestExtractText(unittest.TestCase):
+    def test_keeps_the_text_of_the_whole_page(self):
+        text = extractor.extract_text(PAGE, skip_boilerplate=False, engine="stdlib")
+        self.assertEqual(
+            text.split("\n"),
+            [
+                "The title",
+                "HomeAbout",
+                "Breadcrumbs",
+                "Heading",
+                "First",
+                "paragraph with bold text.",
+                "Second",
+                "sentence.",
+                "A [reference link](https://example.com/ref) and a local one.",
+                "Entities: & <tag> éafter break",
+                "Copyright 2023",
+            ],
+        )
+
+    def test_skips_boilerplate(self):
+        text = extractor.extract_text(PAGE, skip_boilerplate=True, engine="stdlib")
+        self.assertNotIn("Home", text)
+        self.assertNotIn("Breadcrumbs", text)
+        self.assertNotIn("Copyright", text)
+        self.assertIn("Heading", text)
+        self.assertIn("[reference link](https://example.com/ref)", text)
+
+    def test_nested_and_self_closing_elements(self):
+        html = (
+            "<div role='complementary'><div><div>ad</div></div>side</div>"
+            "<nav/>kept <a href='http://x.io'/> <aside><aside>in</aside>out</aside>end"
+        )
+        self.assertEqual(
+            extractor.extract_text(html, skip_boilerplate=True, engine="stdlib"),
+            "kept [](http://x.io) end",
+        )
+
+    def test_unclosed_boilerplate(self):
+        # closing an enclosing element ends the skipped element, like lxml recovers
+        html = (
+            "<html><body><div><nav><ul><li>Home</ul>menu</div>"
+            "<p>article text</p><footer>by <b>me</footer></body>after body</html>"
+        )
+        self.assertEqual(
+            extractor.extract_text(html, skip_boilerplate=True, engine="stdlib"),
+            "article textafter body",
+        )
+        html = "<div><p>intro</p><footer>by me</div><p>next</p>"
+        self.assertEqual(
+            extractor.extract_text(html, skip_boilerplate=True, engine="stdlib"), "intronext"
+        )
+
+    def test_unclosed_link(self):
+        html = "<p><a href='https://a.io'>first<p>second"
+        self.assertEqual(
+            extractor.extract_text(html, engine="stdlib"), "[firstsecond](https://a.io)"
+        )
+
+    @unittest.skipIf(extractor.etree is None, "lxml is not installed")
+    def test_lxml_engine(self):
+        self.assertEqual(
+            extractor.extract_text(PAGE, skip_boilerplate=True, engine="lxml"),
+            extractor.extract_text(PAGE, skip_boilerplate=True, engine="stdlib"),
+        )
+        self.assertEqual(extractor.extract_text("", engine="lxml"), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from jarvis.smartgpt import fetcher
+
+ARTICLE = "<html><body><article>" + "Server rendered text. " * 20 + "</article></body></html>"
+
+
+def response(status=200, text=ARTICLE, headers=None):
+    resp = mock.Mock()
+    resp.status_code = status
+    resp.text = text
+    resp.headers = {"Content-Type": "text/html; charset=utf-8", **(headers or {})}
+    resp.raise_for_status.side_effect = (
+        requests.HTTPError(f"{status} error") if status >= 400 else None
+    )
+    return resp
+
+
+class TestFetcher(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.Mock()
+        self.browser_pool = mock.Mock()
+        self.browser_pool.get_html.return_value = "<p>rendered</p>"
+
+    def fetcher(self, **kwargs):
+        return fetcher.Fetcher(
+            session=self.session, browser_pool=self.browser_pool, **kwargs
+        )
+
+    def test_server_rendered_page_is_served_over_http(self):
+        self.session.get.return_value = response()
+        f = self.fetcher()
+
+        self.assertEqual(f.get_html("https://example.com"), ARTICLE)
+        self.browser_pool.get_html.assert_not_called()
+        self.assertEqual(f.metrics()["http"]["count"], 1)
+
+    def test_js_rendered_pages_escalate_to_the_browser(self):
+        pages = [
+            "<html><body></body></html>",
+            '<html><body><div id="root"></div>' + "<p>footer text</p>" * 50 + "</body></html>",
+            "<html><body><noscript>You need to enable JavaScript to run this app.</noscript>"
+            + "<p>text</p>" * 100
+            + "</body></html>",
+            "<html><body><script>" + "render();" * 100 + "</script></body></html>",
+        ]
+        for page in pages:
+            with self.subTest(page=page[:40]):
+                self.session.get.return_value = response(text=page)
+                self.assertEqual(self.fetcher().get_html("https://spa.io"), "<p>rendered</p>")
+
+    def test_errors_escalate_to_the_browser(self):
+        f = self.fetcher()
+        self.session.get.return_value = response(status=403)
+        self.assertEqual(f.get_html("https://a.io"), "<p>rendered</p>")
+
+        self.session.get.side_effect = requests.ConnectionError("refused")
+        self.assertEqual(f.get_html("https://b.io"), "<p>rendered</p>")
+        self.assertEqual(f.metrics()["browser"]["count"], 2)
+
+    def test_plain_text_is_not_escalated(self):
+        self.session.get.return_value = response(
+            text="short", headers={"Content-Type": "text/plain"}
+        )
+        self.assertEqual(self.fetcher().get_html("https://a.io/robots.txt"), "short")
+
+    def test_conditional_get(self):
+        f = self.fetcher()
+        self.session.get.return_value = response(
+            headers={"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+        )
+        f.get_html("https://example.com")
+
+        self.session.get.return_value = response(status=304, text="")
+        self.assertEqual(f.get_html("https://example.com"), ARTICLE)
+
+        headers = self.session.get.call_args.kwargs["headers"]
+        self.assertEqual(headers["If-None-Match"], '"v1"')
+        self.assertEqual(headers["If-Modified-Since"], "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.assertEqual(f.metrics()["http_not_modified"]["count"], 1)
+
+    def test_conditional_get_cache_is_bounded_by_bytes(self):
+        f = self.fetcher(max_validator_bytes=2 * len(ARTICLE))
+        self.session.get.return_value = response(headers={"ETag": '"v1"'})
+        for url in ("https://a.io", "https://b.io", "https://c.io", "https://b.io"):
+            f.get_html(url)
+
+        self.assertEqual(list(f.validators), ["https://c.io", "https://b.io"])
+        self.assertEqual(f.validator_bytes, 2 * len(ARTICLE))
+
+        # a page larger than the bound is not kept at all
+        self.session.get.return_value = response(text=ARTICLE * 3, headers={"ETag": '"v2"'})
+        f.get_html("https://b.io")
+        self.assertEqual(list(f.validators), ["https://c.io"])
+        self.assertEqual(f.validator_bytes, len(ARTICLE))
+
+    def test_modes(self):
+        self.session.get.return_value = response(status=500)
+        with self.assertRaises(requests.HTTPError):
+            self.fetcher(mode="http").get_html("https://a.io")
+        self.browser_pool.get_html.assert_not_called()
+
+        self.assertEqual(self.fetcher(mode="browser").get_html("https://a.io"), "<p>rendered</p>")
+        self.assertEqual(self.session.get.call_count, 1)
+
+        with self.assertRaises(ValueError):
+            self.fetcher(mode="curl")
+
+    def test_visible_text_length(self):
+        html = "<style>p {}</style><!-- hidden --><p>Hello   <b>world</b></p><script>x()</script>"
+        self.assertEqual(fetcher.visible_text_length(html), len("Hello world"))
@@ -0,0 +1,259 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+from jarvis.smartgpt import gpt
+
+
+class CountingEncoding:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return self.encoding.encode(text)
+
+    def decode(self, tokens):
+        return self.encoding.decode(tokens)
+
+
+class TestTokenCounting(unittest.TestCase):
+    def setUp(self):
+        gpt._TOKEN_COUNTS.clear()
+        gpt._last_tokens.value = None
+        self.encoding = CountingEncoding(gpt.ENCODING)
+        patcher = mock.patch.object(gpt, "ENCODING", self.encoding)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counts_are_memoized(self):
+        text = "The quick brown fox jumps over the lazy dog. " * 20
+        count = gpt.count_tokens(text)
+
+        self.assertEqual(count, len(gpt.ENCODING.encoding.encode(text)))
+        self.assertEqual(gpt.count_tokens(text), count)
+        self.assertEqual(
+            gpt.count_tokens([{"content": text}, {"content": "hi"}]),
+            count + gpt.count_tokens("hi") + 2 * gpt.TOKENS_PER_MESSAGE,
+        )
+        self.assertEqual(self.encoding.encoded, [text, "hi"])
+
+    def test_cache_is_bounded(self):
+        with mock.patch.object(gpt, "TOKEN_COUNT_CACHE_SIZE", 2):
+            for text in ("one", "two", "three"):
+                gpt.count_tokens(text)
+            gpt.count_tokens("one")
+
+        self.assertEqual(len(gpt._TOKEN_COUNTS), 2)
+        self.assertEqual(self.encoding.encoded, ["one", "two", "three", "one"])
+
+    def test_short_content_is_not_encoded(self):
+        self.assertTrue(gpt.within_tokens("short enough", 100))
+        self.assertEqual(gpt.truncate_to_tokens("short enough", 100), "short enough")
+        self.assertEqual(self.encoding.encoded, [])
+
+    def test_content_is_encoded_once(self):
+        text = "word " * 1000
+        self.assertFalse(gpt.within_tokens(text, 100))
+        truncated = gpt.truncate_to_tokens(text, 100)
+        chunks = gpt.split_to_tokens(text, 400, overlap=20)
+
+        self.assertEqual(self.encoding.encoded, [text])
+        self.assertTrue(text.startswith(truncated))
+        self.assertEqual(gpt.count_tokens(truncated), 100)
+        self.assertGreater(len(chunks), 1)
+
+    def test_streaming_count(self):
+        text = "a line of text\n" * 1000
+        exact = len(gpt.ENCODING.encoding.encode(text))
+        with mock.patch.object(gpt, "TOKEN_STREAM_CHARS", 1000), mock.patch.object(
+            gpt, "_STREAM_PIECE_CHARS", 500
+        ):
+            count = gpt.count_tokens(text)
+
+        pieces = self.encoding.encoded
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual("".join(pieces), text)
+        self.assertTrue(all(piece.endswith("\n") for piece in pieces))
+        self.assertAlmostEqual(count, exact, delta=len(pieces))
+
+
+class TestModelHub(unittest.TestCase):
+    def test_models_are_created_on_first_use(self):
+        created = []
+
+        def factory(name):
+            created.append(name)
+            return object()
+
+        hub = gpt.ModelHub({"a": factory, "b": factory})
+        self.assertIn("a", hub)
+        self.assertNotIn("c", hub)
+        self.assertEqual(sorted(hub), ["a", "b"])
+        self.assertEqual(created, [])
+
+        model = hub["a"]
+        self.assertIs(hub["a"], model)
+        self.assertEqual(created, ["a"])
+        self.assertEqual(hub.created(), ["a"])
+        with self.assertRaises(KeyError):
+            hub["c"]
+
+    def test_import_is_lazy(self):
+        code = (
+            "import sys\n"
+            "from jarvis.smartgpt import gpt\n"
+            "print(sorted(m for m in ('langchain', 'openai', 'tiktoken', 'selenium') if m in sys.modules))"
+        )
+        root = os.path.join(os.path.dirname(__file__), "..")
+        env = dict(os.environ, PYTHONPATH=root)
+        env.setdefault("OPENAI_API_KEY", "sk-test")
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=root, env=env, check=True, capture_output=True, text=True
+        ).stdout
+        self.assertEqual(output.strip(), "[]")
+
+
+class RateLimitError(Exception):
+    http_status = 429
+    headers = {}
+
+
+class ServiceUnavailableError(Exception):
+    pass
+
+
+class TestLLMScheduler(unittest.TestCase):
+    def scheduler(self, **kwargs):
+        self.sleeps = []
+        options = dict(
+            limits={"m": (0, 0)}, backoff_base=0.001, completion_tokens=0, sleep=self.sleeps.append
+        )
+        options.update(kwargs)
+        return gpt.LLMScheduler(**options)
+
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = gpt.TokenBucket(60, clock=lambda: now[0])
+        self.assertEqual(bucket.delay(60), 0)
+        bucket.take(60)
+        self.assertAlmostEqual(bucket.delay(1), 1.0)
+        now[0] = 0.5
+        self.assertAlmostEqual(bucket.delay(1), 0.5)
+        # larger than the bucket, waits for a full bucket
+        self.assertAlmostEqual(bucket.delay(600), 59.5)
+        self.assertEqual(gpt.TokenBucket(0).delay(10**9), 0)
+
+    def test_limits_from_model_info(self):
+        scheduler = gpt.LLMScheduler(limits={"gpt-4": (1, 2)})
+        self.assertEqual(scheduler._state("gpt-4").tokens.capacity, 2)
+        info = gpt.OPEN_AI_MODELS[gpt.GPT_3_5_TURBO]
+        self.assertEqual(scheduler._state(gpt.GPT_3_5_TURBO).requests.capacity, info.rpm)
+        self.assertEqual(gpt.parse_rate_limits("a=1:2, b=3"), {"a": (1, 2), "b": (3, 0)})
+
+    def test_retries_with_backoff(self):
+        errors = [ServiceUnavailableError("busy"), RateLimitError("slow down")]
+
+        def send():
+            if errors:
+                raise errors.pop(0)
+            return "done"
+
+        scheduler = self.scheduler()
+        self.assertEqual(scheduler.call("m", send, 10), "done")
+        # a rate limit pauses the model instead of sleeping
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertTrue(0.0005 <= self.sleeps[0] <= 0.001)
+        metrics = scheduler.metrics()["m"]
+        self.assertEqual(metrics["requests"], 3)
+        self.assertEqual(metrics["retries"], 2)
+        self.assertEqual(metrics["rate_limited"], 1)
+        self.assertEqual(metrics["in_flight"], 0)
+
+    def test_gives_up(self):
+        def fail(err):
+            def send():
+                raise err
+
+            return send
+
+        scheduler = self.scheduler(max_retries=2)
+        with self.assertRaises(ServiceUnavailableError):
+            scheduler.call("m", fail(ServiceUnavailableError()), 10)
+        with self.assertRaises(ValueError):
+            scheduler.call("m", fail(ValueError()), 10)
+
+        metrics = scheduler.metrics()["m"]
+        self.assertEqual((metrics["requests"], metrics["retries"], metrics["failures"]), (4, 2, 2))
+
+    def test_backoff_is_jittered_and_bounded(self):
+        scheduler = self.scheduler(backoff_base=1, backoff_max=8)
+        for attempt, low in ((0, 0.5), (2, 2), (10, 4)):
+            delay = scheduler.backoff(attempt)
+            self.assertTrue(low <= delay <= 2 * low, (attempt, delay))
+
+        err = RateLimitError()
+        err.headers = {"retry-after": "30"}
+        self.assertEqual(scheduler.backoff(0, err), 30)
+
+    def test_embeddings_are_scheduled(self):
+        errors = [RateLimitError("slow down")]
+
+        class Client:
+            def embed_documents(self, texts):
+                if errors:
+                    raise errors.pop(0)
+                return [[float(len(text))] for text in texts]
+
+            def embed_query(self, text):
+                return [float(len(text))]
+
+        scheduler = self.scheduler()
+        embeddings = gpt.ScheduledEmbeddings("m", Client())
+        with mock.patch.object(gpt, "SCHEDULER", scheduler):
+            self.assertEqual(embeddings.embed_documents(["ab", "c"]), [[2.0], [1.0]])
+            self.assertEqual(embeddings.embed_query("abc"), [3.0])
+
+        metrics = scheduler.metrics()["m"]
+        self.assertEqual((metrics["requests"], metrics["rate_limited"]), (3, 1))
+
+    def test_priorities(self):
+        scheduler = self.scheduler(max_concurrency=1)
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def blocking():
+            started.set()
+            release.wait(5)
+            return ""
+
+        def send(name):
+            return lambda: order.append(name) or ""
+
+        first = threading.Thread(target=scheduler.call, args=("m", blocking, 1))
+        first.start()
+        started.wait(5)
+        threads = [
+            threading.Thread(target=scheduler.call, args=("m", send("background"), 1, gpt.BACKGROUND)),
+            threading.Thread(target=scheduler.call, args=("m", send("interactive"), 1, gpt.INTERACTIVE)),
+        ]
+        for thread in threads:
+            thread.start()
+            while scheduler.metrics()["m"]["queue_depth"] < threads.index(thread) + 1:
+                time.sleep(0.001)
+
+        self.assertEqual(scheduler.metrics()["m"]["max_queue_depth"], 2)
+        release.set()
+        for thread in [first] + threads:
+            thread.join(5)
+        self.assertEqual(order, ["interactive", "background"])
+
+
+if __name__ == "__main__":
+    unittest.main()
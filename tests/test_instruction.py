@@ -1,8 +1,14 @@
+import os
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 import json
 
-from jarvis.smartgpt.instruction import JVMInstruction
+from jarvis.smartgpt import actions
+from jarvis.smartgpt import jvm
+from jarvis.smartgpt.instruction import JVMInstruction, JVMInterpreter
 
 class TestInstruction(unittest.TestCase):
     def setUp(self):
@@ -189,5 +195,222 @@ class TestInstruction(unittest.TestCase):
 
         mock_set.assert_has_calls(expected_calls, any_order=True)
 
+class TestJVMInterpreterLoop(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.context = jvm.JVMContext(os.path.join(self.tmp_dir.name, "kv_store.json"))
+        self.context.set("urls.seq1.list", ["a", "b", "c"])
+
+    def tearDown(self):
+        self.context.close()
+        self.tmp_dir.cleanup()
+
+    def fetch_loop(self):
+        return {
+            "seq": 2,
+            "type": "Loop",
+            "args": {
+                "count": "jvm.eval(len(jvm.get('urls.seq1.list')))",
+                "instructions": [
+                    {
+                        "seq": 3,
+                        "type": "FetchWebContent",
+                        "args": {
+                            "url": "jvm.eval(jvm.get('urls.seq1.list')[jvm.get('idx')])",
+                            "save_to": "jvm.eval('page_' + str(jvm.get('idx')) + '.seq3.str')",
+                        },
+                    }
+                ],
+            },
+        }
+
+    def run_loop(self, fetch, loop_fanout):
+        def run(action):
+            return fetch({"url": action.url, "save_to": action.save_to})
+
+        with mock.patch.object(actions.FetchWebContentAction, "run", run):
+            interpreter = JVMInterpreter(self.context, loop_fanout=loop_fanout)
+            interpreter.run([self.fetch_loop()], "task")
+
+    def test_iterations_run_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def fetch(data):
+            barrier.wait()
+            # finish in reverse order, the results are committed in loop order anyway
+            time.sleep(0.05 * (2 - jvm.get("idx")))
+            return json.dumps({"kvs": [{"key": data["save_to"], "value": data["url"]}]})
+
+        self.run_loop(fetch, loop_fanout=3)
+
+        self.assertEqual(
+            self.context.list_keys_with_prefix("page_"),
+            ["page_0.seq3.str", "page_1.seq3.str", "page_2.seq3.str"],
+        )
+        self.assertEqual(self.context.list_values_with_key_prefix("page_"), ["a", "b", "c"])
+        self.assertEqual(self.context.get("idx"), 2)
+
+    def test_sequential_loop(self):
+        def fetch(data):
+            return json.dumps({"kvs": [{"key": data["save_to"], "value": data["url"]}]})
+
+        self.run_loop(fetch, loop_fanout=1)
+
+        self.assertEqual(self.context.list_values_with_key_prefix("page_"), ["a", "b", "c"])
+        self.assertEqual(self.context.get("idx"), 2)
+
+    def test_failed_iteration_commits_earlier_ones(self):
+        def fetch(data):
+            if data["url"] == "b":
+                raise RuntimeError("fetch failed")
+            return json.dumps({"kvs": [{"key": data["save_to"], "value": data["url"]}]})
+
+        with self.assertRaisesRegex(RuntimeError, "fetch failed"):
+            self.run_loop(fetch, loop_fanout=3)
+
+        self.assertEqual(self.context.list_keys_with_prefix("page_"), ["page_0.seq3.str"])
+        self.assertEqual(self.context.get("idx"), 1)
+
+
+    def test_running_summary_loop_keeps_its_order(self):
+        loop = {
+            "seq": 2,
+            "type": "Loop",
+            "args": {
+                "count": "4",
+                "instructions": [
+                    {
+                        "seq": 3,
+                        "type": "TextCompletion",
+                        "args": {
+                            "request": "Summarize",
+                            "content": "jvm.eval(','.join(jvm.list_values_with_key_prefix('summary_')))",
+                            "output_format": {
+                                "kvs": [
+                                    {
+                                        "key": "jvm.eval('summary_' + str(jvm.get('idx')) + '.seq3.str')",
+                                        "value": "<to_fill>",
+                                    }
+                                ]
+                            },
+                        },
+                    }
+                ],
+            },
+        }
+
+        def complete(action):
+            summaries = [s for s in action.content.split(",") if s]
+            key = f"summary_{jvm.get('idx')}.seq3.str"
+            return json.dumps({"kvs": [{"key": key, "value": f"S{len(summaries)}"}]})
+
+        results = {}
+        for loop_fanout in (1, 4):
+            context = jvm.JVMContext(os.path.join(self.tmp_dir.name, f"kv_{loop_fanout}.json"))
+            with mock.patch.object(actions.TextCompletionAction, "run", complete):
+                JVMInterpreter(context, loop_fanout=loop_fanout).run([loop], "task")
+            results[loop_fanout] = context.list_values_with_key_prefix("summary_")
+            context.close()
+
+        self.assertEqual(results[1], ["S0", "S1", "S2", "S3"])
+        self.assertEqual(results[4], results[1])
+
+class TestJVMInterpreterResume(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.context = jvm.JVMContext(os.path.join(self.tmp_dir.name, "kv_store.json"))
+        self.queries = []
+        self.failing = {"q2"}
+
+    def tearDown(self):
+        self.context.close()
+        self.tmp_dir.cleanup()
+
+    def search(self, action):
+        self.queries.append(action.query)
+        if action.query in self.failing:
+            raise RuntimeError(f"search {action.query} failed")
+        return json.dumps({"kvs": [{"key": action.save_to, "value": action.query}]})
+
+    def run_task(self, instrs, resume=False, max_workers=1):
+        with mock.patch.object(actions.WebSearchAction, "run", lambda action: self.search(action)):
+            interpreter = JVMInterpreter(self.context, max_workers=max_workers, loop_fanout=1)
+            interpreter.run(instrs, "task", resume=resume)
+
+    def test_resume_after_failed_instruction(self):
+        instrs = [
+            {"seq": i, "type": "WebSearch", "args": {"query": f"q{i}", "save_to": f"r{i}.seq{i}.list"}}
+            for i in range(1, 4)
+        ]
+        with self.assertRaisesRegex(RuntimeError, "q2"):
+            self.run_task(instrs)
+        self.assertEqual(self.queries, ["q1", "q2"])
+
+        self.queries.clear()
+        self.failing.clear()
+        self.run_task(instrs, resume=True)
+        self.assertEqual(self.queries, ["q2", "q3"])
+        self.assertEqual(self.context.get("r3.seq3.list"), "q3")
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "checkpoint.json")))
+
+    def test_resume_concurrent_batch(self):
+        instrs = [
+            {"seq": i, "type": "WebSearch", "args": {"query": f"q{i}", "save_to": f"r{i}.seq{i}.list"}}
+            for i in range(1, 4)
+        ]
+        with self.assertRaisesRegex(RuntimeError, "q2"):
+            self.run_task(instrs, max_workers=3)
+        self.assertEqual(sorted(self.queries), ["q1", "q2", "q3"])
+
+        self.queries.clear()
+        self.failing.clear()
+        self.run_task(instrs, resume=True, max_workers=3)
+        self.assertEqual(self.queries, ["q2"])
+
+    def test_resume_inside_loop(self):
+        instrs = [
+            {
+                "seq": 1,
+                "type": "Loop",
+                "args": {
+                    "count": 3,
+                    "instructions": [
+                        {
+                            "seq": 2,
+                            "type": "WebSearch",
+                            "args": {
+                                "query": "jvm.eval('q' + str(jvm.get('idx')))",
+                                "save_to": "jvm.eval('r_' + str(jvm.get('idx')) + '.seq2.list')",
+                            },
+                        }
+                    ],
+                },
+            }
+        ]
+        self.failing = {"q1"}
+        with self.assertRaisesRegex(RuntimeError, "q1"):
+            self.run_task(instrs)
+
+        self.queries.clear()
+        self.failing.clear()
+        self.run_task(instrs, resume=True)
+        self.assertEqual(self.queries, ["q1", "q2"])
+        self.assertEqual(self.context.list_values_with_key_prefix("r_"), ["q0", "q1", "q2"])
+
+    def test_changed_store_restarts_the_task(self):
+        instrs = [
+            {"seq": i, "type": "WebSearch", "args": {"query": f"q{i}", "save_to": f"r{i}.seq{i}.list"}}
+            for i in range(1, 3)
+        ]
+        with self.assertRaises(RuntimeError):
+            self.run_task(instrs)
+        self.context.set("unrelated", "write")
+
+        self.queries.clear()
+        self.failing.clear()
+        self.run_task(instrs, resume=True)
+        self.assertEqual(self.queries, ["q1", "q2"])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+from unittest import mock
+
+from jarvis.smartgpt import actions
+from jarvis.smartgpt import ir
+from jarvis.smartgpt import jvm
+
+ACTIONS = {
+    "WebSearch": actions.WebSearchAction,
+    "FetchWebContent": actions.FetchWebContentAction,
+    "RunPython": actions.RunPythonAction,
+    "TextCompletion": actions.TextCompletionAction,
+}
+
+
+class TestTemplate(unittest.TestCase):
+    def test_constants_stay_constants(self):
+        self.assertEqual(ir.template("plain text"), "plain text")
+        self.assertEqual(ir.template(None), "")
+        self.assertEqual(ir.template(3), 3)
+
+    def test_templates_reading_the_jvm(self):
+        self.assertEqual(
+            ir.template("page jvm.eval(jvm.get('idx'))"),
+            ir.Template("page jvm.eval(jvm.get('idx'))"),
+        )
+        self.assertEqual(ir.template("jvm.get('idx')"), ir.Template("jvm.get('idx')"))
+
+    def test_pure_templates_are_folded(self):
+        with mock.patch.object(jvm, "get") as mock_get:
+            self.assertEqual(ir.template("a jvm.eval(1 + 2) b jvm.eval('x' * 2)"), "a 3 b xx")
+        mock_get.assert_not_called()
+
+    def test_failing_templates_are_not_folded(self):
+        with self.assertNoLogs(level="CRITICAL"):
+            self.assertEqual(ir.template("jvm.eval(1 / 0)"), ir.Template("jvm.eval(1 / 0)"))
+
+    def test_templates_reading_the_jvm_are_not_evaluated(self):
+        value = "a jvm.eval(1 + 1) b jvm.eval(jvm.get('k'))"
+        with mock.patch.object(jvm, "get") as mock_get:
+            self.assertEqual(ir.template(value), ir.Template(value))
+        mock_get.assert_not_called()
+
+    def test_templates_render_like_eval_all(self):
+        values = {"idx": 2, "k": "v", "urls": ["a", "b", "c"], "lazy": "jvm.eval(1 + 1)"}
+        with mock.patch.object(jvm, "get", side_effect=lambda key, default=None: values.get(key, default)):
+            for text in [
+                "page_jvm.eval(jvm.get('idx')).seq3.str",
+                "jvm.eval(jvm.get('k'))jvm.eval(jvm.get('idx') + 1) (x) jvm.eval(jvm.get('urls')[jvm.get('idx')])",
+                "jvm.get('k')",
+                "nested jvm.eval(str(jvm.eval(jvm.get('idx'))))",
+                "brings in jvm.eval(jvm.get('lazy'))",
+                "fails jvm.eval(jvm.get('idx') / 0) after jvm.eval(jvm.get('k'))",
+            ]:
+                with self.subTest(text=text):
+                    self.assertEqual(ir.Template(text).render(), jvm.eval_all(text))
+
+    def test_templates_are_compiled_once(self):
+        template = ir.Template("page_jvm.eval(jvm.get('idx')).seq3.str")
+        with mock.patch.object(jvm, "get", return_value=1), mock.patch.object(
+            jvm, "eval_all"
+        ) as mock_eval_all, mock.patch.object(jvm, "compile_expression") as mock_compile:
+            self.assertEqual(template.render(), "page_1.seq3.str")
+        mock_eval_all.assert_not_called()
+        mock_compile.assert_not_called()
+
+
+class TestCompile(unittest.TestCase):
+    def test_action(self):
+        op = ir.compile_instruction(
+            {
+                "seq": 4,
+                "type": "TextCompletion",
+                "args": {
+                    "request": "Summarize",
+                    "content": "jvm.eval(jvm.get('page.seq3.str'))",
+                    "output_format": {"kvs": [{"key": "summary.seq4.str", "value": "<to_fill>"}]},
+                },
+            },
+            ACTIONS,
+        )
+        self.assertIs(op.action_class, actions.TextCompletionAction)
+        self.assertEqual([name for name, _ in op.args], ["request", "content", "output_format"])
+
+        with mock.patch.object(jvm, "get", return_value="some page"):
+            action = op.build()
+        self.assertEqual(action.action_id, 4)
+        self.assertEqual(action.content, "some page")
+        self.assertIn('"summary.seq4.str"', action.output_format)
+
+    def test_run_python_defaults(self):
+        op = ir.compile_instruction(
+            {"seq": 2, "type": "RunPython", "args": {"code": "print(1)", "timeout": ""}},
+            ACTIONS,
+        )
+        self.assertEqual(dict(op.args)["timeout"], 30)
+
+    def test_validation(self):
+        with self.assertRaisesRegex(ValueError, "save_to"):
+            ir.compile_instruction({"seq": 1, "type": "WebSearch", "args": {"query": "q"}}, ACTIONS)
+        with self.assertRaisesRegex(ValueError, "count"):
+            ir.compile_instruction({"seq": 1, "type": "Loop", "args": {}}, ACTIONS)
+
+    def test_flow_control(self):
+        program = ir.compile_program(
+            [
+                {
+                    "seq": 1,
+                    "type": "Loop",
+                    "args": {
+                        "count": "3",
+                        "instructions": [
+                            {
+                                "seq": 2,
+                                "type": "If",
+                                "args": {
+                                    "condition": "jvm.eval(jvm.get('idx') > 0)",
+                                    "then": [
+                                        {"seq": 3, "type": "WebSearch", "args": {"query": "q", "save_to": "r.seq3.list"}}
+                                    ],
+                                },
+                            }
+                        ],
+                    },
+                }
+            ],
+            ACTIONS,
+        )
+        loop = program[0]
+        self.assertEqual(loop.count, 3)
+        self.assertFalse(loop.independent)
+        condition = loop.body[0]
+        self.assertIsInstance(condition, ir.IfOp)
+        self.assertEqual(condition.then[0].action_type, "WebSearch")
+        self.assertEqual(condition.orelse, ())
+
+
+if __name__ == "__main__":
+    unittest.main()
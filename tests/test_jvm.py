@@ -0,0 +1,95 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from jarvis.smartgpt import jvm
+from jarvis.smartgpt import kvstore
+
+
+class TestJVMContext(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def new_context(self, name):
+        return jvm.JVMContext(os.path.join(self.tmp_dir.name, name, "kv_store.json"))
+
+    def test_contexts_are_isolated(self):
+        os.makedirs(os.path.join(self.tmp_dir.name, "a"))
+        os.makedirs(os.path.join(self.tmp_dir.name, "b"))
+        context_a = self.new_context("a")
+        context_b = self.new_context("b")
+
+        context_a.set("key.seq1.str", "a")
+        context_b.set("key.seq1.str", "b")
+
+        self.assertEqual(context_a.get("key.seq1.str"), "a")
+        self.assertEqual(context_b.get("key.seq1.str"), "b")
+
+    def test_use_context_binds_module_functions_per_thread(self):
+        contexts = []
+        for i in range(4):
+            os.makedirs(os.path.join(self.tmp_dir.name, str(i)))
+            contexts.append(self.new_context(str(i)))
+
+        barrier = threading.Barrier(len(contexts))
+        results = {}
+
+        def worker(i, context):
+            with jvm.use_context(context):
+                jvm.set("idx", i)
+                barrier.wait()
+                results[i] = jvm.get("idx")
+
+        threads = [
+            threading.Thread(target=worker, args=(i, context))
+            for i, context in enumerate(contexts)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {0: 0, 1: 1, 2: 2, 3: 3})
+
+    def test_large_values_are_spilled(self):
+        context = self.new_context("")
+        context.blobs.threshold = 1024
+        page = "fetched page content " * 1000
+        context.set("page.seq2.str", page)
+
+        self.assertTrue(kvstore.is_blob_ref(context.store.get("page.seq2.str")))
+        self.assertEqual(context.get("page.seq2.str"), page)
+
+        reloaded = self.new_context("")
+        self.assertEqual(reloaded.get("page.seq2.str"), page)
+        self.assertEqual(reloaded.list_values_with_key_prefix("page."), [page])
+
+    def test_env_points_child_at_the_context(self):
+        context = self.new_context("a")
+        env = context.env()
+        self.assertEqual(env["JVM_KV_STORE_PATH"], context.path)
+        self.assertEqual(env["JVM_KV_STORE_ENGINE"], context.engine)
+
+    def test_scope_layers_over_context(self):
+        context = jvm.JVMContext(os.path.join(self.tmp_dir.name, "kv_store.json"))
+        context.set("idx", 5)
+        context.set("page_0.seq3.str", "stored")
+
+        with jvm.use_context(context), jvm.use_scope({"idx": 1}) as scope:
+            jvm.set("page_1.seq3.str", "local")
+            self.assertEqual(jvm.get("idx"), 1)
+            self.assertEqual(
+                jvm.list_values_with_key_prefix("page_"), ["stored", "local"]
+            )
+
+        self.assertEqual(context.get("idx"), 5)
+        self.assertIsNone(context.get("page_1.seq3.str"))
+        self.assertEqual(scope["page_1.seq3.str"], "local")
+
+
+if __name__ == "__main__":
+    unittest.main()
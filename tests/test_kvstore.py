@@ -0,0 +1,322 @@
+import os
+import json
+import tempfile
+import unittest
+
+from jarvis.smartgpt import kvstore
+
+
+class TestValueEncoding(unittest.TestCase):
+    def test_native_containers(self):
+        value = ["https://www.google.com", "https://www.apple.com"]
+        encoded = kvstore.encode_value(value)
+        self.assertEqual(json.loads(json.dumps(encoded)), value)
+        self.assertEqual(kvstore.decode_value(encoded), value)
+
+    def test_bytes(self):
+        encoded = kvstore.encode_value(b"\x00\x01binary")
+        decoded = kvstore.decode_value(json.loads(json.dumps(encoded)))
+        self.assertEqual(decoded, b"\x00\x01binary")
+
+    @unittest.skipIf(kvstore.msgpack is None, "msgpack is not installed")
+    def test_container_of_bytes(self):
+        value = {"name": "logo", "blobs": [b"\x89PNG"]}
+        encoded = kvstore.encode_value(value)
+        self.assertEqual(encoded[kvstore.TYPE_TAG], "msgpack")
+        self.assertEqual(kvstore.decode_value(json.loads(json.dumps(encoded))), value)
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp_dir.name, "kv_store.blobs")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_small_values_stay_inline(self):
+        blobs = kvstore.BlobStore(self.directory, threshold=1024)
+        self.assertEqual(blobs.spill("short text"), "short text")
+        self.assertEqual(blobs.spill(["a", "b"]), ["a", "b"])
+        self.assertFalse(os.path.exists(self.directory))
+
+    def test_spill_and_resolve(self):
+        for compression in ["none", "gzip"]:
+            blobs = kvstore.BlobStore(
+                self.directory, threshold=1024, compression=compression
+            )
+            for value in ["page text \u00e9 " * 200, ["url"] * 300]:
+                ref = blobs.spill(value)
+                self.assertTrue(kvstore.is_blob_ref(ref))
+                self.assertLess(len(json.dumps(ref)), 256)
+
+                # a fresh store has nothing cached and reads the file
+                reader = kvstore.BlobStore(self.directory)
+                self.assertEqual(reader.resolve(ref), value)
+
+    def test_content_addressed(self):
+        blobs = kvstore.BlobStore(self.directory, threshold=16)
+        ref1 = blobs.spill("same content" * 10)
+        ref2 = blobs.spill("same content" * 10)
+        self.assertEqual(ref1["sha256"], ref2["sha256"])
+
+        blobs.spill("other content" * 10)
+        self.assertEqual(blobs.collect([ref1]), 1)
+        self.assertEqual(kvstore.BlobStore(self.directory).resolve(ref1), "same content" * 10)
+
+
+class TestWALStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "kv_store.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_set_appends_records(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        store.set("key1", "value1")
+        store.set("key2", ["a", "b"])
+
+        self.assertFalse(os.path.exists(self.path))
+        with open(store.wal_path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        reloaded = kvstore.WALStore(self.path)
+        reloaded.load()
+        self.assertEqual(reloaded.get("key1"), "value1")
+        self.assertEqual(reloaded.get("key2"), ["a", "b"])
+
+    def test_generation_follows_writes_of_any_process(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        before = store.generation()
+        self.assertEqual(json.loads(json.dumps(before)), before)
+
+        other = kvstore.WALStore(self.path)
+        other.load()
+        other.set("key1", "value1")
+        self.assertNotEqual(store.generation(), before)
+        self.assertEqual(store.generation(), other.generation())
+
+    def test_compaction(self):
+        store = kvstore.WALStore(self.path, compact_records=3)
+        store.load()
+        for i in range(4):
+            store.set(f"key{i}", i)
+
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {"key0": 0, "key1": 1, "key2": 2})
+        self.assertEqual(store.wal_records, 1)
+
+        reloaded = kvstore.WALStore(self.path, compact_records=3)
+        reloaded.load()
+        self.assertEqual(reloaded.keys(), ["key0", "key1", "key2", "key3"])
+
+    def test_replay_drops_torn_record(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        store.set("key1", "value1")
+        with open(store.wal_path, "a") as f:
+            f.write('{"k": "key2", "v": "val')
+
+        reloaded = kvstore.WALStore(self.path)
+        reloaded.load()
+        self.assertEqual(reloaded.get("key1"), "value1")
+        self.assertIsNone(reloaded.get("key2"))
+
+        # later appends must not be glued to the torn record
+        reloaded.set("key3", "value3")
+        again = kvstore.WALStore(self.path)
+        again.load()
+        self.assertEqual(again.get("key3"), "value3")
+
+    def test_replay_skips_corrupt_record_in_the_middle(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        store.set("key1", "value1")
+        with open(store.wal_path, "a") as f:
+            f.write('{"k": "key2", "v": "val\n')
+        store.set("key3", "value3")
+        size = os.path.getsize(store.wal_path)
+
+        reloaded = kvstore.WALStore(self.path)
+        reloaded.load()
+        self.assertEqual(reloaded.keys(), ["key1", "key3"])
+        # the records after it are kept
+        self.assertEqual(os.path.getsize(store.wal_path), size)
+
+    def test_set_applies_records_of_other_writers_first(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        other = kvstore.WALStore(self.path)
+        other.load()
+
+        store.set("key1", "value1")
+        other.set("key2", "value2")
+        other.set("key1", "updated")
+        store.set("key3", "value3")
+
+        self.assertEqual(store.get("key1"), "updated")
+        self.assertEqual(store.keys(), ["key1", "key2", "key3"])
+        self.assertEqual(store.wal_offset, os.path.getsize(store.wal_path))
+        self.assertEqual(store.wal_records, 4)
+
+        reloaded = kvstore.WALStore(self.path)
+        reloaded.load()
+        self.assertEqual(reloaded.data, store.data)
+
+    def test_set_after_compaction_by_other_process(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        store.set("key1", "value1")
+
+        other = kvstore.WALStore(self.path)
+        other.load()
+        other.set("key2", "value2")
+        other.compact()
+        other.set("key3", "value3")
+        store.set("key4", "value4")
+
+        self.assertEqual(store.keys(), ["key1", "key2", "key3", "key4"])
+        reloaded = kvstore.WALStore(self.path)
+        reloaded.load()
+        self.assertEqual(reloaded.data, store.data)
+
+    def test_refresh_merges_appended_records(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        store.set("key1", "value1")
+
+        child = kvstore.WALStore(self.path)
+        child.load()
+        child.set("key2", "value2")
+        child.set("key1", "updated")
+
+        store.refresh()
+        self.assertEqual(store.get("key1"), "updated")
+        self.assertEqual(store.get("key2"), "value2")
+        self.assertEqual(store.wal_offset, os.path.getsize(store.wal_path))
+
+    def test_refresh_after_compaction_by_other_process(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        store.set("key1", "value1")
+
+        child = kvstore.WALStore(self.path)
+        child.load()
+        child.set("key2", "value2")
+        child.compact()
+
+        store.refresh()
+        self.assertEqual(store.keys(), ["key1", "key2"])
+
+    def test_reads_legacy_snapshot(self):
+        with open(self.path, "w") as f:
+            json.dump({"key1": "value1"}, f)
+
+        store = kvstore.WALStore(self.path)
+        store.load()
+        self.assertEqual(store.get("key1"), "value1")
+
+    def test_reset(self):
+        store = kvstore.WALStore(self.path)
+        store.load()
+        store.set("key1", "value1")
+        store.reset()
+
+        reloaded = kvstore.WALStore(self.path)
+        reloaded.load()
+        self.assertEqual(reloaded.keys(), [])
+
+
+class TestSQLiteStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "kv_store.json")
+        self.store = kvstore.SQLiteStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_get_set(self):
+        self.store.set("key1", "value1")
+        self.store.set("key2", ["a", "b"])
+        self.store.set("key1", "value2")
+
+        self.assertEqual(self.store.get("key1"), "value2")
+        self.assertEqual(self.store.get("key2"), ["a", "b"])
+        self.assertEqual(self.store.get("missing", "default"), "default")
+
+    def test_prefix_scan_keeps_insertion_order(self):
+        for i in [0, 1, 2, 10]:
+            self.store.set(f"info_{i}.seq3.str", f"value{i}")
+        self.store.set("infp_0.seq3.str", "other")
+        self.store.set("info_1.seq3.str", "updated")
+
+        self.assertEqual(
+            self.store.keys_with_prefix("info_"),
+            ["info_0.seq3.str", "info_1.seq3.str", "info_2.seq3.str", "info_10.seq3.str"],
+        )
+        self.assertEqual(
+            [value for _, value in self.store.items_with_prefix("info_1")],
+            ["updated", "value10"],
+        )
+
+    def test_concurrent_reader(self):
+        self.store.set("key1", "value1")
+        reader = kvstore.SQLiteStore(self.path)
+        self.assertEqual(reader.get("key1"), "value1")
+        self.store.set("key1", "value2")
+        # a reader only drops its decoded values cache when it is reloaded
+        reader.load()
+        self.assertEqual(reader.get("key1"), "value2")
+        reader.close()
+
+    def test_refresh_evicts_changed_keys(self):
+        self.store.set("key1", "value1")
+        self.store.set("key2", "value2")
+        self.assertEqual(self.store.get("key1"), "value1")
+
+        child = kvstore.SQLiteStore(self.path)
+        child.set("key1", "updated")
+        child.close()
+
+        self.store.refresh()
+        self.assertEqual(self.store.get("key1"), "updated")
+        self.assertEqual(self.store.get("key2"), "value2")
+
+    def test_refresh_after_reset_by_other_process(self):
+        self.store.set("key1", "value1")
+        self.assertEqual(self.store.get("key1"), "value1")
+
+        child = kvstore.SQLiteStore(self.path)
+        child.reset()
+        child.close()
+
+        self.store.refresh()
+        self.assertIsNone(self.store.get("key1"))
+
+    def test_generation(self):
+        before = self.store.generation()
+        self.store.set("key1", "value1")
+        after_set = self.store.generation()
+        self.assertNotEqual(after_set, before)
+
+        self.store.reset()
+        self.assertNotEqual(self.store.generation(), after_set)
+
+    def test_imports_legacy_snapshot(self):
+        path = os.path.join(self.tmp_dir.name, "legacy.json")
+        with open(path, "w") as f:
+            json.dump({"key1": "value1"}, f)
+
+        store = kvstore.SQLiteStore(path)
+        self.assertEqual(store.get("key1"), "value1")
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from jarvis.smartgpt import actions
+from jarvis.smartgpt import jvm
+from jarvis.smartgpt import profiler
+from jarvis.smartgpt.instruction import JVMInterpreter
+
+
+class TestProfiler(unittest.TestCase):
+    def test_counters_add_up_to_enclosing_spans(self):
+        prof = profiler.Profiler()
+        self.assertFalse(profiler.active())
+
+        with prof.span("task", "task") as task:
+            profiler.record(profiler.CACHE_HITS)
+            with prof.span("WebSearch", "instruction", seq=1) as search:
+                profiler.record(profiler.KV_BYTES_WRITTEN, 10)
+
+        profiler.record(profiler.CACHE_HITS)
+        self.assertEqual(search.parent, task)
+        self.assertEqual(search.counters, {profiler.KV_BYTES_WRITTEN: 10})
+        self.assertEqual(
+            prof.totals(), {profiler.CACHE_HITS: 1, profiler.KV_BYTES_WRITTEN: 10}
+        )
+
+        data = prof.to_dict()
+        self.assertEqual([span["name"] for span in data["spans"]], ["task", "WebSearch"])
+        self.assertEqual(data["spans"][1]["args"], {"seq": 1})
+
+    def test_spans_of_worker_threads(self):
+        prof = profiler.Profiler()
+
+        with prof.span("task", "task") as task:
+
+            def work():
+                with prof.span("TextCompletion", "instruction", task):
+                    profiler.record(profiler.LLM_TOKENS_IN, 5)
+
+            worker = threading.Thread(target=work, name="jvm-worker_0")
+            worker.start()
+            worker.join()
+
+        self.assertEqual(task.counters, {profiler.LLM_TOKENS_IN: 5})
+
+        trace = prof.to_chrome_trace()
+        spans = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+        self.assertEqual([span["name"] for span in spans], ["task", "TextCompletion"])
+        self.assertNotEqual(spans[0]["tid"], spans[1]["tid"])
+        self.assertEqual(spans[1]["args"], {profiler.LLM_TOKENS_IN: 5})
+        self.assertGreaterEqual(spans[0]["dur"], spans[1]["dur"])
+        names = {
+            event["args"]["name"] for event in trace["traceEvents"] if event["ph"] == "M"
+        }
+        self.assertIn("jvm-worker_0", names)
+
+    def test_failed_span(self):
+        prof = profiler.Profiler()
+        with self.assertRaises(ValueError):
+            with prof.span("RunPython", "instruction"):
+                raise ValueError("boom")
+
+        self.assertEqual(prof.to_dict()["spans"][0]["error"], "boom")
+        self.assertFalse(profiler.active())
+
+
+class TestInterpreterProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.context = jvm.JVMContext(os.path.join(self.tmp_dir.name, "kv_store.json"))
+        self.context.set("urls.seq1.list", ["a", "b"])
+
+    def tearDown(self):
+        self.context.close()
+        self.tmp_dir.cleanup()
+
+    def test_run_is_profiled(self):
+        instructions = [
+            {
+                "seq": 2,
+                "type": "Loop",
+                "args": {
+                    "count": "2",
+                    "instructions": [
+                        {
+                            "seq": 3,
+                            "type": "FetchWebContent",
+                            "args": {
+                                "url": "jvm.eval(jvm.get('urls.seq1.list')[jvm.get('idx')])",
+                                "save_to": "jvm.eval('page_' + str(jvm.get('idx')) + '.seq3.str')",
+                            },
+                        }
+                    ],
+                },
+            }
+        ]
+
+        def run(action):
+            return json.dumps({"kvs": [{"key": action.save_to, "value": action.url * 4}]})
+
+        prof = profiler.Profiler()
+        with mock.patch.object(actions.FetchWebContentAction, "run", run):
+            interpreter = JVMInterpreter(self.context, loop_fanout=1, profiler=prof)
+            interpreter.run(instructions, "task")
+
+        spans = prof.to_dict()["spans"]
+        self.assertEqual(
+            [(span["name"], span["category"]) for span in spans],
+            [
+                ("task", "task"),
+                ("Loop", "instruction"),
+                ("iteration", "iteration"),
+                ("FetchWebContent", "instruction"),
+                ("iteration", "iteration"),
+                ("FetchWebContent", "instruction"),
+            ],
+        )
+        self.assertEqual(spans[1]["args"], {"pc": 0, "seq": 2})
+        self.assertEqual(spans[4]["args"], {"idx": 1})
+        # "bbbb" is written by the second iteration, after reading the urls
+        self.assertEqual(spans[5]["counters"][profiler.KV_BYTES_WRITTEN], 4)
+        self.assertGreater(spans[5]["counters"][profiler.KV_BYTES_READ], 0)
+
+        totals = prof.totals()
+        self.assertGreaterEqual(totals[profiler.KV_BYTES_WRITTEN], 8)
+
+        path = os.path.join(self.tmp_dir.name, "profile.json")
+        prof.dump_chrome_trace(path)
+        with open(path) as f:
+            self.assertEqual(len(json.load(f)["traceEvents"]), len(spans) + 1)
@@ -1,5 +1,7 @@
 # test_utils.py
 
+import os
+import tempfile
 import unittest
 from unittest.mock import patch
 
@@ -112,5 +114,48 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(jvm.eval(expected_step_2), expected_step_3)
 
 
+class TestEvalAll(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.context = jvm.JVMContext(os.path.join(self.tmp_dir.name, "kv_store.json"))
+        self.context.set("idx", 0)
+        self.context.set("urls.seq1.list", ["https://a.com", "https://b.com"])
+        self.context.set("note.seq2.str", "sunny (from weather.com)")
+        self.context.set("lazy.seq3.str", "jvm.eval(str(1+1))")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def eval_loop(self, text):
+        while True:
+            patched = jvm.eval(text)
+            if patched is None:
+                return text
+            text = patched
+
+    def test_same_result_as_eval_loop(self):
+        texts = [
+            '{"kvs":[{"key":"jvm.eval("key_points_" + str(jvm.get("idx")) + ".seq3.list")", "value":"<to_fill>"}]}',
+            '{"kvs":[{"key":"jvm.eval("key_points_" + "jvm.eval(str(jvm.get("idx")))" + ".seq3.list")", "value":"<to_fill>"}]}',
+            'jvm.eval("key_points_" + "jvm.eval(str(jvm.get("jvm.eval("idx")")))" + ".seqjvm.eval(str(1+1+1)).list")',
+            "url: jvm.eval(jvm.get('urls.seq1.list')[jvm.get('idx')]) and jvm.eval(len(jvm.get('urls.seq1.list')))",
+            "Today is jvm.eval(jvm.get('note.seq2.str')), jvm.eval('weather') jvm.eval(jvm.get('note.seq2.str') + ')')",
+            "nested jvm.eval(jvm.get('lazy.seq3.str')) value",
+            "jvm.get('lazy.seq3.str')",
+            'unbalanced jvm.eval(str(jvm.get("idx") + " jvm.eval(1)',
+            "error jvm.eval(1/0) jvm.eval(2)",
+            "no closing jvm.eval(1 + 1",
+            "nothing to evaluate",
+        ]
+        with jvm.use_context(self.context):
+            for text in texts:
+                self.assertEqual(jvm.eval_all(text), self.eval_loop(text), text)
+
+    def test_right_to_left_order(self):
+        with patch.object(jvm, "get", side_effect=["new_key1", "new_key2"]):
+            text = "{'key': 'jvm.eval(jvm.get(\"key1\"))'}, {'key': 'jvm.eval(jvm.get(\"key2\"))'}"
+            self.assertEqual(jvm.eval_all(text), "{'key': 'new_key2'}, {'key': 'new_key1'}")
+
+
 if __name__ == "__main__":
     unittest.main()